@@ -1,10 +1,9 @@
-from flaskr import pages
-from .backend import Backend
+from flaskr import pages, instrumentation, retry, compression, metrics
+from .backend import Backend, MAX_UPLOAD_SIZE
+from .drivers import make_storage_client
 from flask import Flask
 from flask_login import LoginManager
-import logging
-
-logging.basicConfig(level=logging.DEBUG)
+import os
 
 
 def create_app(test_config=None):
@@ -16,7 +15,24 @@ def create_app(test_config=None):
 
     # This is the default secret key used for login sessions
     # By default the dev environment uses the key 'dev'
-    app.config.from_mapping(SECRET_KEY='dev',)
+    # Requests bigger than MAX_CONTENT_LENGTH are rejected before they are read
+    # Users named in ADMIN_USERS can download a backup from /admin/export,
+    # once SECRET_KEY is no longer the default
+    # LOOKUP_WORKERS threads run the storage lookups views overlap
+    # With METRICS_DIR, /metrics adds up every worker process's metrics
+    # through files in that directory (see gunicorn.conf.py)
+    app.config.from_mapping(SECRET_KEY=pages.DEFAULT_SECRET_KEY,
+                            MAX_CONTENT_LENGTH=MAX_UPLOAD_SIZE,
+                            STORAGE_DRIVER='gcs',
+                            STORAGE_ROOT=None,
+                            SLOW_REQUEST_MS=instrumentation.SLOW_REQUEST_MS,
+                            SEARCH_EXPLAIN=False,
+                            STORAGE_DEADLINE=retry.DEADLINE,
+                            HEDGED_READS=False,
+                            PACKED_PAGES=False,
+                            ADMIN_USERS=(),
+                            LOOKUP_WORKERS=pages.LOOKUP_WORKERS,
+                            METRICS_DIR=os.environ.get('WIKI_METRICS_DIR'))
 
     if test_config is None:
         # Load the instance config, if it exists, when not testing.
@@ -26,7 +42,29 @@ def create_app(test_config=None):
         # Load the test config if passed in.
         app.config.from_mapping(test_config)
 
-    backend = Backend()
+    # STORAGE_DRIVER picks Google Cloud Storage ('gcs'), files on local disk
+    # under STORAGE_ROOT ('local') or memory ('memory')
+    # The GCS client is only created when storage is first used, or by
+    # /_ah/warmup when App Engine starts an instance ahead of traffic
+    backend = Backend(make_storage_client(app.config, app.instance_path))
+    app.extensions['backend'] = backend
+    # Storage reads are retried until STORAGE_DEADLINE seconds have passed, and
+    # with HEDGED_READS slow page reads are sent twice
+    backend.retrier.deadline = app.config['STORAGE_DEADLINE']
+    if app.config['HEDGED_READS']:
+        backend.hedger = retry.Hedger()
+    # With PACKED_PAGES searches read small pages from packs, which cron
+    # rebuilds through /tasks/pack_pages
+    backend.packed_pages = app.config['PACKED_PAGES']
+    # Bookmark changes are written back in the background, except when testing
+    backend.write_behind = not app.testing
+    if app.config['METRICS_DIR']:
+        app.extensions['shared_metrics'] = metrics.SharedMetrics(
+            app.config['METRICS_DIR'])
+    # Times backend and storage calls per request, see the Server-Timing header
+    instrumentation.init_app(app, backend)
+    # Gzips HTML responses for browsers that accept it
+    compression.init_app(app)
     pages.make_endpoints(app, login_manager, backend)
     login_manager.init_app(app)
     app.config['WTF_CSRF_ENABLED'] = False
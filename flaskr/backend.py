@@ -1,44 +1,300 @@
-from google.cloud import storage
 from google.cloud import exceptions
 from flask_login import current_user
 from .search_algo import levenshtein_distance
+from .bookmarks import BookmarkStore, BOOKMARKS_CHANGELOG
+from . import metrics
+from .cache import (LRUCache, ChangeLog, CHANGELOG_BUCKET, MAX_CACHED_IMAGES,
+                    MAX_CACHED_IMAGE_BYTES, PAGE_CACHE_TTL, IMAGE_CACHE_TTL)
+from .drivers import LazyClient
+from .packs import PackStore, PACKS_BUCKET
+from .history import RevisionStore, HISTORY_BUCKET
+from .retry import Retrier, request_options
+from . import compression
 import hashlib
 import io
+import logging
+import threading
+import time
+import uuid
 from flask import Flask
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+#Constants
+
+#Largest upload accepted, in bytes (override with MAX_CONTENT_LENGTH in the app config)
+MAX_UPLOAD_SIZE = 16 * 1024 * 1024
+
+#Uploads bigger than this are sent as resumable uploads in chunks
+RESUMABLE_UPLOAD_THRESHOLD = 8 * 1024 * 1024
+
+#Size of each chunk of a resumable upload, must be a multiple of 256 KiB
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+
+#Size of each chunk read when streaming a page, must be a multiple of 256 KiB
+STREAM_CHUNK_SIZE = 256 * 1024
+
+#Reports waiting to be merged into their page's report blob live under this prefix
+PENDING_REPORTS_PREFIX = 'pending/'
+
+#Each page's merged reports live under this prefix, so no page name can make
+#its report blob look like a pending report
+REPORTS_PREFIX = 'reports/'
+
+#Most objects a single compose call accepts
+MAX_COMPOSE_SOURCES = 32
+
+#How many pages an import writes at the same time
+IMPORT_WORKERS = 8
+
+#Stages of a search, in the order they run
+SEARCH_STAGES = ('list', 'fetch', 'tokenize', 'compare', 'rank')
+
+
+class lazy_property:
+    '''
+    Attribute computed by the decorated method on first use, then kept on the instance.
+
+    Unlike functools.cached_property, threads that race to the first use
+    wait for one computation instead of each running their own.
+    '''
+
+    def __init__(self, method):
+        self.method = method
+        self.name = method.__name__
+        self.__doc__ = method.__doc__
+        self._lock = threading.RLock()
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        with self._lock:
+            if self.name not in instance.__dict__:
+                instance.__dict__[self.name] = self.method(instance)
+        return instance.__dict__[self.name]
 
 
 class Backend:
 
-    def __init__(self, storage_client=storage.Client()):
+    def __init__(self, storage_client=None):
+        #Without a client, a GCS client is created the first time storage is used
+        if storage_client is None:
+            storage_client = LazyClient()
         self.storage_client = storage_client
-        self.pages_bucket = self.storage_client.bucket('sdswiki_contents')
-        self.users_bucket = self.storage_client.bucket('sdsusers_passwords')
-        self.images_bucket = self.storage_client.bucket('sdsimages')
+        #Pages expire even if a changelog bump that should have dropped them was lost
+        self.page_cache = LRUCache(ttl=PAGE_CACHE_TTL)
+        self.image_cache = _image_cache()
+        #Retries storage reads that fail with transient errors
+        self.retrier = Retrier()
+        #Set to a retry.Hedger to duplicate page reads slower than most
+        self.hedger = None
+        #Set to True to read small pages from packs when searching (see packs.py)
+        self.packed_pages = False
+        #Set to True to write bookmark changes back from a background thread,
+        #otherwise they are only written when flushed (see bookmarks.py)
+        self.write_behind = False
+        #Runs cleanup work that doesn't need to finish before the response
+        self.deferred = ThreadPoolExecutor(max_workers=1,
+                                           thread_name_prefix='deferred')
+
+    #Buckets and the stores built on them are made on first use, so creating
+    #a Backend doesn't create the storage client
+
+    @lazy_property
+    def pages_bucket(self):
+        return self.storage_client.bucket('sdswiki_contents')
+
+    @lazy_property
+    def users_bucket(self):
+        return self.storage_client.bucket('sdsusers_passwords')
+
+    @lazy_property
+    def images_bucket(self):
+        return self.storage_client.bucket('sdsimages')
+
+    @lazy_property
+    def changelog(self):
+        return ChangeLog(self.storage_client.bucket(CHANGELOG_BUCKET))
+
+    @lazy_property
+    def bookmarks(self):
+        changelog = ChangeLog(self.storage_client.bucket(CHANGELOG_BUCKET),
+                              BOOKMARKS_CHANGELOG)
+        store = BookmarkStore(self.storage_client.bucket('sds_bookmarks'),
+                              changelog)
+        if self.write_behind:
+            store.start()
+        return store
+
+    @lazy_property
+    def history(self):
+        return RevisionStore(self.storage_client.bucket(HISTORY_BUCKET),
+                             self.retrier)
+
+    @lazy_property
+    def packs(self):
+        return PackStore(self.storage_client.bucket(PACKS_BUCKET), self.retrier)
+
+    def warm_up(self):
+        """Creates the storage client, buckets and stores ahead of the first request that needs them.
 
-    def get_wiki_page(self, name):
-        """Gets the contents of the specified wiki page.
+        Returns:
+            True once everything is ready.
+        """
+        for name in _lazy_properties(type(self)):
+            getattr(self, name)
+        return True
+
+    def after_fork(self):
+        """Replaces what a forked worker process must not share with its parent.
+
+        The storage client's connections, the caches' locks and the background
+        threads of the deferred executor and the bookmark store don't survive
+        a fork, so the worker gets new ones. Call this in the worker right
+        after it is forked (see gunicorn.conf.py).
+        """
+        if isinstance(self.storage_client, LazyClient):
+            self.storage_client.reset()
+        for name in _lazy_properties(type(self)):
+            self.__dict__.pop(name, None)
+        self.page_cache = LRUCache(ttl=PAGE_CACHE_TTL)
+        self.image_cache = _image_cache()
+        self.deferred = ThreadPoolExecutor(max_workers=1,
+                                           thread_name_prefix='deferred')
+        if self.hedger is not None:
+            self.hedger.after_fork()
+
+    def get_page_record(self, name, stream_over=None):
+        """Gets the contents and metadata of a wiki page with a single blob fetch.
 
         Args:
             name: The name of the wiki page.
+            stream_over: If given, pages bigger than this many bytes are neither
+                read up front nor cached. Their record holds a 'chunks' iterator
+                over the content instead of 'content'.
 
         Returns:
-            The contents of the wiki page.
+            A dict with the page's content, author, generation, size and updated
+            time, or None if the page does not exist.
+
+        Raises:
+            Exception: If there is a network error.
+        """
+        #Drop any pages other instances changed since we cached them
+        self.changelog.sync(self.page_cache)
+        record = self.page_cache.get(name)
+        if record is not None:
+            return record
+
+        if self.hedger is not None:
+            blob, content = self.hedger.call(self.retrier.call, self._read_page,
+                                             name, stream_over)
+        else:
+            blob, content = self.retrier.call(self._read_page, name,
+                                              stream_over)
+        if blob is None:
+            return None
+
+        record = _metadata_of(blob)
+        if content is None:
+            record['chunks'] = _iter_chunks(blob, STREAM_CHUNK_SIZE)
+            return record
+
+        record['content'] = content
+        self.page_cache.put(name, record)
+        return record
+
+    def _read_page(self, name, stream_over=None):
+        '''
+        Reads a page's blob, and its content unless it is bigger than stream_over.
+
+        Returns:
+            The blob and its content, the blob and None for a page to stream,
+            or (None, None) if the page does not exist.
+        '''
+        blob = self._get_page_blob(name)
+        if blob is None:
+            return None, None
+        if stream_over is not None and _length_of(blob) > stream_over:
+            return blob, None
+        if compression.is_compressed(blob):
+            return blob, compression.read_bytes(blob).decode('utf-8')
+        with blob.open(**request_options()) as f:
+            return blob, f.read()
+
+    def _get_page_blob(self, name):
+        '''
+        Returns a page's blob, or None if it doesn't exist, within the deadline of the retrier calling it.
+        '''
+        return self.pages_bucket.get_blob(name, **request_options())
+
+    def iter_wiki_page(self, name, chunk_size=STREAM_CHUNK_SIZE):
+        """Reads a wiki page in chunks, so big pages never sit in memory whole.
+
+        Args:
+            name: The name of the wiki page.
+            chunk_size: How many characters each chunk holds.
+
+        Returns:
+            An iterator over the page's content, or None if the page does not exist.
+        """
+        blob = self.retrier.call(self._get_page_blob, name)
+        if blob is None:
+            return None
+        return _iter_chunks(blob, chunk_size)
+
+    def get_page_metadata(self, name):
+        """Gets the author, generation and updated time of a wiki page without reading its content.
+
+        Args:
+            name: The name of the wiki page.
+
+        Returns:
+            A dict with the page's author, generation and updated time (and
+            content, if the page is cached), or None if the page does not exist.
 
         Raises:
             Exception: If there is a network error.
         """
+        self.changelog.sync(self.page_cache)
+        record = self.page_cache.get(name)
+        if record is not None:
+            return record
 
-        blob = self.pages_bucket.get_blob(name)
+        blob = self.retrier.call(self._get_page_blob, name)
         if blob is None:
-            return f"Error: Wiki page {name} not found."
+            return None
+        return _metadata_of(blob)
 
+    def get_wiki_page(self, name):
+        """Gets the contents of the specified wiki page.
+
+        Args:
+            name: The name of the wiki page.
+
+        Returns:
+            The contents of the wiki page.
+
+        Raises:
+            Exception: If there is a network error.
+        """
         try:
-            with blob.open() as f:
-                content = f.read()
-            return content
+            record = self.get_page_record(name)
         except Exception as e:
             return f"Network error: {e}"
 
+        if record is None:
+            return f"Error: Wiki page {name} not found."
+        return record['content']
+
+    def _page_changed(self, name):
+        '''
+        Invalidates a page in this instance's cache and tells the other instances.
+        '''
+        self.page_cache.invalidate(name)
+        self.changelog.bump(name)
+
     def get_all_page_names(self):
         """Gets the names of all wiki pages.
 
@@ -49,34 +305,65 @@ class Backend:
             Exception: If there is a network error.
         """
         try:
-            pages_names_list = []
+            pages_names_list = self.retrier.call(self._list_names)
 
-            blobs = self.storage_client.list_blobs('sdswiki_contents')
-
-            if not blobs:
+            if pages_names_list is None:
                 return 'Error: No pages found in bucket.'
 
-            for blob in blobs:
-                pages_names_list.append(blob.name)
-
             return pages_names_list
 
         except Exception as e:
             return f"Error: {e}"
 
+    def pack_pages(self):
+        '''
+        Copies every small page into packs, so searches read them in a few requests.
+
+        Returns:
+            How many pages were packed, or None if another instance packed them at the same time.
+        '''
+        blobs = self.retrier.call(self._list_blobs)
+        return self.packs.consolidate(blobs, self._read_page_bytes)
+
+    def _read_page_bytes(self, name):
+        '''
+        Returns a page's content in bytes, or None if it doesn't exist.
+        '''
+        blob = self.retrier.call(self._get_page_blob, name)
+        if blob is None:
+            return None
+        try:
+            return self.retrier.call(compression.read_bytes, blob)
+        except exceptions.NotFound:
+            return None
+
+    def _list_blobs(self, bucket_name='sdswiki_contents'):
+        return list(
+            self.storage_client.list_blobs(bucket_name, **request_options()))
+
+    def _list_names(self, bucket_name='sdswiki_contents'):
+        '''
+        Lists the names of every object in a bucket, or returns None if there are none.
+        '''
+        blobs = self.storage_client.list_blobs(bucket_name, **request_options())
+        if not blobs:
+            return None
+        return [blob.name for blob in blobs]
+
     def upload(self, data, destination_blob_name, username, override=False):
         '''
         Uploads page to Wiki server
 
         Args:
             destination_blob_name = name of page to be uploaded
-            data = the information to be displayed on the page
+            data = the information to be displayed on the page, either a string
+                or a seekable file object, which is streamed to storage in chunks
 
         returns:
             A response message stating if your upload was successful or not.
             If the upload was unsuccessful, the reason why would be displayed.
         '''
-        if len(data) <= 0:
+        if _size_of(data) <= 0:
             if override:
                 return 'Page contents cannot be empty'
             return 'Please upload a file.'
@@ -84,28 +371,161 @@ class Backend:
         if destination_blob_name == '':
             return 'Please provide the name of the page.'
 
-        blobs = self.storage_client.list_blobs('sdswiki_contents')
-        for blob in blobs:
-            if destination_blob_name == blob.name and not override:
-                return 'Upload failed. You cannot overrite an existing page'
+        page_names = self.retrier.call(self._list_names) or []
+        if destination_blob_name in page_names and not override:
+            return 'Upload failed. You cannot overrite an existing page'
 
         try:
-            blob = self.pages_bucket.blob(destination_blob_name)
-            # Set the x-goog-meta-author metadata header
-            blob.metadata = {'author': username}
-
-            blob.upload_from_string(data)
-
+            self._write_page(data, destination_blob_name, username)
         except Exception as e:
             return f"Network Error: {e}. Please try again later."
 
+        self._page_changed(destination_blob_name)
+        self._record_revision(data, destination_blob_name, username)
         if override:
             return f"The page titled {destination_blob_name} was successfully updated."
         return f"{destination_blob_name} uploaded to Wiki."
 
+    def _write_page(self, data, name, username):
+        '''
+        Writes a page's blob with its author and length, streaming file objects in chunks.
+        '''
+        blob = self.pages_bucket.blob(name)
+        # Set the x-goog-meta-author metadata header, and the length of the
+        # content before compression, which the blob's size doesn't tell
+        blob.metadata = {'author': username, 'length': str(_size_of(data))}
+
+        #Pages that shrink when gzipped are stored gzipped, see compression.py
+        if hasattr(data, 'read'):
+            data, size, blob.content_encoding = compression.compress_file(
+                data, _size_of(data))
+            if size > RESUMABLE_UPLOAD_THRESHOLD:
+                blob.chunk_size = UPLOAD_CHUNK_SIZE
+            blob.upload_from_file(data, size=size, rewind=True)
+        else:
+            data, blob.content_encoding = compression.compress(data)
+            if blob.content_encoding is None:
+                blob.upload_from_string(data)
+            else:
+                blob.upload_from_string(
+                    data, content_type='text/plain; charset=utf-8')
+
+    def _record_revision(self, data, name, username):
+        '''
+        Adds what was just written to the page's history, logging storage errors instead of failing.
+        '''
+        try:
+            self.history.record(name, data, username)
+        #OSError covers the dropped connections and timeouts of the GCS library
+        except (exceptions.GoogleCloudError, OSError) as e:
+            logger.warning('Could not record a revision of %s: %s', name, e)
+
+    def get_revisions(self, name):
+        """Lists the revisions of a wiki page, oldest first.
+
+        Args:
+            name: The name of the wiki page.
+
+        Returns:
+            A list of dicts with each revision's number, author, kind (snapshot
+            or delta), stored size and updated time. Pages written before
+            history was kept have no revisions until they are next edited.
+
+        Raises:
+            Exception: If there is a network error.
+        """
+        return self.history.list(name)
+
+    def get_revision(self, name, revision):
+        """Gets the contents of a wiki page as of one of its revisions.
+
+        Args:
+            name: The name of the wiki page.
+            revision: The revision number, from 1.
+
+        Returns:
+            The contents of the revision, or None if there is no such revision.
+
+        Raises:
+            Exception: If there is a network error.
+        """
+        return self.history.get(name, revision)
+
+    def diff_revisions(self, name, old, new):
+        """Compares two revisions of a wiki page.
+
+        Args:
+            name: The name of the wiki page.
+            old: The revision compared from.
+            new: The revision compared to.
+
+        Returns:
+            The unified diff between them, or None if either doesn't exist.
+
+        Raises:
+            Exception: If there is a network error.
+        """
+        return self.history.diff(name, old, new)
+
+    def import_pages(self, pages, workers=IMPORT_WORKERS):
+        '''
+        Uploads many pages at once, such as when seeding or migrating the wiki.
+
+        Unlike upload, the bucket isn't listed for every page, so page names
+        must be checked beforehand (see bulk.validate). Pages are written, and
+        recorded in their history, by a pool of workers, with at most twice as
+        many read ahead as are being written, and the changelog is bumped once
+        for all of them at the end.
+
+        Args:
+            pages = An iterable of (page name, content, author) tuples
+            workers = How many pages are written at the same time
+
+        Returns:
+            A dict from page name to None if it was written, or the reason it wasn't.
+        '''
+        results = {}
+        futures = {}
+        #Bounds how many pages sit in memory waiting for a worker
+        slots = threading.BoundedSemaphore(workers * 2)
+        with ThreadPoolExecutor(max_workers=workers,
+                                thread_name_prefix='import') as pool:
+            for name, data, author in pages:
+                if _size_of(data) <= 0:
+                    results[name] = 'Page contents cannot be empty'
+                    continue
+                slots.acquire()
+                future = pool.submit(self._import_page, data, name, author)
+                future.add_done_callback(lambda _: slots.release())
+                futures[name] = future
+
+        for name, future in futures.items():
+            error = future.exception()
+            results[name] = None if error is None else f"Network Error: {error}"
+
+        written = [name for name in futures if results[name] is None]
+        for name in written:
+            self.page_cache.invalidate(name)
+        if written:
+            self.changelog.bump(*written)
+        return results
+
+    def _import_page(self, data, name, author):
+        '''
+        Writes an imported page and adds it to the page's history, like upload does.
+        '''
+        self._write_page(data, name, author)
+        self._record_revision(data, name, author)
+
     def report(self, page, message):
         '''
         Saves the report message for a page in backend
+
+        Each report is written as its own small object under pending/, so the
+        cost of reporting doesn't grow with the page's report history and
+        concurrent reports can't overwrite each other. compact_reports later
+        merges them into the page's report blob, under reports/.
+
         Args: The page being reported, and the message of the report
         Returns: A message stating the status of the report made.
         '''
@@ -113,19 +533,60 @@ class Backend:
             return 'You need to enter a message'
         bucket = self.storage_client.bucket('sds_reports')
 
-        blob = bucket.get_blob(page)
-        if blob == None:
-            blob = bucket.blob(page)
-            blob.upload_from_string(message)
-
-        else:
-            new_report = message + '\n'
-            with blob.open('r') as f:
-                new_report += str(f.read())
-            with blob.open('w') as f:
-                f.write(new_report)
+        blob = bucket.blob(_pending_report_name(page))
+        #Report names are unique, so this only guards against overwriting
+        blob.upload_from_string(message + '\n', if_generation_match=0)
         return "Your report was sent successfully."
 
+    def compact_reports(self):
+        '''
+        Merges pending reports into each page's report blob, newest first.
+
+        The merge is done server side with compose, so report history is never
+        downloaded. A report can be merged twice if we crash between the
+        compose and deleting its pending object, but it is never lost.
+
+        Returns:
+            The number of pending reports that were merged.
+        '''
+        bucket = self.storage_client.bucket('sds_reports')
+        pending = {}
+        for blob in self.storage_client.list_blobs(
+                'sds_reports', prefix=PENDING_REPORTS_PREFIX):
+            page = blob.name[len(PENDING_REPORTS_PREFIX):].rsplit('/', 1)[0]
+            pending.setdefault(page, []).append(blob)
+
+        merged = 0
+        for page, reports in pending.items():
+            #Pending names start with their timestamp, so this is oldest first
+            reports.sort(key=lambda blob: blob.name)
+            while reports:
+                #compose takes at most 32 sources, one of which is the history
+                batch = reports[:MAX_COMPOSE_SOURCES - 1]
+                target = REPORTS_PREFIX + page
+                history = bucket.get_blob(target)
+                sources = list(reversed(batch))
+                generation = 0
+                if history is not None:
+                    sources.append(history)
+                    generation = history.generation
+                else:
+                    #Reports merged before they moved under reports/ carry on
+                    legacy = bucket.get_blob(page)
+                    if legacy is not None:
+                        sources.append(legacy)
+                try:
+                    bucket.blob(target).compose(sources,
+                                                if_generation_match=generation)
+                except exceptions.PreconditionFailed:
+                    #Another compaction is merging this page right now
+                    break
+                for blob in batch:
+                    blob.delete()
+                merged += len(batch)
+                reports = reports[len(batch):]
+        return merged
+
     def sign_up(self, name, password):
         '''
         Allows a person to create an account on the wiki if they are using it for the first time.
@@ -139,10 +600,10 @@ class Backend:
             or if it was unsuccessful because the user already exists.
         '''
 
-        blobs = self.storage_client.list_blobs('sdsusers_passwords')
-        for blob in blobs:
-            if blob.name == name:
-                return f"user {name} already exists in the database. Please sign in."
+        user_names = self.retrier.call(self._list_names,
+                                       'sdsusers_passwords') or []
+        if name in user_names:
+            return f"user {name} already exists in the database. Please sign in."
 
         blob = self.users_bucket.blob(name)
         with blob.open("w") as user:
@@ -166,21 +627,28 @@ class Backend:
         '''
         salty_password = f"{username}{password}".encode()
         hashed = hashlib.sha3_256(salty_password).hexdigest()
-        stored = False
 
-        blobs = self.storage_client.list_blobs('sdsusers_passwords')
-        for blob in blobs:
-            if username == blob.name:
-                with blob.open("r") as username:
-                    secure_password = username.read()
-                stored = True
-        if not stored:
+        secure_password = self.retrier.call(self._stored_password, username)
+        if secure_password is None:
             return False
 
         if hashed == secure_password:
             return True
         return False
 
+    def _stored_password(self, username):
+        '''
+        Returns the hashed password of an account, or None if there is no such account.
+        '''
+        secure_password = None
+        blobs = self.storage_client.list_blobs('sdsusers_passwords',
+                                               **request_options())
+        for blob in blobs:
+            if username == blob.name:
+                with blob.open("r", **request_options()) as f:
+                    secure_password = f.read()
+        return secure_password
+
     def get_image(self, name):
         '''
         Allows images to be pulled from the bucket and sent to the html pages. 
@@ -191,15 +659,45 @@ class Backend:
         Returns:
             Binary form of the image reqested.
         '''
-        blob = self.images_bucket.get_blob(name)
+        record = self.get_image_record(name)
+        if record is None:
+            return None
+        return record['data']
+
+    def get_image_record(self, name):
+        '''
+        Gets an image and the metadata needed to serve it, keeping it in memory for later requests.
+
+        Args:
+            name = The name of the picture
+
+        Returns:
+            A dict with the image's bytes, content type and generation, or None if there is no such image.
+        '''
+        record = self.image_cache.get(name)
+        if record is not None:
+            return record
+
+        blob, img = self.retrier.call(self._read_image, name)
 
         if blob == None:
             return None
 
-        with blob.open("rb") as f:
-            img = f.read()
-
-        return img
+        record = {
+            'data': img,
+            'content_type': blob.content_type,
+            'generation': blob.generation,
+            'updated': blob.updated,
+        }
+        self.image_cache.put(name, record, len(img))
+        return record
+
+    def _read_image(self, name):
+        blob = self.images_bucket.get_blob(name, **request_options())
+        if blob is None:
+            return None, None
+        with blob.open("rb", **request_options()) as f:
+            return blob, f.read()
 
     def check_page_author(self, page_name):
         """
@@ -213,26 +711,18 @@ class Backend:
         If the specified blob does not exist or does not have an author metadata, returns None.
         If an error occurs while retrieving the metadata, returns None and prints an error message.
         """
-        blob = self.pages_bucket.get_blob(page_name)
+        blob = self.retrier.call(self._get_page_blob, page_name)
         if blob:
-            try:
-                metadata = blob.metadata
-                author = metadata.get('author')
-                if author:
-                    return author
-                else:
-                    return None
-
-            except AttributeError:
-                return None
-
-        else:
-            return None
+            return _author_of(blob)
+        return None
 
     def delete_page(self, name):
         '''
         Allows pages to be deleted from the wiki. 
 
+        Deletions are not recorded as revisions: the page's history is kept as
+        it was, and a page later written under the same name continues it.
+
         Args:
             name = The name of the page to delete
 
@@ -244,13 +734,14 @@ class Backend:
         for blob in blobs:
             if blob.name == name:
                 blob.delete()
+                self._page_changed(name)
                 return True
         #Return false if it was never found
         return False
 
     def bookmark(self, page_title, name):
         '''
-        Stores a user's bookmark in a GCP blob
+        Stores a user's bookmark, written back to its GCP blob in the background
 
         Args:
             page_title = page to bookmark
@@ -259,29 +750,68 @@ class Backend:
         Returns:
             True for successful bookmarks, False otherwise
         '''
-        bucket = self.storage_client.bucket('sds_bookmarks')
-        blob = bucket.get_blob(name)
+        #Return false if bookmark already exists
+        return self.bookmarks.add(name, page_title)
 
-        #For first time bookmarks
-        if blob == None:
-            blob = bucket.blob(name)
-            blob.upload_from_string(page_title + '\n')
-            return True
+    def save_bookmarks(self, name):
+        '''
+        Writes a user's bookmark changes back now, instead of waiting for the background flush
 
-        #Adding bookmarks to existing blobs instead of overwritting data
-        with blob.open('r') as f:
-            bookmark_data = f.read()
-        info = bookmark_data.splitlines()
-        if page_title not in info:
-            bookmark_data += page_title + '\n'
-            blob.upload_from_string(bookmark_data)
-            return True
-        #Return false if bookmark already exists
-        return False
+        Args:
+            name = The name of the user's account
+
+        Returns:
+            The generation the bookmarks were written at, to pass to
+            require_bookmarks, or None if nothing was written. Changes that
+            couldn't be written stay pending for the next flush.
+        '''
+        try:
+            return self.bookmarks.flush_user(name)
+        except Exception as e:
+            logger.warning('Could not write bookmarks of %s: %s', name, e)
+            return None
+
+    def require_bookmarks(self, name, generation):
+        '''
+        Makes this process read a user's bookmarks again if its copy is older than what they saved
+
+        Args:
+            name = The name of the user's account
+            generation = A generation returned by save_bookmarks, in any process
+        '''
+        self.bookmarks.require(name, generation)
+
+    def is_bookmarked(self, name, page_title):
+        '''
+        Checks whether a user has bookmarked a page without listing the wiki.
+
+        Args:
+            name = The name of the user's account
+            page_title = The page to look for
+
+        Returns:
+            True if the page is in the user's bookmarks, False otherwise
+        '''
+        return self.bookmarks.contains(name, page_title)
+
+    def load_bookmarks(self, name):
+        '''
+        Reads a user's bookmarks into memory, so a get_bookmarks call that follows doesn't wait on storage
+
+        Args:
+            name = The name of the user's account
+
+        Returns:
+            How many bookmarks the user has
+        '''
+        return len(self.bookmarks.get(name))
 
     def get_bookmarks(self, name, existing_pages):
         '''
-        Pulls a user's bookmarks from GCP Bucket and ensures all bookmarks are still valid
+        Gets a user's bookmarks and ensures all bookmarks are still valid
+
+        Bookmarks of deleted pages are left out, and removed from the user's
+        bookmarks by a deferred task instead of on the request path.
 
         Args:
             name = The name of the user's account
@@ -290,34 +820,31 @@ class Backend:
         Returns:
             list of bookmarks
         '''
-        new_data = ""
-        deleted_pages = False
+        bookmarks = self.bookmarks.get(name)
+        #get_all_page_names returns an error message when listing fails,
+        #which must not make every bookmark look stale
+        if isinstance(existing_pages, str):
+            return bookmarks
+
+        #Hashing the page names makes each check O(1) instead of O(pages)
+        existing_pages = set(existing_pages)
         bookmarks_list = []
-        bucket = self.storage_client.bucket('sds_bookmarks')
-        blob = bucket.get_blob(name)
-
-        if blob == None:
-            return bookmarks_list
-
-        #Reading in bookmark data
-        with blob.open('r') as f:
-            bookmark_data = f.readlines()
+        deleted_pages = []
 
         #Ensuring all bookmarked pages are still active (in the wiki)
-        for line in bookmark_data:
-            if line[:-1] not in existing_pages:
-                deleted_pages = True
+        for title in bookmarks:
+            if title not in existing_pages:
+                deleted_pages.append(title)
                 continue
-            new_data += line
-            bookmarks_list.append(line[:-1])
+            bookmarks_list.append(title)
 
         if deleted_pages:
-            blob.upload_from_string(new_data)
+            self.deferred.submit(self.bookmarks.remove, name, *deleted_pages)
         return bookmarks_list
 
     def remove_bookmark(self, title, name):
         '''
-        Rewrites a blob's data and skips over the line to remove 
+        Removes a bookmark, written back to its GCP blob in the background
 
         Args:
             title = bookmark to remove
@@ -326,76 +853,227 @@ class Backend:
         Returns:
             Success message or error message
         '''
-        new_data = ""
-        deleted = False
-        bucket = self.storage_client.bucket('sds_bookmarks')
-        blob = bucket.get_blob(name)
-        title += '\n'
-        #Read in bookmark data
-        with blob.open('r') as f:
-            bookmark_data = f.readlines()
-        #Rewriting data but skipping over the line we're removing
-        for line in bookmark_data:
-            if line == title:
-                deleted = True
-                continue
-            new_data += line
-        #Upload new data
-        blob.upload_from_string(new_data)
-        #Return success or error message
-        if deleted:
+        if self.bookmarks.remove(name, title):
             return 'Bookmark successfully deleted'
         return 'Error'
 
-    def search_pages(self, search_content, max_distance, wiki_searcher=None):
+    def search_pages(self,
+                     search_content,
+                     max_distance,
+                     wiki_searcher=None,
+                     explain=False):
+        """Ranks the pages whose title or content match the words searched for.
+
+        Args:
+            search_content: The words to search for.
+            max_distance: How many characters a word may differ by and still match.
+            wiki_searcher: Where pages are listed and read from, this backend by default.
+            explain: Also return a profile of where the search spent its time.
+
+        Returns:
+            The matching page titles, best match first. With explain, a tuple of
+            the titles and a dict with the seconds spent in each stage (listing,
+            fetching, tokenizing, comparing and ranking) and how many pages were
+            examined, words compared, distances computed and page cache hits.
+        """
         if wiki_searcher is None:
             wiki_searcher = self
 
+        profile = {
+            'stages': dict.fromkeys(SEARCH_STAGES, 0.0),
+            'max_distance': max_distance,
+            'pages_examined': 0,
+            'words_compared': 0,
+            'distance_computations': 0,
+            'cache_hits': 0,
+            'results': 0,
+        }
+        stages = profile['stages']
+
         if len(search_content) < 1:
-            return []
+            return ([], profile) if explain else []
 
+        start = time.perf_counter()
         search_words = search_content.lower().split()
 
         search_results = []
 
-        all_pages = wiki_searcher.get_all_page_names()
-
-        for page_title in all_pages:
+        if wiki_searcher is self and self.packed_pages:
+            #One listing gives every page's generation, which tells which
+            #packed copies are up to date
+            blobs = self.retrier.call(self._list_blobs)
+            all_pages = [blob.name for blob in blobs]
+            pages = self.packs.scan(blobs)
+        else:
+            all_pages = wiki_searcher.get_all_page_names()
+            pages = ((page_title, None) for page_title in all_pages)
+        #Pages come out of packs in pack order, ties are ranked in listing order
+        listing_order = {
+            page_title: i for i, page_title in enumerate(all_pages)
+        }
+        now = time.perf_counter()
+        stages['list'] += now - start
+
+        #Only a real backend has a page cache to count hits in
+        cache = getattr(wiki_searcher, 'page_cache', None)
+        if not (explain and isinstance(cache, LRUCache)):
+            cache = None
+
+        distance_computations = 0
+        for page_title, page_content in pages:
             title_match_counter = 0
             content_match_counter = 0
 
             close_title_match_counter = 0
             close_content_match_counter = 0
+            #Also counts the time spent reading a pack to get here
+            then = now
+            if page_content is None:
+                if cache is not None and page_title in cache:
+                    profile['cache_hits'] += 1
+                page_content = wiki_searcher.get_wiki_page(page_title)
+            else:
+                page_content = page_content.decode('utf-8', 'replace')
+            now = time.perf_counter()
+            stages['fetch'] += now - then
+
             title_words = page_title.lower().split()
-            page_content = wiki_searcher.get_wiki_page(page_title)
             page_words = page_content.lower().split()
+            then = now
+            now = time.perf_counter()
+            stages['tokenize'] += now - then
 
             for search_word in search_words:
 
                 for title_word in title_words:
                     if search_word == title_word:
                         title_match_counter += 1
-                    elif levenshtein_distance(search_word,
-                                              title_word) <= max_distance:
-                        close_title_match_counter += 1
+                    else:
+                        distance_computations += 1
+                        if levenshtein_distance(search_word,
+                                                title_word) <= max_distance:
+                            close_title_match_counter += 1
 
                 for page_word in page_words:
 
                     if search_word == page_word:
                         content_match_counter += 1
-                    elif levenshtein_distance(search_word,
-                                              page_word) <= max_distance:
-                        close_content_match_counter += 1
+                    else:
+                        distance_computations += 1
+                        if levenshtein_distance(search_word,
+                                                page_word) <= max_distance:
+                            close_content_match_counter += 1
 
             match_score = title_match_counter * 0.8 + content_match_counter * 0.1 + close_title_match_counter * 0.08 + close_content_match_counter * 0.02
 
             if match_score > 0:
                 search_results.append((page_title, match_score))
 
+            profile['pages_examined'] += 1
+            profile['words_compared'] += len(search_words) * (len(title_words) +
+                                                              len(page_words))
+            then = now
+            now = time.perf_counter()
+            stages['compare'] += now - then
+
         # Sort search_results by match score
-        search_results.sort(key=lambda x: x[1], reverse=True)
+        search_results.sort(key=lambda x: (-x[1], listing_order[x[0]]))
 
         # Extract page titles from search_results and return them
         page_titles = [result[0] for result in search_results]
-
-        return page_titles
\ No newline at end of file
+        stages['rank'] += time.perf_counter() - now
+
+        profile['distance_computations'] = distance_computations
+        profile['results'] = len(page_titles)
+        profile['total'] = sum(stages.values())
+
+        metrics.SEARCH_CANDIDATES.observe(len(all_pages))
+        metrics.SEARCH_RESULTS.observe(len(page_titles))
+
+        if explain:
+            return page_titles, profile
+        return page_titles
+
+
+def _lazy_properties(cls):
+    return [
+        name for name, value in vars(cls).items()
+        if isinstance(value, lazy_property)
+    ]
+
+
+def _size_of(data):
+    '''
+    Returns the size in bytes of a string once encoded, or of a seekable file object without reading it.
+    '''
+    if isinstance(data, str):
+        return len(data) if data.isascii() else len(data.encode('utf-8'))
+    if not hasattr(data, 'read'):
+        return len(data)
+    data.seek(0, io.SEEK_END)
+    size = data.tell()
+    data.seek(0)
+    return size
+
+
+def _pending_report_name(page):
+    '''
+    Returns a unique, time ordered name for a new report on a page.
+    '''
+    return (f"{PENDING_REPORTS_PREFIX}{page}/"
+            f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}")
+
+
+def _iter_chunks(blob, chunk_size):
+    '''
+    Yields the text of a blob chunk_size characters at a time.
+
+    The reader downloads the same amount per request, instead of its 40 MB default.
+    '''
+    with compression.open_text(blob, chunk_size) as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def _metadata_of(blob):
+    '''
+    Returns the page metadata kept alongside the content in a page record.
+    '''
+    return {
+        'author': _author_of(blob),
+        'generation': blob.generation,
+        'size': blob.size,
+        'updated': blob.updated,
+    }
+
+
+def _image_cache():
+    '''
+    Returns an empty image cache, bounded by entries and bytes, whose images expire like pages do.
+    '''
+    return LRUCache(max_entries=MAX_CACHED_IMAGES,
+                    ttl=IMAGE_CACHE_TTL,
+                    max_bytes=MAX_CACHED_IMAGE_BYTES)
+
+
+def _length_of(blob):
+    '''
+    Returns the length of a page's content before compression, or its stored size if it was written without one.
+    '''
+    try:
+        return int(blob.metadata['length'])
+    except (TypeError, KeyError, ValueError):
+        return blob.size or 0
+
+
+def _author_of(blob):
+    '''
+    Returns the author stored in a blob's metadata, or None if there is none.
+    '''
+    try:
+        return blob.metadata.get('author') or None
+    except AttributeError:
+        return None
@@ -1,9 +1,14 @@
-from flaskr.backend import Backend
+from flaskr.backend import Backend, RESUMABLE_UPLOAD_THRESHOLD, UPLOAD_CHUNK_SIZE
+from flaskr.history import HISTORY_BUCKET
+from flaskr.cache import CHANGELOG_BUCKET
+from flaskr.drivers import MemoryClient
 import unittest
 from unittest.mock import MagicMock
 from google.cloud import exceptions
 from unittest.mock import patch
 import pytest
+import io
+import os
 
 
 @pytest.fixture
@@ -79,6 +84,86 @@ def test_get_wiki_page_error(blob, bucket, storage_client, backend):
     assert result == "Network error: Network error"
 
 
+def test_get_page_record(blob, bucket, storage_client, backend):
+    """
+    Test that the content and metadata of a page come from a single blob fetch.
+    """
+    blob.open.return_value.__enter__.return_value.read.return_value = "content"
+    blob.metadata = {'author': 'Elei'}
+    blob.generation = 3
+
+    result = backend.get_page_record("test_wiki")
+
+    assert result['content'] == "content"
+    assert result['author'] == 'Elei'
+    assert result['generation'] == 3
+    assert bucket.get_blob.call_args.args == ("test_wiki",)
+    #The GCS library's own retries are off under the backend's retrier
+    assert bucket.get_blob.call_args.kwargs['retry'] is None
+    assert 0 < bucket.get_blob.call_args.kwargs['timeout'] <= 10
+
+
+def test_get_page_record_cached(blob, bucket, storage_client, backend):
+    """
+    Test that a second read of the same page is served from the page cache.
+    """
+    blob.open.return_value.__enter__.return_value.read.return_value = "content"
+
+    backend.get_page_record("test_wiki")
+    backend.get_page_record("test_wiki")
+
+    assert blob.open.call_count == 1
+
+
+def test_get_page_record_streams_big_pages(blob, bucket, storage_client,
+                                           backend):
+    """
+    Test that pages over the streaming size are read lazily in chunks and not cached.
+    """
+    #Stored gzipped, the page takes less than the streaming size
+    blob.size = 3
+    blob.metadata = {'author': 'Elei', 'length': '10'}
+    blob.open.return_value.__enter__.return_value.read.side_effect = [
+        "abc", "de", ""
+    ]
+
+    result = backend.get_page_record("big_page", stream_over=5)
+
+    assert 'content' not in result
+    blob.open.assert_not_called()
+    assert list(result['chunks']) == ["abc", "de"]
+    assert "big_page" not in backend.page_cache
+
+
+def test_iter_wiki_page(blob, bucket, storage_client, backend):
+    """
+    Test that a page can be read as an iterator of chunks.
+    """
+    blob.open.return_value.__enter__.return_value.read.side_effect = [
+        "abc", "de", ""
+    ]
+
+    result = backend.iter_wiki_page("test_wiki", chunk_size=3)
+
+    assert list(result) == ["abc", "de"]
+    blob.open.assert_called_with('r', chunk_size=3)
+
+
+def test_get_page_metadata(blob, bucket, storage_client, backend):
+    """
+    Test that page metadata is fetched without reading the page content.
+    """
+    blob.metadata = {'author': 'Elei'}
+    blob.generation = 3
+
+    result = backend.get_page_metadata("test_wiki")
+
+    assert result['author'] == 'Elei'
+    assert result['generation'] == 3
+    assert 'content' not in result
+    blob.open.assert_not_called()
+
+
 def test_get_all_page_names_success():
     """
     Test that getting all the wiki page names returns the expected list of names.
@@ -181,6 +266,71 @@ def test_upload_to_empty_database(blob, bucket, storage_client, backend):
     assert 'uploaded to Wiki.' in upload_result
 
 
+def test_upload_streams_file(blob, bucket, storage_client, backend):
+    '''
+    Test that file uploads are streamed instead of read into memory.
+    '''
+    storage_client.list_blobs.return_value = []
+    bucket.blob.return_value = blob
+    #The page's history is kept in a bucket of its own
+    storage_client.bucket.side_effect = lambda name: (MagicMock(
+    ) if name == HISTORY_BUCKET else bucket)
+    data = io.BytesIO(b'random stuff')
+
+    upload_result = backend.upload(data, 'mock_name', 'username')
+
+    assert 'uploaded to Wiki.' in upload_result
+    blob.upload_from_file.assert_called_once_with(data, size=12, rewind=True)
+    blob.upload_from_string.assert_not_called()
+
+
+def test_upload_large_file_is_resumable(blob, bucket, storage_client, backend):
+    '''
+    Test that files above the threshold are uploaded in chunks.
+    '''
+    storage_client.list_blobs.return_value = []
+    bucket.blob.return_value = blob
+    storage_client.bucket.side_effect = lambda name: (MagicMock(
+    ) if name == HISTORY_BUCKET else bucket)
+    #Random bytes don't shrink when compressed
+    data = io.BytesIO(os.urandom(RESUMABLE_UPLOAD_THRESHOLD + 1))
+
+    backend.upload(data, 'mock_name', 'username')
+
+    assert blob.chunk_size == UPLOAD_CHUNK_SIZE
+
+
+def test_upload_empty_file(blob, bucket, storage_client, backend):
+    '''
+    Test that an empty file is rejected without uploading anything.
+    '''
+    upload_result = backend.upload(io.BytesIO(b''), 'mock_name', 'username')
+    assert upload_result == 'Please upload a file.'
+
+
+def test_import_pages(blob, bucket, storage_client, backend):
+    '''
+    Test that imported pages are written without listing the bucket, and the changelog is bumped once.
+    '''
+    backend.changelog.bump = MagicMock()
+    backend.history.record = MagicMock()
+    bucket.blob.return_value = blob
+    blob.upload_from_string.side_effect = [None, exceptions.NotFound('404')]
+
+    result = backend.import_pages([('a', 'page a', 'Elei'), ('b', '', 'Elei'),
+                                   ('c', 'page c', 'Elei')],
+                                  workers=1)
+
+    assert result == {
+        'a': None,
+        'b': 'Page contents cannot be empty',
+        'c': 'Network Error: 404 404'
+    }
+    bucket.list_blobs.assert_not_called()
+    backend.changelog.bump.assert_called_once_with('a')
+    backend.history.record.assert_called_once_with('a', 'page a', 'Elei')
+
+
 def test_successful_sign_up(blob, bucket, storage_client, backend):
     '''
     Test that sign up is successful if it is a new user
@@ -253,6 +403,19 @@ def test_get_image_successful(blob, bucket, storage_client, backend):
     assert result == content
 
 
+#Testing that images are only downloaded once
+def test_get_image_record_cached(blob, bucket, storage_client, backend):
+    blob.content_type = 'image/jpeg'
+    blob.open.return_value.__enter__.return_value.read.return_value = b'img'
+
+    backend.get_image_record("Dimitri.jpg")
+    result = backend.get_image_record("Dimitri.jpg")
+
+    assert result['data'] == b'img'
+    assert result['content_type'] == 'image/jpeg'
+    assert blob.open.call_count == 1
+
+
 def test_check_page_author_exists(blob, bucket, storage_client, backend):
     """
     Test that the author name of a blob that exists and has an author metadata is correctly returned.
@@ -352,6 +515,92 @@ def test_report_when_page_is_in_database(blob, bucket, storage_client, backend):
     assert 'Your report was sent successfully.' in result
 
 
+def test_report_is_appended_as_new_object(blob, bucket, storage_client,
+                                          backend):
+    '''
+    Test that a report is written as its own object without reading the history.
+    '''
+    bucket.blob.return_value = blob
+
+    backend.report('testPage', 'Test message')
+
+    name = bucket.blob.call_args.args[0]
+    assert name.startswith('pending/testPage/')
+    blob.upload_from_string.assert_called_once_with('Test message\n',
+                                                    if_generation_match=0)
+    blob.open.assert_not_called()
+
+
+def test_compact_reports(blob, bucket, storage_client, backend):
+    '''
+    Test that pending reports are composed newest first on top of the history.
+    '''
+    older = MagicMock()
+    older.name = 'pending/testPage/00000000000000000001-aaaaaaaa'
+    newer = MagicMock()
+    newer.name = 'pending/testPage/00000000000000000002-bbbbbbbb'
+    storage_client.list_blobs.return_value = [newer, older]
+    history = blob
+    history.generation = 9
+    target = MagicMock()
+    bucket.blob.return_value = target
+
+    result = backend.compact_reports()
+
+    assert result == 2
+    target.compose.assert_called_once_with([newer, older, history],
+                                           if_generation_match=9)
+    bucket.blob.assert_called_with('reports/testPage')
+    older.delete.assert_called_once()
+    newer.delete.assert_called_once()
+
+
+def test_compact_reports_conflict(blob, bucket, storage_client, backend):
+    '''
+    Test that pending reports are kept when another compaction wins the race.
+    '''
+    pending = MagicMock()
+    pending.name = 'pending/testPage/00000000000000000001-aaaaaaaa'
+    storage_client.list_blobs.return_value = [pending]
+    bucket.blob.return_value.compose.side_effect = exceptions.PreconditionFailed(
+        'conflict')
+
+    assert backend.compact_reports() == 0
+    pending.delete.assert_not_called()
+
+
+def test_compact_reports_of_pages_named_like_pending():
+    '''
+    Test that the report blob of a page whose name looks like a pending report is never taken for one.
+    '''
+    backend = Backend(MemoryClient())
+    backend.report('pending/Ada', 'Needs sources')
+    assert backend.compact_reports() == 1
+
+    backend.report('Ada', 'Wrong dates')
+    assert backend.compact_reports() == 1
+
+    reports = backend.storage_client.bucket('sds_reports')
+    assert reports.get_blob(
+        'reports/pending/Ada').download_as_text() == 'Needs sources\n'
+    assert reports.get_blob('reports/Ada').download_as_text() == 'Wrong dates\n'
+
+
+def test_compact_reports_carries_on_legacy_blob():
+    '''
+    Test that reports merged under the page's own name are kept when it first moves under reports/.
+    '''
+    backend = Backend(MemoryClient())
+    reports = backend.storage_client.bucket('sds_reports')
+    reports.blob('Ada').upload_from_string('Old report\n')
+    backend.report('Ada', 'New report')
+
+    assert backend.compact_reports() == 1
+
+    assert reports.get_blob(
+        'reports/Ada').download_as_text() == 'New report\nOld report\n'
+
+
 #Testing that pages are properly being deleted
 def test_delete_page(blob, bucket, storage_client, backend):
     '''
@@ -381,7 +630,7 @@ def test_bookmark_successful(blob, bucket, storage_client, backend):
     #mocking
     content = "Test Page"
     blob.name = 'Dimitripl5'
-    blob.open.return_value.__enter__.return_value.read.return_value = content
+    blob.download_as_text.return_value = content
 
     #function call
     result = backend.bookmark('Hello World', 'Dimitripl5')
@@ -397,7 +646,7 @@ def test_bookmark_unsuccessful(blob, bucket, storage_client, backend):
     #mocking
     content = "Test Page"
     blob.name = 'Dimitripl5'
-    blob.open.return_value.__enter__.return_value.read.return_value = content
+    blob.download_as_text.return_value = content
 
     #function call
     result = backend.bookmark('Test Page', 'Dimitripl5')
@@ -406,14 +655,25 @@ def test_bookmark_unsuccessful(blob, bucket, storage_client, backend):
     assert result == False
 
 
+def test_is_bookmarked(blob, bucket, storage_client, backend):
+    '''
+    Test that a single page can be checked against a user's bookmarks.
+    '''
+    content = "Test Page\nHello World\n"
+    blob.download_as_text.return_value = content
+
+    assert backend.is_bookmarked('Dimitripl5', 'Hello World') == True
+    assert backend.is_bookmarked('Dimitripl5', 'Hello') == False
+
+
 def test_get_bookmarks(blob, bucket, storage_client, backend):
     '''
     Test that all VALID bookmarks are being returned
     '''
     #Mocking
-    content = ["Test Page\n"]
+    content = "Test Page\n"
     blob.name = 'Dimitripl5'
-    blob.open.return_value.__enter__.return_value.readlines.return_value = content
+    blob.download_as_text.return_value = content
 
     #function call
     result = backend.get_bookmarks("Dimitripl5", ['Test Page', 'Hello World'])
@@ -422,14 +682,57 @@ def test_get_bookmarks(blob, bucket, storage_client, backend):
     assert result == ['Test Page']
 
 
+def test_get_bookmarks_cleans_up_later(blob, bucket, storage_client, backend):
+    '''
+    Test that bookmarks of deleted pages are removed by a deferred task.
+    '''
+    blob.download_as_text.return_value = "Test Page\nDeleted Page\n"
+
+    result = backend.get_bookmarks("Dimitripl5", ['Test Page'])
+    backend.deferred.shutdown(wait=True)
+
+    assert result == ['Test Page']
+    assert backend.bookmarks.get("Dimitripl5") == ['Test Page']
+
+
+def test_get_bookmarks_listing_error(blob, bucket, storage_client, backend):
+    '''
+    Test that a failed page listing doesn't throw away every bookmark.
+    '''
+    blob.download_as_text.return_value = "Test Page\n"
+
+    result = backend.get_bookmarks("Dimitripl5", 'Error: Network error')
+    backend.deferred.shutdown(wait=True)
+
+    assert result == ['Test Page']
+    assert backend.bookmarks.get("Dimitripl5") == ['Test Page']
+
+
+def test_load_bookmarks_reads_once(blob, bucket, storage_client, backend):
+    '''
+    Test that bookmarks loaded ahead of get_bookmarks aren't read again.
+    '''
+    blob.download_as_text.return_value = "Test Page\nHello World\n"
+    changelog_bucket = MagicMock()
+    changelog_bucket.get_blob.return_value = None
+    storage_client.bucket.side_effect = lambda name: (
+        changelog_bucket if name == CHANGELOG_BUCKET else bucket)
+
+    assert backend.load_bookmarks("Dimitripl5") == 2
+    result = backend.get_bookmarks("Dimitripl5", ['Test Page', 'Hello World'])
+
+    assert result == ['Test Page', 'Hello World']
+    blob.download_as_text.assert_called_once()
+
+
 def test_remove_bookmark_successful(blob, bucket, storage_client, backend):
     '''
     Test that bookmarks are successfully being removed.
     '''
     #mocking
-    content = ["Test Page\n", "Expected"]
+    content = "Test Page\nExpected"
     blob.name = 'Dimitripl5'
-    blob.open.return_value.__enter__.return_value.readlines.return_value = content
+    blob.download_as_text.return_value = content
 
     #function call
     result = backend.remove_bookmark("Test Page", 'Dimitripl5')
@@ -443,9 +746,9 @@ def test_remove_bookmark_unsuccessful(blob, bucket, storage_client, backend):
     Test that error is returned when bookmark isn't properly removed
     '''
     #mocking
-    content = ["Test Page\n", "Expected"]
+    content = "Test Page\nExpected"
     blob.name = 'Dimitripl5'
-    blob.open.return_value.__enter__.return_value.readlines.return_value = content
+    blob.download_as_text.return_value = content
 
     #function call
     result = backend.remove_bookmark("random547865", 'randompl5')
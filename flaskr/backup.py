@@ -0,0 +1,273 @@
+'''
+Backup and restore of the whole wiki.
+
+A backup is a gzipped tar archive of every page under pages/, every user's
+bookmarks under bookmarks/ and every page's reports under reports/, stored
+as they are in their buckets. The author of a page is kept in a pax header
+of its member. User accounts and images are not backed up, and neither is
+page history (see history.py), whose revisions depend on object metadata
+an archive doesn't keep: every restored page is recorded as a new revision
+instead.
+
+The archive is written as a stream. Objects are downloaded by a pool of
+workers, a bounded number ahead of the one being written, and each is
+written out as soon as it arrives, so memory doesn't grow with the wiki.
+Restoring reads the archive once from start to end.
+
+Usage:
+    python -m flaskr.backup export wiki.tar.gz --driver gcs
+    python -m flaskr.backup restore wiki.tar.gz --driver gcs
+'''
+from .backend import Backend, IMPORT_WORKERS
+from .drivers import make_storage_client, STORAGE_DRIVERS
+from . import compression
+from .retry import request_options
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from google.cloud import exceptions
+import argparse
+import io
+import logging
+import sys
+import tarfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+#Constants
+
+#Folder of the archive -> bucket its objects come from, in the order they are archived
+SECTIONS = {
+    'pages': 'sdswiki_contents',
+    'bookmarks': 'sds_bookmarks',
+    'reports': 'sds_reports',
+}
+
+#Pax header holding the author of a page
+AUTHOR_HEADER = 'SDSWIKI.author'
+
+#How many objects are downloaded at the same time
+EXPORT_WORKERS = 8
+
+
+def iter_export(backend, workers=EXPORT_WORKERS):
+    '''
+    Yields a backup of the wiki as a gzipped tar archive, a piece at a time.
+
+    Args:
+        backend = The backend of the wiki
+        workers = How many objects are downloaded at the same time
+
+    Returns:
+        A generator of bytes, which joined together are the archive.
+    '''
+    #Bookmarks changed in this process may not have been written out yet
+    backend.bookmarks.flush()
+    out = _Spool()
+    with ThreadPoolExecutor(max_workers=workers,
+                            thread_name_prefix='export') as pool:
+        with tarfile.open(fileobj=out, mode='w|gz',
+                          format=tarfile.PAX_FORMAT) as tar:
+            for section, bucket_name in SECTIONS.items():
+                blobs = backend.retrier.call(_list_blobs, backend, bucket_name)
+                downloads = _ahead(pool, lambda blob: _download(backend, blob),
+                                   blobs, workers * 2)
+                for blob, data in downloads:
+                    if data is None:
+                        continue
+                    tar.addfile(_member(section, blob, len(data)),
+                                io.BytesIO(data))
+                    chunk = out.drain()
+                    if chunk:
+                        yield chunk
+        yield out.drain()
+
+
+def export(backend, path, workers=EXPORT_WORKERS):
+    '''
+    Writes a backup of the wiki to a file.
+
+    Returns:
+        The size of the backup in bytes.
+    '''
+    size = 0
+    with open(path, 'wb') as f:
+        for chunk in iter_export(backend, workers):
+            f.write(chunk)
+            size += len(chunk)
+    return size
+
+
+def restore(backend, path, workers=IMPORT_WORKERS):
+    '''
+    Writes every page, bookmark and report of a backup back to storage.
+
+    Objects already in storage are replaced by the ones in the backup, and
+    objects that aren't in the backup are left alone. Pages are written by
+    backend.import_pages, so the changelog is bumped once for all of them,
+    and bookmarks and reports by a pool of their own while pages are written.
+    Bookmarks are written through the bookmark store, whose changelog is
+    bumped once for every restored user at the end.
+
+    Args:
+        backend = The backend of the wiki
+        path = The backup archive
+        workers = How many objects are written at the same time
+
+    Returns:
+        A tuple of a dict from folder to how many objects were restored, and
+        a dict from member name to the reason it wasn't.
+    '''
+    failed = {}
+    uploads = {}
+    #Bounds how many objects sit in memory waiting for a worker
+    slots = threading.BoundedSemaphore(workers * 2)
+    with ThreadPoolExecutor(max_workers=workers,
+                            thread_name_prefix='restore') as pool:
+        with tarfile.open(path, 'r|*') as tar:
+
+            def pages():
+                for member in tar:
+                    if not member.isfile():
+                        continue
+                    section, _, name = member.name.partition('/')
+                    if section not in SECTIONS or not name:
+                        failed[member.name] = 'Not part of a backup'
+                        continue
+                    with tar.extractfile(member) as f:
+                        data = f.read()
+                    if section == 'pages':
+                        yield name, data, member.pax_headers.get(AUTHOR_HEADER)
+                        continue
+                    slots.acquire()
+                    if section == 'bookmarks':
+                        titles = data.decode('utf-8').splitlines()
+                        future = pool.submit(backend.retrier.call,
+                                             backend.bookmarks.replace, name,
+                                             titles)
+                    else:
+                        blob = backend.storage_client.bucket(
+                            SECTIONS[section]).blob(name)
+                        future = pool.submit(backend.retrier.call,
+                                             blob.upload_from_string, data)
+                    future.add_done_callback(lambda _: slots.release())
+                    uploads[member.name] = future
+
+            results = backend.import_pages(pages(), workers)
+
+    counts = dict.fromkeys(SECTIONS, 0)
+    for name, error in results.items():
+        if error is None:
+            counts['pages'] += 1
+        else:
+            failed[f'pages/{name}'] = error
+    users = []
+    for member_name, future in uploads.items():
+        error = future.exception()
+        section, _, name = member_name.partition('/')
+        if error is None:
+            counts[section] += 1
+            if section == 'bookmarks':
+                users.append(name)
+        else:
+            failed[member_name] = f'Network Error: {error}'
+    if users:
+        backend.bookmarks.announce(*users)
+    return counts, failed
+
+
+class _Spool:
+    '''
+    Write-only file that hands back what was written to it since it was last drained.
+    '''
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _ahead(pool, fn, items, window):
+    '''
+    Yields fn(item) for every item in order, running at most window of them ahead on the pool.
+    '''
+    pending = deque()
+    for item in items:
+        pending.append(pool.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _list_blobs(backend, bucket_name):
+    return list(
+        backend.storage_client.list_blobs(bucket_name, **request_options()))
+
+
+def _download(backend, blob):
+    '''
+    Returns a blob and its content, or None for the content if it was deleted since it was listed.
+    '''
+    try:
+        return blob, backend.retrier.call(compression.read_bytes, blob)
+    except exceptions.NotFound:
+        logger.info('Not backing up %s, it was deleted', blob.name)
+        return blob, None
+
+
+def _member(section, blob, size):
+    info = tarfile.TarInfo(f'{section}/{blob.name}')
+    info.size = size
+    info.mode = 0o644
+    if blob.updated is not None:
+        info.mtime = blob.updated.timestamp()
+    author = (blob.metadata or {}).get('author')
+    if author:
+        info.pax_headers = {AUTHOR_HEADER: author}
+    return info
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    commands = parser.add_subparsers(dest='command', required=True)
+    exporter = commands.add_parser('export', help='back up the wiki to a file')
+    exporter.add_argument('archive')
+    exporter.add_argument('--workers', type=int, default=EXPORT_WORKERS)
+    restorer = commands.add_parser('restore',
+                                   help='restore the wiki from a backup')
+    restorer.add_argument('archive')
+    restorer.add_argument('--workers', type=int, default=IMPORT_WORKERS)
+    for command in (exporter, restorer):
+        command.add_argument('--driver', choices=STORAGE_DRIVERS, default='gcs')
+        command.add_argument('--storage-root',
+                             help='directory of the local storage driver')
+    args = parser.parse_args(argv)
+
+    backend = Backend(
+        make_storage_client({
+            'STORAGE_DRIVER': args.driver,
+            'STORAGE_ROOT': args.storage_root
+        }))
+    if args.command == 'export':
+        size = export(backend, args.archive, args.workers)
+        print(f'Wrote {size} bytes to {args.archive}.')
+        return 0
+
+    counts, failed = restore(backend, args.archive, args.workers)
+    for name, error in sorted(failed.items()):
+        print(f'{name}: {error}', file=sys.stderr)
+    print(', '.join(f'{count} {section}' for section, count in counts.items()) +
+          f' restored, {len(failed)} failed.')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
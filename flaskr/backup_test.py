@@ -0,0 +1,137 @@
+from .backup import iter_export, export, restore, main, AUTHOR_HEADER
+from .backend import Backend
+from .drivers import MemoryClient, LocalClient
+from unittest.mock import MagicMock
+from google.cloud import exceptions
+import io
+import secrets
+import tarfile
+import pytest
+
+
+@pytest.fixture
+def backend():
+    backend = Backend(MemoryClient())
+    backend.upload('Wrote the first algorithm', 'Ada Lovelace', 'Elei')
+    backend.upload('Built the first compiler', 'Grace Hopper', 'Nasir')
+    backend.bookmark('Ada Lovelace', 'Dimitri')
+    backend.report('Grace Hopper', 'Spam')
+    return backend
+
+
+def read_archive(data):
+    with tarfile.open(fileobj=io.BytesIO(data), mode='r:gz') as tar:
+        return {
+            member.name: (tar.extractfile(member).read(),
+                          member.pax_headers.get(AUTHOR_HEADER))
+            for member in tar
+        }
+
+
+def test_export_streams_every_object(backend):
+    '''
+    Test that the backup holds pages with their authors, unflushed bookmarks and reports.
+    '''
+    big_page = secrets.token_hex(100_000)
+    backend.upload(big_page, 'Big', 'Elei')
+
+    chunks = list(iter_export(backend, workers=2))
+
+    archive = read_archive(b''.join(chunks))
+    #Written out as each object is archived, not all at the end
+    assert len(chunks) > 1
+    assert archive['pages/Big'] == (big_page.encode(), 'Elei')
+    assert archive['pages/Ada Lovelace'] == (b'Wrote the first algorithm',
+                                             'Elei')
+    assert archive['pages/Grace Hopper'] == (b'Built the first compiler',
+                                             'Nasir')
+    assert archive['bookmarks/Dimitri'] == (b'Ada Lovelace\n', None)
+    reports = [name for name in archive if name.startswith('reports/')]
+    assert len(reports) == 1
+    assert archive[reports[0]][0] == b'Spam\n'
+
+
+def test_export_skips_deleted_objects(backend):
+    '''
+    Test that an object deleted between listing and downloading is left out.
+    '''
+    blob = MagicMock()
+    blob.name = 'Gone'
+    blob.download_as_bytes.side_effect = exceptions.NotFound('404')
+    backend.storage_client.list_blobs = MagicMock(return_value=[blob])
+
+    archive = read_archive(b''.join(iter_export(backend)))
+
+    assert archive == {}
+
+
+def test_restore_round_trip(backend, tmp_path):
+    path = tmp_path / 'wiki.tar.gz'
+    export(backend, path)
+    restored = Backend(MemoryClient())
+    restored.changelog.bump = MagicMock()
+
+    counts, failed = restore(restored, path, workers=2)
+
+    assert (counts, failed) == ({'pages': 2, 'bookmarks': 1, 'reports': 1}, {})
+    assert restored.get_wiki_page('Ada Lovelace') == 'Wrote the first algorithm'
+    assert restored.check_page_author('Grace Hopper') == 'Nasir'
+    assert restored.bookmarks.get('Dimitri') == ['Ada Lovelace']
+    assert restored.compact_reports() == 1
+    restored.changelog.bump.assert_called_once_with('Ada Lovelace',
+                                                    'Grace Hopper')
+
+
+def test_restore_bookmarks_through_store(backend, tmp_path):
+    '''
+    Test that restored bookmarks replace pending changes and reach other instances through the changelog.
+    '''
+    path = tmp_path / 'wiki.tar.gz'
+    export(backend, path)
+    client = MemoryClient()
+    restored, other = Backend(client), Backend(client)
+    restored.bookmark('Grace Hopper', 'Dimitri')
+    #The other instance has read the changelog, and cached Dimitri's bookmarks
+    restored.bookmarks.announce('Elei')
+    assert other.bookmarks.get('Dimitri') == []
+    other.bookmarks.changelog.sync(other.bookmarks, force=True)
+
+    restore(restored, path, workers=2)
+    restored.bookmarks.flush()
+
+    assert restored.bookmarks.get('Dimitri') == ['Ada Lovelace']
+    assert other.bookmarks.changelog.sync(other.bookmarks,
+                                          force=True) == ['Dimitri']
+    assert other.bookmarks.get('Dimitri') == ['Ada Lovelace']
+
+
+def test_restore_reports_unknown_members(tmp_path):
+    path = tmp_path / 'other.tar'
+    with tarfile.open(path, 'w') as tar:
+        info = tarfile.TarInfo('notes/todo')
+        info.size = 4
+        tar.addfile(info, io.BytesIO(b'todo'))
+
+    counts, failed = restore(Backend(MemoryClient()), path)
+
+    assert counts == {'pages': 0, 'bookmarks': 0, 'reports': 0}
+    assert failed == {'notes/todo': 'Not part of a backup'}
+
+
+def test_main(backend, tmp_path, capsys):
+    source = tmp_path / 'source'
+    Backend(LocalClient(str(source))).upload('First programmer', 'Ada Lovelace',
+                                             'Elei')
+    path = str(tmp_path / 'wiki.tar.gz')
+    target = str(tmp_path / 'target')
+
+    assert main(
+        ['export', path, '--driver', 'local', '--storage-root',
+         str(source)]) == 0
+    assert main(
+        ['restore', path, '--driver', 'local', '--storage-root', target]) == 0
+
+    assert '1 pages, 0 bookmarks, 0 reports restored, 0 failed.' in \
+        capsys.readouterr().out
+    assert Backend(
+        LocalClient(target)).get_wiki_page('Ada Lovelace') == 'First programmer'
@@ -0,0 +1,322 @@
+from google.cloud import exceptions
+import atexit
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+#Constants
+
+#How many seconds bookmark changes wait in memory before they are written out
+FLUSH_INTERVAL = 5
+
+#How many seconds a user's unchanged bookmarks are trusted before being re-read,
+#in case a change made through another instance never reached the changelog
+CACHE_TTL = 60
+
+#Name of the changelog blob other instances learn of bookmark changes from
+BOOKMARKS_CHANGELOG = 'bookmarks'
+
+#How many times a user's bookmarks are re-read and rewritten when another
+#instance wrote them first
+FLUSH_ATTEMPTS = 5
+
+ADD = 'add'
+REMOVE = 'remove'
+
+
+class BookmarkStore:
+    '''
+    In-process, write-behind cache of every user's bookmarks.
+
+    Bookmarks are kept as an insertion ordered set per user, so adding,
+    removing and checking a bookmark are memory operations. Each change is
+    also kept as a pending operation until it is written back to the user's
+    sds_bookmarks blob by flush or flush_user. Once started, a background
+    thread flushes at most once per flush interval, and once more when the
+    store is closed or the process exits.
+
+    Writes only succeed if the blob is still at the generation it was read
+    at. If another process wrote it in between, the blob is read again, the
+    pending operations are replayed on it and the write is retried, so
+    neither process's changes are lost. With a changelog, other processes
+    are told which users changed so they drop their cached bookmarks.
+
+    Processes only hear of the changelog when they next poll it, so a user
+    who changed their bookmarks through one process can pass the generation
+    flush_user returned to require on any other, which reads them again if
+    its copy is older.
+    '''
+
+    def __init__(self,
+                 bucket,
+                 changelog=None,
+                 flush_interval=FLUSH_INTERVAL,
+                 cache_ttl=CACHE_TTL,
+                 clock=time.monotonic):
+        self.bucket = bucket
+        self.changelog = changelog
+        self.flush_interval = flush_interval
+        self.cache_ttl = cache_ttl
+        self.clock = clock
+        #user name -> (dict used as an ordered set of titles, generation read, time loaded)
+        self._users = {}
+        #user name -> list of (ADD or REMOVE, title) not written out yet, oldest first
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flusher = None
+        self._stopped = threading.Event()
+
+    def get(self, name):
+        '''
+        Returns the list of a user's bookmarks, oldest first.
+        '''
+        titles = self._titles(name)
+        with self._lock:
+            return list(titles)
+
+    def contains(self, name, title):
+        return title in self._titles(name)
+
+    def add(self, name, title):
+        '''
+        Bookmarks a page for a user.
+
+        Returns:
+            True if the bookmark was added, False if it already existed.
+        '''
+        titles = self._titles(name)
+        with self._lock:
+            if title in titles:
+                return False
+            titles[title] = None
+            self._changed(name, ADD, title)
+            return True
+
+    def remove(self, name, *titles):
+        '''
+        Removes bookmarks from a user.
+
+        Returns:
+            True if any of the bookmarks existed, False otherwise.
+        '''
+        bookmarks = self._titles(name)
+        with self._lock:
+            removed = False
+            for title in titles:
+                if title in bookmarks:
+                    del bookmarks[title]
+                    self._changed(name, REMOVE, title)
+                    removed = True
+            return removed
+
+    def flush(self):
+        '''
+        Writes every changed user's bookmarks back to storage.
+
+        Returns:
+            The number of users written.
+        '''
+        with self._lock:
+            names = list(self._pending)
+
+        written = []
+        for name in names:
+            try:
+                if self._flush_user(name) is not None:
+                    written.append(name)
+            except Exception as e:
+                logger.warning('Could not write bookmarks of %s: %s', name, e)
+        if written:
+            self.announce(*written)
+        return len(written)
+
+    def flush_user(self, name):
+        '''
+        Writes one user's changed bookmarks back to storage now, such as before answering the change.
+
+        Returns:
+            The generation the bookmarks were written at, or None if there was nothing to write.
+
+        Raises:
+            PreconditionFailed: If other processes kept writing them first.
+        '''
+        generation = self._flush_user(name)
+        if generation is not None:
+            self.announce(name)
+        return generation
+
+    def replace(self, name, titles):
+        '''
+        Overwrites a user's bookmarks, such as when restoring a backup.
+
+        Changes to them not written out yet are dropped. Call announce once
+        done, so other processes drop their copies.
+
+        Args:
+            name = The user name
+            titles = The titles of the bookmarks, oldest first
+        '''
+        with self._lock:
+            self._pending.pop(name, None)
+            self._users.pop(name, None)
+        self.bucket.blob(name).upload_from_string(_serialize(titles))
+
+    def announce(self, *names):
+        '''
+        Tells other processes through the changelog that users' bookmarks were written.
+        '''
+        if self.changelog is not None:
+            self.changelog.bump(*names)
+
+    def require(self, name, generation):
+        '''
+        Drops a user's cached bookmarks if they are older than a generation the user has written.
+        '''
+        with self._lock:
+            entry = self._users.get(name)
+            if entry is not None and entry[1] < generation:
+                del self._users[name]
+
+    def start(self):
+        '''
+        Starts flushing in a background thread, and once more when the process exits.
+        '''
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._stopped.clear()
+            self._flusher = threading.Thread(target=self._flush_forever,
+                                             name='bookmark-flusher',
+                                             daemon=True)
+            self._flusher.start()
+        atexit.register(self.close)
+
+    def close(self):
+        '''
+        Stops the background flusher, if started, and writes out what is pending.
+        '''
+        with self._lock:
+            flusher, self._flusher = self._flusher, None
+        if flusher is not None:
+            atexit.unregister(self.close)
+            self._stopped.set()
+            flusher.join()
+        self.flush()
+
+    def invalidate(self, name):
+        '''
+        Drops a user's cached bookmarks, so they are read again on next use.
+
+        Changes not written out yet are kept and replayed on what is read.
+        '''
+        with self._lock:
+            self._users.pop(name, None)
+
+    def clear(self):
+        '''
+        Drops every user's cached bookmarks, keeping changes not written out yet.
+        '''
+        with self._lock:
+            self._users.clear()
+
+    def _flush_user(self, name):
+        '''
+        Writes a user's bookmarks if the blob is still at the generation they were read at.
+
+        Returns:
+            The generation they were written at, or None if there was nothing to write.
+
+        Raises:
+            PreconditionFailed: If other processes kept writing them first.
+        '''
+        for _ in range(FLUSH_ATTEMPTS):
+            self._titles(name)
+            with self._lock:
+                entry = self._users.get(name)
+                operations = self._pending.get(name)
+                if not operations:
+                    return None
+                if entry is None:
+                    #Invalidated since it was loaded, load it again
+                    continue
+                titles, generation, _ = entry
+                count = len(operations)
+                data = _serialize(titles)
+
+            blob = self.bucket.blob(name)
+            try:
+                blob.upload_from_string(data, if_generation_match=generation)
+            except exceptions.PreconditionFailed:
+                #Another process wrote them since, read them again and replay ours
+                self.invalidate(name)
+                continue
+
+            with self._lock:
+                #Changes made while we were writing stay pending for the next flush
+                del self._pending[name][:count]
+                if not self._pending[name]:
+                    del self._pending[name]
+                if self._users.get(name) is entry:
+                    self._users[name] = (titles, blob.generation, self.clock())
+            return blob.generation
+        raise exceptions.PreconditionFailed(
+            f'Bookmarks of {name} kept changing while being written')
+
+    def _titles(self, name):
+        '''
+        Returns the cached ordered set of a user's bookmarks, reading it from
+        storage if it isn't cached or has expired, with pending changes
+        replayed on it. The read is done without holding the lock, so one
+        slow user doesn't hold up the others.
+        '''
+        if self.changelog is not None:
+            self.changelog.sync(self)
+        with self._lock:
+            entry = self._fresh(name)
+        if entry is not None:
+            return entry
+
+        blob = self.bucket.get_blob(name)
+        titles = {}
+        generation = 0
+        if blob is not None:
+            titles = dict.fromkeys(blob.download_as_text().splitlines())
+            generation = blob.generation
+
+        with self._lock:
+            #Another thread may have loaded them in the meantime
+            entry = self._fresh(name)
+            if entry is not None:
+                return entry
+            for operation, title in self._pending.get(name, ()):
+                if operation == ADD:
+                    titles[title] = None
+                else:
+                    titles.pop(title, None)
+            self._users[name] = (titles, generation, self.clock())
+            return titles
+
+    def _fresh(self, name):
+        entry = self._users.get(name)
+        #Users with pending changes are only re-read when invalidated, since
+        #what is cached is the base the changes were made against
+        if entry is not None and (name in self._pending or
+                                  self.clock() - entry[2] < self.cache_ttl):
+            return entry[0]
+        return None
+
+    def _changed(self, name, operation, title):
+        self._pending.setdefault(name, []).append((operation, title))
+
+    def _flush_forever(self):
+        while not self._stopped.wait(self.flush_interval):
+            self.flush()
+
+
+def _serialize(titles):
+    '''
+    Formats bookmarks the way they are stored, one title per line.
+    '''
+    return ''.join(title + '\n' for title in titles)
@@ -0,0 +1,167 @@
+from .bookmarks import BookmarkStore
+from .backend import Backend
+from .drivers import MemoryClient
+from google.cloud import exceptions
+from unittest.mock import MagicMock
+import pytest
+import threading
+
+
+@pytest.fixture
+def blob():
+    mock_blob = MagicMock()
+    mock_blob.download_as_text.return_value = "Test Page\nHello World\n"
+    mock_blob.generation = 1
+    return mock_blob
+
+
+@pytest.fixture
+def bucket(blob):
+    mock_bucket = MagicMock()
+    mock_bucket.get_blob.return_value = blob
+    mock_bucket.blob.return_value = blob
+    return mock_bucket
+
+
+@pytest.fixture
+def now():
+    return [0]
+
+
+@pytest.fixture
+def store(bucket, now):
+    return BookmarkStore(bucket, flush_interval=3600, clock=lambda: now[0])
+
+
+def test_bookmarks_are_read_once(blob, bucket, store):
+    '''
+    Test that a user's bookmarks are only downloaded once while cached.
+    '''
+    assert store.get('Dimitripl5') == ['Test Page', 'Hello World']
+    assert store.contains('Dimitripl5', 'Hello World')
+    assert not store.contains('Dimitripl5', 'Sucks')
+    assert blob.download_as_text.call_count == 1
+
+
+def test_changes_are_written_behind(blob, bucket, store):
+    '''
+    Test that bookmark changes are only written to storage on flush, once per user.
+    '''
+    assert store.add('Dimitripl5', 'New Page') == True
+    assert store.add('Dimitripl5', 'New Page') == False
+    assert store.remove('Dimitripl5', 'Test Page') == True
+    blob.upload_from_string.assert_not_called()
+
+    assert store.flush() == 1
+    blob.upload_from_string.assert_called_once_with("Hello World\nNew Page\n",
+                                                    if_generation_match=1)
+    assert store.flush() == 0
+
+
+def test_failed_flush_is_retried(blob, bucket, store):
+    '''
+    Test that users whose bookmarks could not be written stay dirty.
+    '''
+    store.add('Dimitripl5', 'New Page')
+    blob.upload_from_string.side_effect = Exception('Network error')
+    assert store.flush() == 0
+
+    blob.upload_from_string.side_effect = None
+    assert store.flush() == 1
+
+
+def test_clean_bookmarks_expire(blob, bucket, store, now):
+    '''
+    Test that unchanged bookmarks are re-read after the cache TTL, but dirty ones are not.
+    '''
+    store.get('Dimitripl5')
+    now[0] = 1000
+    store.get('Dimitripl5')
+    assert blob.download_as_text.call_count == 2
+
+    store.add('Dimitripl5', 'New Page')
+    now[0] = 2000
+    assert 'New Page' in store.get('Dimitripl5')
+    assert blob.download_as_text.call_count == 2
+
+
+def test_new_user_has_no_bookmarks(bucket, store):
+    bucket.get_blob.return_value = None
+    assert store.get('randompl5') == []
+    assert store.remove('randompl5', 'Test Page') == False
+
+
+def test_flush_replays_changes_on_newer_bookmarks(blob, bucket, store):
+    '''
+    Test that a flush that loses a race re-reads the bookmarks and replays its changes on them.
+    '''
+    store.add('Dimitripl5', 'New Page')
+    store.remove('Dimitripl5', 'Test Page')
+    newer = MagicMock()
+    newer.generation = 2
+    newer.download_as_text.return_value = "Test Page\nHello World\nOther Page\n"
+    bucket.get_blob.return_value = newer
+    blob.upload_from_string.side_effect = [
+        exceptions.PreconditionFailed('412'), None
+    ]
+
+    assert store.flush() == 1
+
+    assert blob.upload_from_string.call_args.args == (
+        "Hello World\nOther Page\nNew Page\n",)
+    assert blob.upload_from_string.call_args.kwargs == {
+        'if_generation_match': 2
+    }
+    assert store.get('Dimitripl5') == ['Hello World', 'Other Page', 'New Page']
+
+
+def test_instances_do_not_lose_each_others_bookmarks():
+    '''
+    Test that two backends sharing storage both keep their bookmarks, whichever flushes last.
+    '''
+    client = MemoryClient()
+    first, second = Backend(client), Backend(client)
+    assert first.get_bookmarks('Elei', ['p1', 'p2']) == []
+    assert second.get_bookmarks('Elei', ['p1', 'p2']) == []
+
+    first.bookmark('p1', 'Elei')
+    first.bookmarks.flush()
+    second.bookmark('p2', 'Elei')
+    second.bookmarks.flush()
+
+    third = Backend(client)
+    assert third.bookmarks.get('Elei') == ['p1', 'p2']
+    #The changelog tells the first backend its cached bookmarks are stale
+    first.bookmarks.changelog.sync(first.bookmarks, force=True)
+    assert first.is_bookmarked('Elei', 'p2')
+
+
+def test_saved_bookmarks_are_required_elsewhere():
+    '''
+    Test that a process whose copy is older than what a user saved reads their bookmarks again.
+    '''
+    client = MemoryClient()
+    first, second = Backend(client), Backend(client)
+    assert not second.is_bookmarked('Elei', 'p1')
+
+    first.bookmark('p1', 'Elei')
+    generation = first.save_bookmarks('Elei')
+
+    assert generation is not None
+    assert not second.is_bookmarked('Elei', 'p1')
+    second.require_bookmarks('Elei', generation)
+    assert second.is_bookmarked('Elei', 'p1')
+    assert first.save_bookmarks('Elei') is None
+
+
+def test_close_stops_flusher_and_flushes(blob, bucket, store):
+    store.start()
+    store.add('Dimitripl5', 'New Page')
+
+    store.close()
+
+    assert store._flusher is None
+    assert blob.upload_from_string.call_args.args == (
+        "Test Page\nHello World\nNew Page\n",)
+    assert not any(
+        thread.name == 'bookmark-flusher' for thread in threading.enumerate())
@@ -0,0 +1,285 @@
+'''
+Bulk import of wiki pages.
+
+Imports a directory, tar archive (optionally compressed) or zip archive of
+pages. A manifest.json at its root can name each page and its author:
+
+    {"pages": [{"path": "ada.txt", "title": "Ada Lovelace", "author": "Elei"}]}
+
+Without one, every file is a page named after the file without its
+extension, written by --author. Every page name is checked before anything
+is written, and nothing is written if any of them is invalid.
+
+Usage:
+    python -m flaskr.bulk import pages.tar.gz --author Elei --driver gcs
+'''
+from .backend import Backend, IMPORT_WORKERS
+from .drivers import make_storage_client, STORAGE_DRIVERS
+import argparse
+import json
+import os
+import posixpath
+import sys
+import tarfile
+import zipfile
+
+#Constants
+
+#Name of the file listing the pages of an archive and their authors
+MANIFEST_NAME = 'manifest.json'
+
+#Extensions dropped from file names to make page names
+PAGE_EXTENSIONS = ('.txt', '.md', '.html')
+
+#Longest page name Cloud Storage accepts, in UTF-8 bytes
+MAX_NAME_BYTES = 1024
+
+
+class DirectorySource:
+    '''
+    Pages stored as files under a directory.
+    '''
+
+    def __init__(self, root):
+        self.root = root
+
+    def paths(self):
+        '''
+        Returns the path of every file, relative to the root and separated by /.
+        '''
+        paths = []
+        for folder, _, files in os.walk(self.root):
+            for name in files:
+                path = os.path.relpath(os.path.join(folder, name), self.root)
+                paths.append(path.replace(os.sep, '/'))
+        return sorted(paths)
+
+    def read(self, path):
+        with open(os.path.join(self.root, *path.split('/')), 'rb') as f:
+            return f.read()
+
+    def close(self):
+        pass
+
+
+class TarSource:
+    '''
+    Pages stored in a tar archive, compressed or not.
+
+    Reading members in archive order never seeks backwards, which would
+    decompress a compressed archive again from the start.
+    '''
+
+    def __init__(self, path):
+        self.tar = tarfile.open(path, 'r:*')
+        self.members = {
+            member.name: member
+            for member in self.tar.getmembers()
+            if member.isfile()
+        }
+
+    def paths(self):
+        return list(self.members)
+
+    def read(self, path):
+        with self.tar.extractfile(self.members[path]) as f:
+            return f.read()
+
+    def close(self):
+        self.tar.close()
+
+
+class ZipSource:
+    '''
+    Pages stored in a zip archive.
+    '''
+
+    def __init__(self, path):
+        self.zip = zipfile.ZipFile(path)
+
+    def paths(self):
+        return [name for name in self.zip.namelist() if not name.endswith('/')]
+
+    def read(self, path):
+        return self.zip.read(path)
+
+    def close(self):
+        self.zip.close()
+
+
+def open_source(path):
+    '''
+    Opens a directory, zip or tar archive of pages.
+
+    Raises:
+        ValueError: If path is none of those.
+    '''
+    if os.path.isdir(path):
+        return DirectorySource(path)
+    if zipfile.is_zipfile(path):
+        return ZipSource(path)
+    if tarfile.is_tarfile(path):
+        return TarSource(path)
+    raise ValueError(f'{path} is not a directory, zip or tar archive')
+
+
+def read_manifest(source, author):
+    '''
+    Lists the pages of a source from its manifest, or from its files if it has none.
+
+    Args:
+        source = The opened directory or archive
+        author = Author of pages the manifest doesn't give one for
+
+    Returns:
+        A list of dicts with each page's path, title and author, in the order
+        their files are stored.
+    '''
+    paths = source.paths()
+    if MANIFEST_NAME not in paths:
+        return [{
+            'path': path,
+            'title': page_title(path),
+            'author': author
+        } for path in paths]
+
+    manifest = json.loads(source.read(MANIFEST_NAME))
+    entries = [{
+        'path': page['path'],
+        'title': page.get('title', page_title(page['path'])),
+        'author': page.get('author', author),
+    } for page in manifest['pages']]
+    order = {path: i for i, path in enumerate(paths)}
+    return sorted(entries, key=lambda entry: order.get(entry['path'], -1))
+
+
+def page_title(path):
+    '''
+    Returns the page name of a file: its name without its extension.
+    '''
+    name = posixpath.basename(path)
+    stem, extension = posixpath.splitext(name)
+    return stem if extension.lower() in PAGE_EXTENSIONS else name
+
+
+def validate(entries, paths, existing_pages, override=False):
+    '''
+    Checks every page of an import against each other and the wiki, before anything is written.
+
+    Args:
+        entries = The pages from read_manifest
+        paths = The paths of the files in the source
+        existing_pages = Names of the pages already in the wiki
+        override = Whether existing pages may be replaced
+
+    Returns:
+        A list of (page name, problem) tuples, empty if the import can go ahead.
+    '''
+    problems = []
+    paths = set(paths)
+    existing_pages = set(existing_pages)
+    seen = set()
+    for entry in entries:
+        title = entry['title']
+        if not title or title in ('.', '..'):
+            problems.append((title, 'Page names cannot be empty, "." or ".."'))
+        elif len(title.encode('utf-8')) > MAX_NAME_BYTES:
+            problems.append(
+                (title, f'Page names are at most {MAX_NAME_BYTES} bytes'))
+        elif '\n' in title or '\r' in title:
+            problems.append((title, 'Page names cannot contain line breaks'))
+        elif title in seen:
+            problems.append((title, 'Page name is used more than once'))
+        elif title in existing_pages and not override:
+            problems.append((title, 'Page already exists'))
+        if entry['path'] not in paths:
+            problems.append((title, f"File {entry['path']} is missing"))
+        if not entry['author']:
+            problems.append((title, 'Page has no author'))
+        seen.add(title)
+    return problems
+
+
+def import_pages(backend,
+                 path,
+                 author=None,
+                 override=False,
+                 workers=IMPORT_WORKERS):
+    '''
+    Imports a directory or archive of pages into the wiki.
+
+    The wiki is listed once to check the page names against, then pages are
+    read in the order they are stored and written by backend.import_pages.
+
+    Returns:
+        A tuple of the problems found by validate, and a dict from page name
+        to None if it was written or the reason it wasn't. Nothing is written
+        if there are problems.
+    '''
+    source = open_source(path)
+    try:
+        entries = read_manifest(source, author)
+        existing_pages = backend.get_all_page_names()
+        if isinstance(existing_pages, str):
+            #An empty bucket is reported as an error message too
+            if existing_pages != 'Error: No pages found in bucket.':
+                return [('', existing_pages)], {}
+            existing_pages = []
+        problems = validate(entries, source.paths(), existing_pages, override)
+        if problems:
+            return problems, {}
+
+        undecodable = {}
+
+        def pages():
+            for entry in entries:
+                try:
+                    content = source.read(entry['path']).decode('utf-8')
+                except UnicodeDecodeError:
+                    undecodable[entry['title']] = 'Page is not UTF-8 text'
+                    continue
+                yield entry['title'], content, entry['author']
+
+        results = backend.import_pages(pages(), workers)
+        results.update(undecodable)
+        return [], results
+    finally:
+        source.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    commands = parser.add_subparsers(dest='command', required=True)
+    importer = commands.add_parser(
+        'import', help='import a directory or archive of pages')
+    importer.add_argument('source')
+    importer.add_argument('--author',
+                          help='author of pages the manifest gives none for')
+    importer.add_argument('--override',
+                          action='store_true',
+                          help='replace pages that already exist')
+    importer.add_argument('--workers', type=int, default=IMPORT_WORKERS)
+    importer.add_argument('--driver', choices=STORAGE_DRIVERS, default='gcs')
+    importer.add_argument('--storage-root',
+                          help='directory of the local storage driver')
+    args = parser.parse_args(argv)
+
+    backend = Backend(
+        make_storage_client({
+            'STORAGE_DRIVER': args.driver,
+            'STORAGE_ROOT': args.storage_root
+        }))
+    problems, results = import_pages(backend, args.source, args.author,
+                                     args.override, args.workers)
+    for title, problem in problems:
+        print(f'{title}: {problem}', file=sys.stderr)
+    failed = {title: error for title, error in results.items() if error}
+    for title, error in sorted(failed.items()):
+        print(f'{title}: {error}', file=sys.stderr)
+    print(f'Imported {len(results) - len(failed)} pages, '
+          f'{len(failed)} failed, {len(problems)} problems found.')
+    return 1 if problems or failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
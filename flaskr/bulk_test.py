@@ -0,0 +1,170 @@
+from .bulk import import_pages, validate, page_title, main
+from .backend import Backend
+from .drivers import MemoryClient, LocalClient
+from unittest.mock import MagicMock
+import io
+import json
+import tarfile
+import zipfile
+import pytest
+
+PAGES = {
+    'Ada Lovelace': 'Wrote the first algorithm',
+    'Grace Hopper': 'Built the first compiler',
+}
+
+
+@pytest.fixture
+def backend():
+    backend = Backend(MemoryClient())
+    backend.changelog.bump = MagicMock()
+    return backend
+
+
+@pytest.fixture
+def page_dir(tmp_path):
+    root = tmp_path / 'pages'
+    (root / 'people').mkdir(parents=True)
+    for title, content in PAGES.items():
+        (root / 'people' / f'{title}.txt').write_text(content)
+    return root
+
+
+def make_tar(path, files):
+    with tarfile.open(path, 'w:gz') as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return path
+
+
+def test_page_title():
+    assert page_title('people/Ada Lovelace.txt') == 'Ada Lovelace'
+    assert page_title('C.S. Lewis') == 'C.S. Lewis'
+
+
+def test_import_directory(backend, page_dir):
+    '''
+    Test that every file is imported and the changelog is bumped once.
+    '''
+    problems, results = import_pages(backend, str(page_dir), 'Elei')
+
+    assert problems == []
+    assert results == {'Ada Lovelace': None, 'Grace Hopper': None}
+    assert backend.get_wiki_page('Grace Hopper') == 'Built the first compiler'
+    assert backend.check_page_author('Ada Lovelace') == 'Elei'
+    backend.changelog.bump.assert_called_once_with('Ada Lovelace',
+                                                   'Grace Hopper')
+
+
+def test_import_tar_with_manifest(backend, tmp_path):
+    manifest = {
+        'pages': [
+            {
+                'path': 'a.txt',
+                'title': 'Ada Lovelace',
+                'author': 'Nasir'
+            },
+            {
+                'path': 'g.txt',
+                'title': 'Grace Hopper'
+            },
+        ]
+    }
+    archive = make_tar(
+        tmp_path / 'pages.tar.gz', {
+            'manifest.json': json.dumps(manifest).encode(),
+            'a.txt': b'Wrote the first algorithm',
+            'g.txt': b'Built the first compiler',
+        })
+
+    problems, results = import_pages(backend, str(archive), 'Elei')
+
+    assert problems == []
+    assert results == {'Ada Lovelace': None, 'Grace Hopper': None}
+    assert backend.check_page_author('Ada Lovelace') == 'Nasir'
+    assert backend.check_page_author('Grace Hopper') == 'Elei'
+
+
+def test_import_zip(backend, tmp_path):
+    archive = tmp_path / 'pages.zip'
+    with zipfile.ZipFile(archive, 'w') as z:
+        z.writestr('Ada Lovelace.md', 'Wrote the first algorithm')
+        z.writestr('empty.txt', '')
+        z.writestr('binary.txt', b'\xff\xfe')
+
+    problems, results = import_pages(backend, str(archive), 'Elei')
+
+    assert problems == []
+    assert results == {
+        'Ada Lovelace': None,
+        'empty': 'Page contents cannot be empty',
+        'binary': 'Page is not UTF-8 text',
+    }
+    assert backend.get_all_page_names() == ['Ada Lovelace']
+
+
+def test_import_writes_nothing_when_invalid(backend, page_dir):
+    backend.upload('Old', 'Ada Lovelace', 'Dimitri')
+
+    problems, results = import_pages(backend, str(page_dir), 'Elei')
+
+    assert problems == [('Ada Lovelace', 'Page already exists')]
+    assert results == {}
+    assert backend.get_wiki_page('Grace Hopper').startswith('Error')
+
+    problems, results = import_pages(backend,
+                                     str(page_dir),
+                                     'Elei',
+                                     override=True)
+    assert problems == []
+    assert backend.get_wiki_page('Ada Lovelace') == 'Wrote the first algorithm'
+
+
+def test_validate():
+    entries = [
+        {
+            'path': 'a',
+            'title': 'Ada',
+            'author': 'Elei'
+        },
+        {
+            'path': 'b',
+            'title': 'Ada',
+            'author': 'Elei'
+        },
+        {
+            'path': 'c',
+            'title': '',
+            'author': 'Elei'
+        },
+        {
+            'path': 'x',
+            'title': 'Line\nbreak',
+            'author': None
+        },
+    ]
+
+    assert validate(entries, ['a', 'b', 'c'], []) == [
+        ('Ada', 'Page name is used more than once'),
+        ('', 'Page names cannot be empty, "." or ".."'),
+        ('Line\nbreak', 'Page names cannot contain line breaks'),
+        ('Line\nbreak', 'File x is missing'),
+        ('Line\nbreak', 'Page has no author'),
+    ]
+
+
+def test_main(page_dir, tmp_path, capsys):
+    root = tmp_path / 'storage'
+
+    assert main([
+        'import',
+        str(page_dir), '--author', 'Elei', '--driver', 'local',
+        '--storage-root',
+        str(root)
+    ]) == 0
+
+    assert 'Imported 2 pages, 0 failed' in capsys.readouterr().out
+    assert Backend(LocalClient(
+        str(root))).get_all_page_names() == ['Ada Lovelace', 'Grace Hopper']
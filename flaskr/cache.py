@@ -0,0 +1,286 @@
+from collections import OrderedDict
+from google.cloud import exceptions
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+#Constants
+
+#Bucket and blob holding the shared page changelog
+CHANGELOG_BUCKET = 'sds_changelog'
+CHANGELOG_BLOB = 'pages'
+
+#How many changes the changelog remembers before older ones are dropped
+MAX_CHANGES = 500
+
+#How many seconds an instance waits between changelog polls
+POLL_INTERVAL = 5
+
+#How many times a changelog bump is retried when another instance wins the race
+BUMP_ATTEMPTS = 5
+
+#How many pages each instance keeps in memory
+MAX_CACHED_PAGES = 256
+
+#How many images each instance keeps in memory
+MAX_CACHED_IMAGES = 32
+
+#How many bytes of images each instance keeps in memory at most, bigger
+#images aren't cached at all
+MAX_CACHED_IMAGE_BYTES = 16 * 1024 * 1024
+
+#How many seconds a cached page is served for at most, in case a changelog
+#bump was lost and the page's change never reached this instance
+PAGE_CACHE_TTL = 300
+
+#How many seconds a cached image is served for at most, so a replaced image is
+#picked up, since image changes don't go through the changelog
+IMAGE_CACHE_TTL = 300
+
+
+class LRUCache:
+    '''
+    Thread safe in-process LRU cache, used for page records and images.
+
+    Args:
+        max_entries = How many entries are kept before the least recently used is evicted
+        ttl = If given, entries are dropped this many seconds after they were put
+        max_bytes = If given, least recently used entries are evicted while the
+            sizes given to put add up to more, and bigger values aren't cached
+        clock = Returns the current time in seconds, for ttl
+    '''
+
+    def __init__(self,
+                 max_entries=MAX_CACHED_PAGES,
+                 ttl=None,
+                 max_bytes=None,
+                 clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.clock = clock
+        #key -> (time it expires at or None, value, size)
+        self._entries = OrderedDict()
+        #Sum of the sizes of the entries
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key):
+        '''
+        Returns the cached value for key, or None if it is not cached.
+        '''
+        with self._lock:
+            if not self._fresh(key):
+                self._misses += 1
+                return None
+            self._hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][1]
+
+    def stats(self):
+        '''
+        Returns how many lookups were hits and how many were misses, as a tuple.
+        '''
+        with self._lock:
+            return self._hits, self._misses
+
+    def put(self, key, value, size=0):
+        '''
+        Caches value under key, evicting the least recently used entries if full.
+
+        Args:
+            size = How many bytes value takes, counted against max_bytes
+        '''
+        expires = None if self.ttl is None else self.clock() + self.ttl
+        with self._lock:
+            self._drop(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._entries[key] = (expires, value, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or (
+                    self.max_bytes is not None and
+                    self._bytes > self.max_bytes):
+                self._bytes -= self._entries.popitem(last=False)[1][2]
+
+    def invalidate(self, key):
+        '''
+        Drops key from the cache if present.
+        '''
+        with self._lock:
+            self._drop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._fresh(key)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def _fresh(self, key):
+        '''
+        Returns whether key is cached and not expired, dropping it if it expired. Call with the lock held.
+        '''
+        if key not in self._entries:
+            return False
+        expires = self._entries[key][0]
+        if expires is not None and self.clock() >= expires:
+            self._drop(key)
+            return False
+        return True
+
+    def _drop(self, key):
+        '''
+        Removes key if present. Call with the lock held.
+        '''
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+
+class ChangeLog:
+    '''
+    Keeps the page caches of every instance coherent through a small shared blob.
+
+    The blob is a JSON document holding a sequence number and the most recent
+    (sequence, page name) changes. Writers bump it after changing a page and
+    readers poll it with a conditional GET, so an unchanged changelog costs a
+    single 304 response, and only the changed pages are dropped from the cache.
+
+    Other caches shared between instances, like bookmarks, keep their own
+    changelog in a blob of another name. Anything with invalidate and clear
+    methods can be synced.
+    '''
+
+    def __init__(self,
+                 bucket,
+                 blob_name=CHANGELOG_BLOB,
+                 poll_interval=POLL_INTERVAL,
+                 max_changes=MAX_CHANGES,
+                 clock=time.monotonic):
+        self.bucket = bucket
+        self.blob_name = blob_name
+        self.poll_interval = poll_interval
+        self.max_changes = max_changes
+        self.clock = clock
+        #Last sequence number this instance has applied
+        self.seq = None
+        #Generation of the changelog blob last read, used for conditional GETs
+        self.blob_generation = None
+        self.last_poll = None
+        self._lock = threading.Lock()
+
+    def bump(self, *names):
+        '''
+        Records that pages changed so other instances drop them from their caches.
+
+        Many pages changed together, like by an import, are recorded with a
+        single write of the changelog.
+
+        Args:
+            names = The names of the pages that were changed
+
+        Returns:
+            The new sequence number, or None if the changelog could not be updated.
+        '''
+        for _ in range(BUMP_ATTEMPTS):
+            try:
+                blob = self.bucket.get_blob(self.blob_name)
+                if blob is None:
+                    state = {'seq': 0, 'changes': []}
+                    generation = 0
+                else:
+                    state = json.loads(blob.download_as_text())
+                    generation = blob.generation
+
+                for name in names:
+                    state['seq'] += 1
+                    state['changes'].append([state['seq'], name])
+                del state['changes'][:-self.max_changes]
+
+                #Only succeeds if nobody else wrote the changelog in between
+                self.bucket.blob(self.blob_name).upload_from_string(
+                    json.dumps(state),
+                    content_type='application/json',
+                    if_generation_match=generation)
+                return state['seq']
+            except exceptions.PreconditionFailed:
+                continue
+            except Exception as e:
+                logger.warning('Could not bump %s changelog: %s',
+                               self.blob_name, e)
+                return None
+        logger.warning('Gave up bumping %s changelog for %s', self.blob_name,
+                       ', '.join(names))
+        return None
+
+    def sync(self, cache, force=False):
+        '''
+        Polls the changelog and invalidates the pages that changed since the last poll.
+
+        Polls at most once every poll_interval seconds unless force is set, and
+        skips the poll if another thread is already doing it.
+
+        Args:
+            cache = The cache to invalidate, like the LRUCache of pages
+            force = Poll even if the poll interval has not passed
+
+        Returns:
+            The list of page names that were invalidated. If changes were missed
+            (first poll, or older than the changelog keeps) the whole cache is
+            cleared instead and an empty list is returned.
+        '''
+        now = self.clock()
+        if not force and self.last_poll is not None and now - self.last_poll < self.poll_interval:
+            return []
+        if not self._lock.acquire(blocking=False):
+            return []
+        try:
+            self.last_poll = now
+            return self._apply(cache)
+        except Exception as e:
+            logger.warning('Could not poll %s changelog: %s', self.blob_name, e)
+            return []
+        finally:
+            self._lock.release()
+
+    def _apply(self, cache):
+        try:
+            blob = self.bucket.get_blob(
+                self.blob_name, if_generation_not_match=self.blob_generation)
+        except exceptions.NotModified:
+            return []
+        if blob is None:
+            return []
+
+        state = json.loads(blob.download_as_text())
+        self.blob_generation = blob.generation
+        previous, self.seq = self.seq, state['seq']
+
+        #First poll: anything cached so far may predate the changelog
+        if previous is None:
+            cache.clear()
+            return []
+
+        changes = state['changes']
+        #We missed changes that have already been dropped from the log
+        if previous < state['seq'] and (not changes or
+                                        changes[0][0] > previous + 1):
+            cache.clear()
+            return []
+
+        changed = [name for seq, name in changes if seq > previous]
+        for name in changed:
+            cache.invalidate(name)
+        return changed
@@ -0,0 +1,188 @@
+from .cache import LRUCache, ChangeLog
+from unittest.mock import MagicMock
+from google.cloud import exceptions
+import json
+import pytest
+
+
+@pytest.fixture
+def blob():
+    mock_blob = MagicMock()
+    mock_blob.generation = 1
+    return mock_blob
+
+
+@pytest.fixture
+def bucket(blob):
+    mock_bucket = MagicMock()
+    mock_bucket.get_blob.return_value = blob
+    mock_bucket.blob.return_value = blob
+    return mock_bucket
+
+
+@pytest.fixture
+def changelog(bucket):
+    return ChangeLog(bucket, poll_interval=0)
+
+
+def set_state(blob, seq, changes, generation):
+    blob.download_as_text.return_value = json.dumps({
+        'seq': seq,
+        'changes': changes
+    })
+    blob.generation = generation
+
+
+def test_page_cache_evicts_least_recently_used():
+    '''
+    Test that the oldest unused page is evicted once the cache is full.
+    '''
+    cache = LRUCache(max_entries=2)
+    cache.put('a', 'page a')
+    cache.put('b', 'page b')
+    cache.get('a')
+    cache.put('c', 'page c')
+
+    assert 'a' in cache
+    assert 'b' not in cache
+    assert cache.get('c') == 'page c'
+
+
+def test_page_cache_expires_entries_after_ttl():
+    '''
+    Test that an entry is dropped once its ttl has passed, even if nothing invalidated it.
+    '''
+    now = [100.0]
+    cache = LRUCache(ttl=30, clock=lambda: now[0])
+    cache.put('a', 'page a')
+
+    now[0] = 129.0
+    assert cache.get('a') == 'page a'
+    now[0] = 130.0
+    assert 'a' not in cache
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+def test_image_cache_bounded_by_bytes():
+    '''
+    Test that least recently used entries are evicted to stay under max_bytes, and bigger values aren't cached.
+    '''
+    cache = LRUCache(max_bytes=10)
+    cache.put('a', b'aaaa', 4)
+    cache.put('b', b'bbbb', 4)
+    cache.get('a')
+    cache.put('c', b'cccc', 4)
+
+    assert 'b' not in cache
+    assert cache.get('a') == b'aaaa'
+    assert cache.get('c') == b'cccc'
+
+    cache.put('a', b'a' * 11, 11)
+    assert 'a' not in cache
+    cache.put('d', b'dddddd', 6)
+    assert len(cache) == 2
+
+
+def test_sync_invalidates_only_changed_pages(blob, changelog):
+    '''
+    Test that polling drops only the pages changed since the last poll.
+    '''
+    cache = LRUCache()
+    set_state(blob, 2, [[1, 'a'], [2, 'b']], 1)
+    changelog.sync(cache)
+    cache.put('a', 'page a')
+    cache.put('b', 'page b')
+    cache.put('c', 'page c')
+
+    set_state(blob, 3, [[1, 'a'], [2, 'b'], [3, 'c']], 2)
+    result = changelog.sync(cache)
+
+    assert result == ['c']
+    assert 'a' in cache
+    assert 'b' in cache
+    assert 'c' not in cache
+
+
+def test_sync_not_modified(blob, bucket, changelog):
+    '''
+    Test that an unchanged changelog leaves the cache alone.
+    '''
+    cache = LRUCache()
+    set_state(blob, 1, [[1, 'a']], 7)
+    changelog.sync(cache)
+    cache.put('a', 'page a')
+    bucket.get_blob.side_effect = exceptions.NotModified('304')
+
+    assert changelog.sync(cache) == []
+    assert 'a' in cache
+    bucket.get_blob.assert_called_with('pages', if_generation_not_match=7)
+
+
+def test_sync_clears_cache_when_changes_missed(blob, changelog):
+    '''
+    Test that the whole cache is cleared when changes fell off the changelog.
+    '''
+    cache = LRUCache()
+    set_state(blob, 1, [[1, 'a']], 1)
+    changelog.sync(cache)
+    cache.put('a', 'page a')
+
+    set_state(blob, 9, [[8, 'x'], [9, 'y']], 2)
+    changelog.sync(cache)
+
+    assert len(cache) == 0
+
+
+def test_sync_respects_poll_interval(bucket):
+    '''
+    Test that the changelog is not polled again before the interval has passed.
+    '''
+    now = [100]
+    changelog = ChangeLog(bucket, poll_interval=5, clock=lambda: now[0])
+    changelog.sync(LRUCache())
+    changelog.sync(LRUCache())
+    assert bucket.get_blob.call_count == 1
+
+    now[0] = 106
+    changelog.sync(LRUCache())
+    assert bucket.get_blob.call_count == 2
+
+
+def test_bump_writes_next_sequence(blob, changelog):
+    '''
+    Test that bumping appends the page with the next sequence number.
+    '''
+    set_state(blob, 4, [[4, 'a']], 12)
+
+    result = changelog.bump('b')
+
+    assert result == 5
+    data, = blob.upload_from_string.call_args.args
+    assert json.loads(data) == {'seq': 5, 'changes': [[4, 'a'], [5, 'b']]}
+    assert blob.upload_from_string.call_args.kwargs['if_generation_match'] == 12
+
+
+def test_bump_many_pages_in_one_write(blob, changelog):
+    '''
+    Test that pages bumped together are written to the changelog once.
+    '''
+    set_state(blob, 4, [], 12)
+
+    assert changelog.bump('a', 'b', 'c') == 7
+    assert blob.upload_from_string.call_count == 1
+    data, = blob.upload_from_string.call_args.args
+    assert json.loads(data)['changes'] == [[5, 'a'], [6, 'b'], [7, 'c']]
+
+
+def test_bump_retries_on_conflict(blob, changelog):
+    '''
+    Test that a bump is retried when another instance wrote the changelog first.
+    '''
+    set_state(blob, 1, [], 1)
+    blob.upload_from_string.side_effect = [
+        exceptions.PreconditionFailed('412'), None
+    ]
+
+    assert changelog.bump('a') == 2
+    assert blob.upload_from_string.call_count == 2
@@ -0,0 +1,116 @@
+'''
+Cold start benchmark for the wiki.
+
+Starts a fresh interpreter for each run, so every import is cold, and
+measures the time to import flaskr, to create the app and to answer the
+first request, as App Engine does when it starts a new instance.
+
+Usage:
+    python -m flaskr.coldstart --runs 10 --driver gcs --path /
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+#Constants
+
+#Code each fresh interpreter runs, timing every phase of a cold start
+PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+from flaskr import create_app
+imported = time.perf_counter()
+app = create_app({'STORAGE_DRIVER': sys.argv[1]})
+created = time.perf_counter()
+response = app.test_client().get(sys.argv[2])
+answered = time.perf_counter()
+print(json.dumps({
+    'import': imported - start,
+    'create_app': created - imported,
+    'first_response': answered - created,
+    'status': response.status_code,
+    'storage_imported': 'google.cloud.storage' in sys.modules,
+}))
+'''
+
+#Phases reported, in the order they happen
+PHASES = ('process', 'import', 'create_app', 'first_response', 'total')
+
+
+def measure(driver='gcs', path='/'):
+    '''
+    Cold starts the app once in a new interpreter.
+
+    Returns:
+        A dict with the seconds each phase took, 'process' being the
+        interpreter's own startup, the first response's status and whether
+        google.cloud.storage was imported.
+    '''
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', PROBE, driver, path],
+                            cwd=root,
+                            capture_output=True,
+                            text=True,
+                            check=True).stdout
+    total = time.perf_counter() - start
+    result = json.loads(output.strip().splitlines()[-1])
+    result['total'] = total
+    result['process'] = total - (result['import'] + result['create_app'] +
+                                 result['first_response'])
+    return result
+
+
+def run(runs=5, driver='gcs', path='/'):
+    '''
+    Cold starts the app several times.
+
+    Returns:
+        A dict from phase to its median, min and max in milliseconds, plus
+        the statuses of the first responses and whether any run imported
+        google.cloud.storage.
+    '''
+    results = [measure(driver, path) for _ in range(runs)]
+    report = {}
+    for phase in PHASES:
+        samples = [result[phase] * 1000 for result in results]
+        report[phase] = {
+            'median': statistics.median(samples),
+            'min': min(samples),
+            'max': max(samples),
+        }
+    report['statuses'] = sorted({result['status'] for result in results})
+    report['storage_imported'] = any(
+        result['storage_imported'] for result in results)
+    return report
+
+
+def format_report(report):
+    lines = [f"{'phase':<15} {'median ms':>10} {'min ms':>10} {'max ms':>10}"]
+    for phase in PHASES:
+        row = report[phase]
+        lines.append(f"{phase:<15} {row['median']:>10.1f} {row['min']:>10.1f} "
+                     f"{row['max']:>10.1f}")
+    lines.append(f"statuses: {report['statuses']}, google.cloud.storage "
+                 f"imported: {report['storage_imported']}")
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--driver',
+                        default='gcs',
+                        help='STORAGE_DRIVER of the app, gcs by default')
+    parser.add_argument('--path', default='/', help='path of the first request')
+    args = parser.parse_args(argv)
+
+    print(format_report(run(args.runs, args.driver, args.path)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,20 @@
+from .coldstart import measure, format_report, run
+
+
+def test_cold_start_does_not_create_storage_client():
+    '''
+    Test that a fresh app answers a request that doesn't need storage without importing the GCS client.
+    '''
+    result = measure('gcs', '/')
+
+    assert result['status'] == 200
+    assert result['storage_imported'] == False
+    assert result['total'] >= result['import'] > 0
+
+
+def test_run_reports_every_phase():
+    report = run(runs=1, driver='memory', path='/about')
+
+    assert report['statuses'] == [200]
+    assert report['total']['min'] <= report['total']['median']
+    assert 'first_response' in format_report(report)
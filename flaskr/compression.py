@@ -0,0 +1,174 @@
+'''
+Gzip compression of pages at rest and of HTML responses on the wire.
+
+Pages are stored gzipped with a Content-Encoding of gzip once that makes
+them smaller, and Backend decompresses them itself. They are downloaded
+raw, so the same code works with every storage driver and range reads of
+the stored bytes stay valid. Pages written before compression, or too
+small to gain from it, are stored as they are and read as before.
+
+init_app gzips HTML responses for browsers that accept it.
+'''
+from .retry import request_options
+from flask import request
+import contextlib
+import gzip
+import io
+import shutil
+import tempfile
+import zlib
+
+#Constants
+
+#Content-Encoding of compressed pages and responses
+CONTENT_ENCODING = 'gzip'
+
+#Balances compression against CPU time, like most web servers' default
+COMPRESS_LEVEL = 6
+
+#Pages and responses smaller than this many bytes are left as they are,
+#gzip's own overhead eats most of what they would gain
+MIN_COMPRESS_SIZE = 1024
+
+#Compressed uploads bigger than this many bytes are spooled to disk
+SPOOL_SIZE = 1024 * 1024
+
+#Responses of these types are compressed
+COMPRESSED_MIMETYPES = ('text/html',)
+
+
+def compress(data):
+    '''
+    Gzips the text of a page if that makes it smaller.
+
+    Returns:
+        A tuple of what to store, and its Content-Encoding or None if data
+        is returned as it was.
+    '''
+    raw = data.encode('utf-8') if isinstance(data, str) else data
+    if len(raw) < MIN_COMPRESS_SIZE:
+        return data, None
+    compressed = gzip.compress(raw, COMPRESS_LEVEL, mtime=0)
+    if len(compressed) >= len(raw):
+        return data, None
+    return compressed, CONTENT_ENCODING
+
+
+def compress_file(file_obj, size):
+    '''
+    Gzips a seekable file object if that makes it smaller, without reading it into memory.
+
+    Args:
+        file_obj = The file object
+        size = Its size in bytes
+
+    Returns:
+        A tuple of the file object to store, its size and its
+        Content-Encoding or None if file_obj is returned as it was.
+    '''
+    if size < MIN_COMPRESS_SIZE:
+        return file_obj, size, None
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    file_obj.seek(0)
+    with gzip.GzipFile(fileobj=spool,
+                       mode='wb',
+                       compresslevel=COMPRESS_LEVEL,
+                       mtime=0) as f:
+        shutil.copyfileobj(file_obj, f)
+    compressed_size = spool.tell()
+    if compressed_size >= size:
+        spool.close()
+        return file_obj, size, None
+    spool.seek(0)
+    return spool, compressed_size, CONTENT_ENCODING
+
+
+def is_compressed(blob):
+    return blob.content_encoding == CONTENT_ENCODING
+
+
+def read_bytes(blob):
+    '''
+    Downloads a blob and returns its content, decompressed if it is stored compressed.
+    '''
+    if not is_compressed(blob):
+        return blob.download_as_bytes(**request_options())
+    return gzip.decompress(
+        blob.download_as_bytes(raw_download=True, **request_options()))
+
+
+@contextlib.contextmanager
+def open_text(blob, chunk_size=None):
+    '''
+    Opens a blob for reading its content as text a chunk at a time, decompressed if it is stored compressed.
+    '''
+    if not is_compressed(blob):
+        with blob.open('r', chunk_size=chunk_size, **request_options()) as f:
+            yield f
+        return
+    with blob.open('rb',
+                   chunk_size=chunk_size,
+                   raw_download=True,
+                   **request_options()) as raw:
+        with gzip.GzipFile(fileobj=raw) as f:
+            yield io.TextIOWrapper(f, encoding='utf-8')
+
+
+def init_app(app):
+    '''
+    Gzips HTML responses for browsers that send Accept-Encoding: gzip.
+
+    Streamed responses are compressed as they are generated, flushed every
+    MIN_COMPRESS_SIZE bytes or so, so the browser can show each part before
+    the rest arrives without every small template fragment costing a flush.
+    '''
+
+    @app.after_request
+    def compress_response(response):
+        if (response.mimetype not in COMPRESSED_MIMETYPES or
+                response.status_code < 200 or response.status_code == 204 or
+                response.status_code == 304 or
+                'Content-Encoding' in response.headers or
+                'gzip' not in request.accept_encodings):
+            return response
+
+        response.vary.add('Accept-Encoding')
+        if response.is_streamed:
+            response.response = _compress_chunks(response.response)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < MIN_COMPRESS_SIZE:
+                return response
+            response.set_data(gzip.compress(data, COMPRESS_LEVEL))
+        response.content_encoding = CONTENT_ENCODING
+
+        #The compressed body is a different representation of the same page
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+
+def _compress_chunks(chunks):
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED,
+                                  16 + zlib.MAX_WBITS)
+    #Chunks waiting to be flushed together, and how many bytes they hold
+    buffered = []
+    size = 0
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            buffered.append(chunk)
+            size += len(chunk)
+            if size < MIN_COMPRESS_SIZE:
+                continue
+            data = compressor.compress(b''.join(buffered))
+            data += compressor.flush(zlib.Z_SYNC_FLUSH)
+            buffered, size = [], 0
+            yield data
+        yield compressor.compress(b''.join(buffered)) + compressor.flush()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
@@ -0,0 +1,137 @@
+from flaskr import create_app
+from .compression import (compress, compress_file, _compress_chunks,
+                          MIN_COMPRESS_SIZE)
+from .backend import Backend
+from .drivers import MemoryClient
+from unittest.mock import patch
+import gzip
+import io
+import os
+import pytest
+
+PAGE = 'The Analytical Engine weaves algebraic patterns. ' * 100
+
+
+@pytest.fixture
+def backend():
+    return Backend(MemoryClient())
+
+
+@pytest.fixture
+def app():
+    return create_app({'TESTING': True, 'STORAGE_DRIVER': 'memory'})
+
+
+def test_compress_leaves_small_pages():
+    assert compress('short page') == ('short page', None)
+
+
+def test_compress_round_trip():
+    data, encoding = compress(PAGE)
+
+    assert encoding == 'gzip'
+    assert len(data) < len(PAGE) / 10
+    assert gzip.decompress(data).decode() == PAGE
+
+
+def test_compress_file_keeps_incompressible_files():
+    original = io.BytesIO(os.urandom(MIN_COMPRESS_SIZE * 4))
+
+    assert compress_file(original,
+                         MIN_COMPRESS_SIZE * 4) == (original,
+                                                    MIN_COMPRESS_SIZE * 4, None)
+
+
+def test_pages_stored_compressed(backend):
+    '''
+    Test that pages are stored gzipped and read back as they were written.
+    '''
+    backend.upload(PAGE, 'Engine', 'Ada')
+    backend.upload(io.BytesIO(PAGE.encode()), 'Engine notes', 'Ada')
+    backend.page_cache.clear()
+
+    for name in ('Engine', 'Engine notes'):
+        blob = backend.pages_bucket.get_blob(name)
+        assert blob.content_encoding == 'gzip'
+        assert blob.size < len(PAGE) / 10
+        assert backend.get_wiki_page(name) == PAGE
+        assert ''.join(backend.iter_wiki_page(name, chunk_size=100)) == PAGE
+
+
+def test_uncompressed_pages_still_read(backend):
+    blob = backend.pages_bucket.blob('Old page')
+    blob.upload_from_string(PAGE)
+
+    assert backend.get_wiki_page('Old page') == PAGE
+    assert ''.join(backend.iter_wiki_page('Old page')) == PAGE
+
+
+def test_packs_hold_decompressed_pages(backend):
+    backend.upload(PAGE, 'Engine', 'Ada')
+    backend.pack_pages()
+
+    blobs = backend.storage_client.list_blobs('sdswiki_contents')
+    assert dict(backend.packs.scan(blobs)) == {'Engine': PAGE.encode()}
+
+
+def test_html_responses_gzipped(app):
+    app.extensions['backend'].upload(PAGE, 'Engine', 'Ada')
+    client = app.test_client()
+
+    resp = client.get('/pages/Engine', headers={'Accept-Encoding': 'gzip'})
+
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in resp.headers['Vary']
+    assert PAGE.encode() in gzip.decompress(resp.data)
+    etag, weak = resp.get_etag()
+    assert weak
+
+    resp = client.get('/pages/Engine',
+                      headers={
+                          'Accept-Encoding': 'gzip',
+                          'If-None-Match': f'W/"{etag}"'
+                      })
+    assert resp.status_code == 304
+
+
+def test_streamed_responses_gzipped(app):
+    app.extensions['backend'].upload(PAGE, 'Engine', 'Ada')
+    client = app.test_client()
+
+    with patch('flaskr.pages.STREAM_PAGE_SIZE', 10):
+        resp = client.get('/pages/Engine', headers={'Accept-Encoding': 'gzip'})
+
+    assert resp.is_streamed
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert PAGE.encode() in gzip.decompress(resp.data)
+
+
+def test_streaming_uses_uncompressed_length(backend):
+    '''
+    Test that a page is streamed by its length, even when stored gzipped it is smaller.
+    '''
+    backend.upload(PAGE, 'Engine', 'Ada')
+    stored = backend.pages_bucket.get_blob('Engine').size
+
+    record = backend.get_page_record('Engine', stream_over=stored + 1)
+
+    assert 'content' not in record
+    assert ''.join(record['chunks']) == PAGE
+
+
+def test_streamed_fragments_flushed_together():
+    fragments = ['<p>fragment</p>'] * 1000
+
+    parts = list(_compress_chunks(iter(fragments)))
+
+    assert len(parts) < len(fragments) / 10
+    assert gzip.decompress(b''.join(parts)) == ''.join(fragments).encode()
+
+
+def test_responses_not_gzipped_without_accept_encoding(app):
+    app.extensions['backend'].upload(PAGE, 'Engine', 'Ada')
+
+    resp = app.test_client().get('/pages/Engine')
+
+    assert 'Content-Encoding' not in resp.headers
+    assert PAGE.encode() in resp.data
@@ -0,0 +1,608 @@
+from google.cloud import exceptions
+from datetime import datetime, timezone
+from urllib.parse import quote, unquote
+import abc
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+#Constants
+
+#Drivers that can be chosen with the STORAGE_DRIVER config value
+STORAGE_DRIVERS = ('gcs', 'local', 'memory', 'emulator')
+
+#How many bytes are copied at a time when streaming a file into storage
+COPY_CHUNK_SIZE = 1024 * 1024
+
+#How many bytes Blob.open reads at a time without a chunk_size, like the GCS library
+READ_CHUNK_SIZE = 40 * 1024 * 1024
+
+
+def make_storage_client(config, instance_path=''):
+    '''
+    Creates the storage client selected by the app config.
+
+    Args:
+        config = The app config. STORAGE_DRIVER picks 'gcs' (the default),
+            'local', 'memory' or 'emulator'. STORAGE_ROOT is the local driver's
+            directory, by default the storage folder of the instance path.
+            The emulator keeps data in memory and is tuned with
+            EMULATOR_MEDIAN_LATENCY and EMULATOR_P99_LATENCY (seconds),
+            EMULATOR_ERROR_RATE and EMULATOR_MAX_OPS_PER_SECOND.
+        instance_path = The app's instance folder
+
+    Returns:
+        A client with the subset of the google.cloud.storage client API that Backend uses.
+    '''
+    driver = config.get('STORAGE_DRIVER', 'gcs')
+    if driver == 'gcs':
+        return LazyClient()
+    if driver == 'local':
+        root = config.get('STORAGE_ROOT') or os.path.join(
+            instance_path, 'storage')
+        return LocalClient(root)
+    if driver == 'memory':
+        return MemoryClient()
+    if driver == 'emulator':
+        from .emulator import EmulatedClient, LogNormal
+        latency = None
+        if config.get('EMULATOR_MEDIAN_LATENCY'):
+            median = config['EMULATOR_MEDIAN_LATENCY']
+            latency = LogNormal(median,
+                                config.get('EMULATOR_P99_LATENCY', median * 10))
+        return EmulatedClient(
+            latency=latency,
+            error_rate=config.get('EMULATOR_ERROR_RATE', 0),
+            max_ops_per_second=config.get('EMULATOR_MAX_OPS_PER_SECOND'))
+    raise ValueError(f"Unknown STORAGE_DRIVER {driver!r}, "
+                     f"expected one of {', '.join(STORAGE_DRIVERS)}")
+
+
+class LazyClient:
+    '''
+    Stands in for a google.cloud.storage.Client until storage is first used.
+
+    Importing google.cloud.storage and looking up credentials take longer
+    than the rest of the app's startup, and requests that don't touch
+    storage never need them. The client is created on the first attribute
+    access, once even when several threads get there together, and every
+    other attribute is passed through to it.
+
+    Args:
+        factory = Creates the client, google.cloud.storage.Client() by default
+    '''
+
+    def __init__(self, factory=None):
+        self._factory = factory or _gcs_client
+        self._client = None
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    @property
+    def created(self):
+        return self._client is not None
+
+    def get(self):
+        '''
+        Returns the client, creating it if this is its first use.
+        '''
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    client = self._factory()
+                    for callback in self._callbacks:
+                        callback(client)
+                    self._client = client
+        return self._client
+
+    def reset(self):
+        '''
+        Forgets the client, so the next use creates a new one, as a forked worker must.
+
+        Callbacks registered with on_create are kept for the new client.
+        '''
+        self._lock = threading.Lock()
+        self._client = None
+
+    def on_create(self, callback):
+        '''
+        Calls callback with the client once it is created, right away if it already is.
+        '''
+        with self._lock:
+            if self._client is None:
+                self._callbacks.append(callback)
+                return
+        callback(self._client)
+
+    def __getattr__(self, name):
+        #Copying and pickling look up dunders before __init__ has run
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.get(), name)
+
+
+class Client(abc.ABC):
+    '''
+    Storage client that looks like google.cloud.storage.Client to Backend.
+
+    Subclasses decide where objects live by implementing the abstract _head,
+    _read, _put, _remove and _list. Object properties are kept as a dict
+    with the generation, updated time, size, custom metadata, content type
+    and content encoding.
+    '''
+
+    def __init__(self):
+        self._generation_lock = threading.Lock()
+        self._last_generation = 0
+
+    def bucket(self, name):
+        return Bucket(self, name)
+
+    def list_blobs(self, bucket_or_name, prefix=None, **kwargs):
+        bucket = bucket_or_name
+        if isinstance(bucket_or_name, str):
+            bucket = self.bucket(bucket_or_name)
+        return [
+            Blob(bucket, name, props)
+            for name, props in sorted(self._list(bucket.name, prefix or ''))
+        ]
+
+    def _next_generation(self):
+        '''
+        Returns a new generation, microseconds since the epoch like GCS, but always increasing.
+        '''
+        with self._generation_lock:
+            self._last_generation = max(time.time_ns() // 1000,
+                                        self._last_generation + 1)
+            return self._last_generation
+
+    def _new_props(self, size, properties):
+        props = dict(properties)
+        props['generation'] = self._next_generation()
+        props['updated'] = time.time()
+        props['size'] = size
+        return props
+
+    @abc.abstractmethod
+    def _head(self, bucket, name):
+        '''
+        Returns the properties of an object, or None if it doesn't exist.
+        '''
+
+    @abc.abstractmethod
+    def _read(self, bucket, name, start=None, end=None):
+        '''
+        Returns the bytes of an object from start to end inclusive, raising NotFound if it doesn't exist.
+        '''
+
+    @abc.abstractmethod
+    def _put(self, bucket, name, chunks, properties, if_generation_match=None):
+        '''
+        Writes an object from an iterable of byte chunks and returns its new properties.
+        '''
+
+    @abc.abstractmethod
+    def _remove(self, bucket, name):
+        '''
+        Deletes an object, raising NotFound if it doesn't exist.
+        '''
+
+    @abc.abstractmethod
+    def _list(self, bucket, prefix):
+        '''
+        Returns the (name, properties) pairs of the objects whose names start with prefix.
+        '''
+
+
+class MemoryClient(Client):
+    '''
+    Keeps every object in a dict, for tests and benchmarks without any I/O.
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        #bucket name -> object name -> (data, props)
+        self._objects = {}
+
+    def _head(self, bucket, name):
+        with self._lock:
+            entry = self._objects.get(bucket, {}).get(name)
+        return None if entry is None else dict(entry[1])
+
+    def _read(self, bucket, name, start=None, end=None):
+        with self._lock:
+            entry = self._objects.get(bucket, {}).get(name)
+        if entry is None:
+            raise exceptions.NotFound(f'{bucket}/{name}')
+        lo, hi = _byte_range(len(entry[0]), start, end)
+        return entry[0][lo:hi]
+
+    def _put(self, bucket, name, chunks, properties, if_generation_match=None):
+        data = b''.join(chunks)
+        with self._lock:
+            objects = self._objects.setdefault(bucket, {})
+            current = objects.get(name)
+            _check_generation(bucket, name, current and
+                              current[1]['generation'], if_generation_match)
+            props = self._new_props(len(data), properties)
+            objects[name] = (data, props)
+        return dict(props)
+
+    def _remove(self, bucket, name):
+        with self._lock:
+            if self._objects.get(bucket, {}).pop(name, None) is None:
+                raise exceptions.NotFound(f'{bucket}/{name}')
+
+    def _list(self, bucket, prefix):
+        with self._lock:
+            objects = list(self._objects.get(bucket, {}).items())
+        return [(name, dict(props))
+                for name, (data, props) in objects
+                if name.startswith(prefix)]
+
+
+class LocalClient(Client):
+    '''
+    Keeps every object as a file under a root directory, one folder per bucket.
+
+    Each file starts with a line of JSON holding the object's properties,
+    followed by its bytes, so replacing the file swaps data and properties
+    together. Writes go to a temporary file that is renamed into place, and
+    reads seek straight to the bytes asked for.
+    '''
+
+    def __init__(self, root):
+        super().__init__()
+        self.root = root
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(root, '.tmp'), exist_ok=True)
+        os.makedirs(os.path.join(root, '.locks'), exist_ok=True)
+
+    def _head(self, bucket, name):
+        try:
+            with open(self._path(bucket, name), 'rb') as f:
+                return _read_props(f)
+        except FileNotFoundError:
+            return None
+
+    def _read(self, bucket, name, start=None, end=None):
+        try:
+            f = open(self._path(bucket, name), 'rb')
+        except FileNotFoundError:
+            raise exceptions.NotFound(f'{bucket}/{name}')
+        with f:
+            offset = len(f.readline())
+            size = os.fstat(f.fileno()).st_size - offset
+            lo, hi = _byte_range(size, start, end)
+            if hi <= lo:
+                return b''
+            f.seek(offset + lo)
+            return f.read(hi - lo)
+
+    def _put(self, bucket, name, chunks, properties, if_generation_match=None):
+        os.makedirs(os.path.join(self.root, bucket), exist_ok=True)
+        props = self._new_props(0, properties)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.root, '.tmp'))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(json.dumps(props).encode() + b'\n')
+                size = 0
+                for chunk in chunks:
+                    f.write(chunk)
+                    size += len(chunk)
+            props['size'] = size
+            with self._locked(bucket):
+                current = self._head(bucket, name)
+                _check_generation(bucket, name, current and
+                                  current['generation'], if_generation_match)
+                os.replace(tmp_path, self._path(bucket, name))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return props
+
+    def _remove(self, bucket, name):
+        with self._locked(bucket):
+            try:
+                os.remove(self._path(bucket, name))
+            except FileNotFoundError:
+                raise exceptions.NotFound(f'{bucket}/{name}')
+
+    def _list(self, bucket, prefix):
+        try:
+            files = os.listdir(os.path.join(self.root, bucket))
+        except FileNotFoundError:
+            return []
+        listing = []
+        for file_name in files:
+            name = unquote(file_name)
+            if not name.startswith(prefix):
+                continue
+            props = self._head(bucket, name)
+            #Deleted since we listed the folder
+            if props is not None:
+                listing.append((name, props))
+        return listing
+
+    def _path(self, bucket, name):
+        return os.path.join(self.root, bucket, quote(name, safe=''))
+
+    def _locked(self, bucket):
+        return _FileLock(self._lock, os.path.join(self.root, '.locks', bucket))
+
+
+class Bucket:
+    '''
+    A bucket of a driver client, with the methods Backend uses from google.cloud.storage.Bucket.
+    '''
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def blob(self, name, **kwargs):
+        return Blob(self, name)
+
+    def get_blob(self, name, if_generation_not_match=None, **kwargs):
+        props = self.client._head(self.name, name)
+        if props is None:
+            return None
+        if if_generation_not_match is not None and props[
+                'generation'] == if_generation_not_match:
+            raise exceptions.NotModified(f'{self.name}/{name}')
+        return Blob(self, name, props)
+
+    def list_blobs(self, prefix=None, **kwargs):
+        return self.client.list_blobs(self, prefix=prefix)
+
+
+class Blob:
+    '''
+    An object of a driver client, with the methods Backend uses from google.cloud.storage.Blob.
+    '''
+
+    def __init__(self, bucket, name, props=None):
+        self.bucket = bucket
+        self.client = bucket.client
+        self.name = name
+        self.metadata = None
+        self.content_type = None
+        self.content_encoding = None
+        self.chunk_size = None
+        self.generation = None
+        self.updated = None
+        self.size = None
+        if props is not None:
+            self._set(props)
+
+    def open(self, mode='r', chunk_size=None, encoding='utf-8', **kwargs):
+        if 'r' in mode:
+            #Read chunk_size bytes at a time with ranged reads, like GCS
+            chunk_size = chunk_size or READ_CHUNK_SIZE
+            reader = io.BufferedReader(_Reader(self, chunk_size),
+                                       buffer_size=chunk_size)
+            return reader if 'b' in mode else io.TextIOWrapper(
+                reader, encoding=encoding)
+        writer = _Writer(self._upload_written)
+        return writer if 'b' in mode else io.TextIOWrapper(writer,
+                                                           encoding=encoding)
+
+    def upload_from_string(self,
+                           data,
+                           content_type=None,
+                           if_generation_match=None,
+                           **kwargs):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+            content_type = content_type or 'text/plain'
+        self._upload([data], content_type, if_generation_match)
+
+    def upload_from_file(self,
+                         file_obj,
+                         rewind=False,
+                         size=None,
+                         content_type=None,
+                         if_generation_match=None,
+                         **kwargs):
+        if rewind:
+            file_obj.seek(0)
+        self._upload(_iter_file(file_obj, size), content_type,
+                     if_generation_match)
+
+    def download_as_bytes(self, start=None, end=None, **kwargs):
+        return self.client._read(self.bucket.name, self.name, start, end)
+
+    def download_as_text(self,
+                         start=None,
+                         end=None,
+                         encoding='utf-8',
+                         **kwargs):
+        return self.download_as_bytes(start, end).decode(encoding)
+
+    def delete(self, **kwargs):
+        self.client._remove(self.bucket.name, self.name)
+
+    def compose(self, sources, if_generation_match=None, **kwargs):
+        chunks = (self.client._read(self.bucket.name, source.name)
+                  for source in sources)
+        self._upload(chunks, self.content_type, if_generation_match)
+
+    def reload(self, **kwargs):
+        props = self.client._head(self.bucket.name, self.name)
+        if props is None:
+            raise exceptions.NotFound(f'{self.bucket.name}/{self.name}')
+        self._set(props)
+
+    def exists(self, **kwargs):
+        return self.client._head(self.bucket.name, self.name) is not None
+
+    def _upload(self, chunks, content_type, if_generation_match):
+        props = self.client._put(
+            self.bucket.name, self.name, chunks, {
+                'metadata':
+                    self.metadata,
+                'content_type':
+                    content_type or self.content_type
+                    or 'application/octet-stream',
+                'content_encoding':
+                    self.content_encoding,
+            }, if_generation_match)
+        self._set(props)
+
+    def _upload_written(self, data):
+        self._upload([data], None, None)
+
+    def _set(self, props):
+        self.metadata = props.get('metadata')
+        self.content_type = props.get('content_type')
+        self.content_encoding = props.get('content_encoding')
+        self.generation = props['generation']
+        self.updated = datetime.fromtimestamp(props['updated'], timezone.utc)
+        self.size = props['size']
+
+
+class _Reader(io.RawIOBase):
+    '''
+    Reads a blob handed out by Blob.open with a ranged read of the client per call.
+    '''
+
+    def __init__(self, blob, chunk_size):
+        self._blob = blob
+        self._chunk_size = chunk_size
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not len(buffer):
+            return 0
+        #GCS ranges include their end
+        end = self._position + len(buffer) - 1
+        data = self._blob.download_as_bytes(start=self._position, end=end)
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def readall(self):
+        #RawIOBase would read the rest a few kilobytes per request
+        chunks = []
+        while True:
+            chunk = self.read(self._chunk_size)
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            if self._blob.size is None:
+                self._blob.reload()
+            offset += self._blob.size
+        self._position = max(offset, 0)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+
+class _Writer(io.BytesIO):
+    '''
+    Buffer handed out by Blob.open for writing, uploaded when it is closed.
+    '''
+
+    def __init__(self, on_close):
+        super().__init__()
+        self._on_close = on_close
+
+    def close(self):
+        if not self.closed:
+            self._on_close(self.getvalue())
+        super().close()
+
+
+class _FileLock:
+    '''
+    Holds a thread lock and an exclusive lock on a file, so writes to a bucket
+    are serialised across threads and processes.
+    '''
+
+    def __init__(self, thread_lock, path):
+        self._thread_lock = thread_lock
+        self._path = path
+        self._file = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        if fcntl is not None:
+            self._file = open(self._path, 'a')
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+        self._thread_lock.release()
+
+
+def _gcs_client():
+    from google.cloud import storage
+    return storage.Client()
+
+
+def _check_generation(bucket, name, current, if_generation_match):
+    '''
+    Raises PreconditionFailed like GCS when if_generation_match doesn't hold.
+    0 means the object must not exist yet.
+    '''
+    if if_generation_match is None:
+        return
+    if (current or 0) != if_generation_match:
+        raise exceptions.PreconditionFailed(
+            f'{bucket}/{name} is at generation {current or 0}, '
+            f'not {if_generation_match}')
+
+
+def _byte_range(size, start, end):
+    '''
+    Turns GCS style start and inclusive end offsets into slice bounds.
+    '''
+    lo = 0 if start is None else start
+    hi = size if end is None else min(end + 1, size)
+    return lo, hi
+
+
+def _read_props(f):
+    props = json.loads(f.readline())
+    props['size'] = os.fstat(f.fileno()).st_size - f.tell()
+    return props
+
+
+def _iter_file(file_obj, size=None):
+    remaining = size
+    while remaining is None or remaining > 0:
+        chunk_size = COPY_CHUNK_SIZE
+        if remaining is not None:
+            chunk_size = min(chunk_size, remaining)
+        chunk = file_obj.read(chunk_size)
+        if not chunk:
+            return
+        if remaining is not None:
+            remaining -= len(chunk)
+        yield chunk
@@ -0,0 +1,216 @@
+from .drivers import make_storage_client, Client, MemoryClient, LocalClient, LazyClient
+from .backend import Backend
+from google.cloud import exceptions
+import io
+import pytest
+
+
+@pytest.fixture(params=['memory', 'local'])
+def storage_client(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryClient()
+    return LocalClient(str(tmp_path))
+
+
+@pytest.fixture
+def bucket(storage_client):
+    return storage_client.bucket('sdswiki_contents')
+
+
+def test_upload_and_get_blob(bucket):
+    '''
+    Test that uploaded data and metadata can be read back.
+    '''
+    blob = bucket.blob('Ada Lovelace')
+    blob.metadata = {'author': 'Elei'}
+    blob.upload_from_string('First programmer')
+
+    result = bucket.get_blob('Ada Lovelace')
+
+    assert result.metadata == {'author': 'Elei'}
+    assert result.generation == blob.generation
+    assert result.size == 16
+    assert result.content_type == 'text/plain'
+    assert result.updated is not None
+    assert result.download_as_text() == 'First programmer'
+    with result.open() as f:
+        assert f.read() == 'First programmer'
+    assert bucket.get_blob('Grace Hopper') is None
+
+
+def test_open_reads_in_chunks(storage_client, bucket):
+    '''
+    Test that an opened blob is read chunk_size bytes per read instead of all at once.
+    '''
+    bucket.blob('page').upload_from_string(b'0123456789')
+    reads = []
+    read = storage_client._read
+
+    def counted(bucket_name, name, start=None, end=None):
+        reads.append((start, end))
+        return read(bucket_name, name, start, end)
+
+    storage_client._read = counted
+
+    with bucket.get_blob('page').open('rb', chunk_size=4) as f:
+        assert f.read(3) == b'012'
+        assert reads == [(0, 3)]
+        assert f.read() == b'3456789'
+        f.seek(-2, io.SEEK_END)
+        assert f.read() == b'89'
+
+    assert all(end - start < 4 for start, end in reads)
+
+
+def test_generations_increase(bucket):
+    blob = bucket.blob('page')
+    blob.upload_from_string('one')
+    first = blob.generation
+    blob.upload_from_string('two')
+
+    assert blob.generation > first
+
+
+def test_generation_preconditions(bucket):
+    '''
+    Test that if_generation_match and if_generation_not_match behave like GCS.
+    '''
+    blob = bucket.blob('page')
+    blob.upload_from_string('one', if_generation_match=0)
+    with pytest.raises(exceptions.PreconditionFailed):
+        bucket.blob('page').upload_from_string('two', if_generation_match=0)
+
+    with pytest.raises(exceptions.NotModified):
+        bucket.get_blob('page', if_generation_not_match=blob.generation)
+    assert bucket.get_blob('page', if_generation_not_match=1) is not None
+
+
+def test_list_blobs_with_prefix(storage_client, bucket):
+    for name in ['pending/a/1', 'pending/b/2', 'page']:
+        bucket.blob(name).upload_from_string(name)
+
+    all_names = [b.name for b in storage_client.list_blobs('sdswiki_contents')]
+    pending = [
+        b.name for b in storage_client.list_blobs('sdswiki_contents',
+                                                  prefix='pending/')
+    ]
+
+    assert all_names == ['page', 'pending/a/1', 'pending/b/2']
+    assert pending == ['pending/a/1', 'pending/b/2']
+    assert list(storage_client.list_blobs('sds_reports')) == []
+
+
+def test_ranged_download(bucket):
+    bucket.blob('page').upload_from_string(b'0123456789')
+
+    assert bucket.blob('page').download_as_bytes(start=2, end=4) == b'234'
+    assert bucket.blob('page').download_as_bytes(start=8) == b'89'
+
+
+def test_open_for_writing(bucket):
+    with bucket.blob('user').open('w') as f:
+        f.write('hashed password')
+
+    assert bucket.get_blob('user').download_as_text() == 'hashed password'
+
+
+def test_upload_from_file(bucket):
+    bucket.blob('page').upload_from_file(io.BytesIO(b'file data'),
+                                         rewind=True,
+                                         size=4)
+
+    assert bucket.get_blob('page').download_as_bytes() == b'file'
+
+
+def test_compose(bucket):
+    bucket.blob('a').upload_from_string('new\n')
+    bucket.blob('b').upload_from_string('old\n')
+
+    target = bucket.blob('b')
+    target.compose([bucket.blob('a'), bucket.get_blob('b')])
+
+    assert bucket.get_blob('b').download_as_text() == 'new\nold\n'
+
+
+def test_delete(bucket):
+    bucket.blob('page').upload_from_string('x')
+    bucket.get_blob('page').delete()
+
+    assert bucket.get_blob('page') is None
+    with pytest.raises(exceptions.NotFound):
+        bucket.blob('page').delete()
+
+
+def test_backend_round_trip(storage_client):
+    '''
+    Test that the whole Backend works on top of a driver client.
+    '''
+    backend = Backend(storage_client)
+
+    assert backend.upload('Wrote the first algorithm', 'Ada Lovelace',
+                          'Elei') == 'Ada Lovelace uploaded to Wiki.'
+    assert backend.get_all_page_names() == ['Ada Lovelace']
+    assert backend.get_wiki_page('Ada Lovelace') == 'Wrote the first algorithm'
+    assert backend.check_page_author('Ada Lovelace') == 'Elei'
+
+    backend.report('Ada Lovelace', 'Needs sources')
+    assert backend.compact_reports() == 1
+    reports = storage_client.bucket('sds_reports').get_blob(
+        'reports/Ada Lovelace')
+    assert reports.download_as_text() == 'Needs sources\n'
+
+    assert backend.sign_up('Elei',
+                           'password') == 'user Elei successfully created.'
+    assert backend.sign_in('Elei', 'password') == True
+
+    assert backend.bookmark('Ada Lovelace', 'Elei') == True
+    backend.bookmarks.flush()
+    assert Backend(storage_client).get_bookmarks(
+        'Elei', ['Ada Lovelace']) == ['Ada Lovelace']
+
+    assert backend.delete_page('Ada Lovelace') == True
+    assert backend.get_wiki_page(
+        'Ada Lovelace') == 'Error: Wiki page Ada Lovelace not found.'
+
+
+def test_client_primitives_are_abstract():
+
+    class Incomplete(Client):
+
+        def _head(self, bucket, name):
+            return None
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_make_storage_client(tmp_path):
+    assert isinstance(make_storage_client({'STORAGE_DRIVER': 'memory'}),
+                      MemoryClient)
+    assert isinstance(make_storage_client({}), LazyClient)
+    client = make_storage_client({'STORAGE_DRIVER': 'local'}, str(tmp_path))
+    assert isinstance(client, LocalClient)
+    assert client.root == str(tmp_path / 'storage')
+    with pytest.raises(ValueError):
+        make_storage_client({'STORAGE_DRIVER': 'ftp'})
+
+
+def test_lazy_client_created_on_first_use():
+    created = []
+
+    def factory():
+        created.append(MemoryClient())
+        return created[-1]
+
+    client = LazyClient(factory)
+    backend = Backend(client)
+    seen = []
+    client.on_create(seen.append)
+
+    assert created == []
+    assert backend.upload('x', 'page', 'Elei') == 'page uploaded to Wiki.'
+    assert len(created) == 1
+    assert seen == created
+    assert client.get() is created[0]
+    assert backend.warm_up() == True
+    assert len(created) == 1
@@ -0,0 +1,176 @@
+from .drivers import Client, MemoryClient
+from google.cloud import exceptions
+from collections import Counter
+import math
+import random
+import threading
+import time
+
+#Constants
+
+#Storage operations the emulator can slow down or fail, one per driver primitive
+OPERATIONS = ('metadata', 'read', 'write', 'delete', 'list')
+
+#Errors GCS clients are expected to retry
+TRANSIENT_ERRORS = (exceptions.InternalServerError,
+                    exceptions.ServiceUnavailable, exceptions.GatewayTimeout)
+
+
+class Fixed:
+    '''
+    Latency distribution that always takes the same time.
+    '''
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def sample(self, rng):
+        return self.seconds
+
+
+class Uniform:
+    '''
+    Latency distribution spread evenly between low and high seconds.
+    '''
+
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+
+    def sample(self, rng):
+        return rng.uniform(self.low, self.high)
+
+
+class LogNormal:
+    '''
+    Long tailed latency distribution, the usual shape of cloud storage latency.
+
+    Args:
+        median = The median latency in seconds
+        p99 = The 99th percentile latency in seconds
+    '''
+
+    #z score of the 99th percentile of a normal distribution
+    Z99 = 2.326
+
+    def __init__(self, median, p99):
+        self.mu = math.log(median)
+        self.sigma = (math.log(p99) - self.mu) / self.Z99
+
+    def sample(self, rng):
+        return rng.lognormvariate(self.mu, self.sigma)
+
+
+class EmulatedClient(Client):
+    '''
+    Storage client that adds latency, throttling and transient errors to another driver client.
+
+    Every storage call is delayed by a sample of its operation's latency
+    distribution, rejected with 429 Too Many Requests once more than
+    max_ops_per_second calls arrive in a second, and fails with a random
+    transient 5xx error with probability error_rate. The calls, the time
+    slept and the faults injected are counted in stats.
+
+    Args:
+        inner = The client that stores the data, a MemoryClient by default
+        latency = A distribution for every operation, or a dict from
+            operation name (see OPERATIONS) to distribution
+        error_rate = Probability of a transient error, or a dict per operation
+        max_ops_per_second = Calls allowed per second before throttling, or None
+        bytes_per_second = Transfer rate added on top of latency for reads
+            and writes, or None
+        seed = Seed of the random generator, for repeatable runs
+    '''
+
+    def __init__(self,
+                 inner=None,
+                 latency=None,
+                 error_rate=0,
+                 max_ops_per_second=None,
+                 bytes_per_second=None,
+                 seed=None,
+                 sleep=time.sleep,
+                 clock=time.monotonic):
+        super().__init__()
+        self.inner = inner if inner is not None else MemoryClient()
+        self.latency = _per_operation(latency)
+        self.error_rate = _per_operation(error_rate)
+        self.max_ops_per_second = max_ops_per_second
+        self.bytes_per_second = bytes_per_second
+        self.sleep = sleep
+        self.clock = clock
+        self.stats = Counter()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._window_start = None
+        self._window_calls = 0
+
+    def _head(self, bucket, name):
+        self._call('metadata')
+        return self.inner._head(bucket, name)
+
+    def _read(self, bucket, name, start=None, end=None):
+        self._call('read')
+        data = self.inner._read(bucket, name, start, end)
+        self._transfer(len(data))
+        return data
+
+    def _put(self, bucket, name, chunks, properties, if_generation_match=None):
+        self._call('write')
+        data = b''.join(chunks)
+        self._transfer(len(data))
+        return self.inner._put(bucket, name, [data], properties,
+                               if_generation_match)
+
+    def _remove(self, bucket, name):
+        self._call('delete')
+        return self.inner._remove(bucket, name)
+
+    def _list(self, bucket, prefix):
+        self._call('list')
+        return self.inner._list(bucket, prefix)
+
+    def _call(self, operation):
+        with self._lock:
+            self.stats[operation] += 1
+            throttled = self._throttled()
+            failed = self._rng.random() < (self.error_rate.get(operation) or 0)
+            error = self._rng.choice(TRANSIENT_ERRORS)
+            distribution = self.latency.get(operation)
+            delay = distribution.sample(self._rng) if distribution else 0
+
+        self._delay(delay)
+        if throttled:
+            with self._lock:
+                self.stats['throttled'] += 1
+            raise exceptions.TooManyRequests(f'{operation} throttled')
+        if failed:
+            with self._lock:
+                self.stats['errors'] += 1
+            raise error(f'injected {operation} failure')
+
+    def _throttled(self):
+        if self.max_ops_per_second is None:
+            return False
+        now = self.clock()
+        if self._window_start is None or now - self._window_start >= 1:
+            self._window_start = now
+            self._window_calls = 0
+        self._window_calls += 1
+        return self._window_calls > self.max_ops_per_second
+
+    def _transfer(self, size):
+        if self.bytes_per_second:
+            self._delay(size / self.bytes_per_second)
+
+    def _delay(self, seconds):
+        if seconds > 0:
+            with self._lock:
+                self.stats['slept'] += seconds
+            self.sleep(seconds)
+
+
+def _per_operation(value):
+    if isinstance(value, dict):
+        return dict(value)
+    return {operation: value for operation in OPERATIONS}
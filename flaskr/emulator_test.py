@@ -0,0 +1,113 @@
+from .emulator import EmulatedClient, Fixed, LogNormal, Uniform, TRANSIENT_ERRORS
+from .drivers import make_storage_client
+from .backend import Backend
+from google.cloud import exceptions
+import random
+import pytest
+
+
+@pytest.fixture
+def slept():
+    return []
+
+
+def make_client(slept, **kwargs):
+    return EmulatedClient(sleep=slept.append, seed=1, **kwargs)
+
+
+def test_latency_per_operation(slept):
+    '''
+    Test that each storage call sleeps for its operation's latency.
+    '''
+    client = make_client(slept,
+                         latency={
+                             'write': Fixed(0.5),
+                             'read': Fixed(0.1)
+                         })
+    blob = client.bucket('sdswiki_contents').blob('page')
+
+    blob.upload_from_string('text')
+    blob.download_as_text()
+    client.bucket('sdswiki_contents').get_blob('page')
+
+    assert slept == [0.5, 0.1]
+    assert client.stats['write'] == 1
+    assert client.stats['read'] == 1
+    assert client.stats['metadata'] == 1
+
+
+def test_transfer_rate(slept):
+    client = make_client(slept, bytes_per_second=100)
+    client.bucket('sdswiki_contents').blob('page').upload_from_string(b'x' * 50)
+
+    assert slept == [0.5]
+
+
+def test_transient_errors(slept):
+    '''
+    Test that failures are injected at the configured rate.
+    '''
+    client = make_client(slept, error_rate={'read': 1})
+    blob = client.bucket('sdswiki_contents').blob('page')
+    blob.upload_from_string('text')
+
+    with pytest.raises(TRANSIENT_ERRORS):
+        blob.download_as_text()
+    assert client.stats['errors'] == 1
+
+
+def test_throttling(slept):
+    '''
+    Test that calls over the rate limit are rejected with 429.
+    '''
+    now = [0]
+    client = EmulatedClient(max_ops_per_second=2,
+                            sleep=slept.append,
+                            clock=lambda: now[0])
+    bucket = client.bucket('sdswiki_contents')
+
+    bucket.get_blob('a')
+    bucket.get_blob('b')
+    with pytest.raises(exceptions.TooManyRequests):
+        bucket.get_blob('c')
+
+    now[0] = 1.5
+    assert bucket.get_blob('c') is None
+    assert client.stats['throttled'] == 1
+
+
+def test_distributions():
+    rng = random.Random(3)
+    samples = sorted(LogNormal(0.02, 0.2).sample(rng) for _ in range(10000))
+
+    assert 0.017 < samples[5000] < 0.023
+    assert 0.15 < samples[9900] < 0.25
+    assert 1 <= Uniform(1, 2).sample(rng) <= 2
+
+
+def test_backend_storage_calls(slept):
+    '''
+    Test that the emulator shows the page cache saving storage reads.
+    '''
+    client = make_client(slept, latency=Fixed(0.01))
+    backend = Backend(client)
+    backend.upload('content', 'page', 'Elei')
+    backend.get_wiki_page('page')
+    reads = client.stats['read']
+
+    backend.get_wiki_page('page')
+    backend.get_wiki_page('page')
+
+    assert client.stats['read'] == reads
+
+
+def test_emulator_from_config():
+    client = make_storage_client({
+        'STORAGE_DRIVER': 'emulator',
+        'EMULATOR_MEDIAN_LATENCY': 0.01,
+        'EMULATOR_ERROR_RATE': 0.1
+    })
+
+    assert isinstance(client, EmulatedClient)
+    assert isinstance(client.latency['read'], LogNormal)
+    assert client.error_rate['read'] == 0.1
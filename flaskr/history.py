@@ -0,0 +1,303 @@
+'''
+Revision history of pages, kept as snapshots and deltas.
+
+Every upload of a page is kept as a revision, numbered from 1, in the
+object <page>/<revision> of the history bucket. A revision is either a
+snapshot of the whole page or a delta against the revision before it,
+listing the runs of lines kept from it, dropped from it and added. Every
+SNAPSHOT_INTERVAL revisions a snapshot is stored whatever the delta, so
+rebuilding any revision reads at most SNAPSHOT_INTERVAL objects, addressed
+by their number. Revisions are gzipped like pages (see compression.py).
+
+The number of a page's latest revision is kept in the metadata of its
+small <page>/head object. Recording a revision first takes the next number
+by rewriting the head with a generation match, so instances recording the
+same page at once never take the same number, and only listing a page's
+revisions lists the bucket.
+
+Uploads and imports (including restores from backups) are recorded.
+Deleting a page is not: its revisions are kept, and are continued if a
+page of the same name is written again.
+'''
+from . import compression
+from .cache import LRUCache
+from .retry import request_options
+from google.cloud import exceptions
+import difflib
+import io
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+#Constants
+
+#Bucket the revisions of every page are kept in
+HISTORY_BUCKET = 'sdswiki_history'
+
+#A snapshot is stored every this many revisions, bounding how many deltas a read applies
+SNAPSHOT_INTERVAL = 10
+
+#Revision numbers are zero padded to this many digits, so they list in order
+REVISION_DIGITS = 8
+
+#How many times the next revision number is taken again when another instance took it first
+RECORD_ATTEMPTS = 5
+
+#Name of the object under a page's revisions holding its latest revision number
+HEAD = 'head'
+
+#How many pages' latest revision text is kept to diff the next revision against
+MAX_CACHED_REVISIONS = 256
+
+SNAPSHOT = 'snapshot'
+DELTA = 'delta'
+
+
+class RevisionStore:
+    '''
+    Revisions of every page, stored as snapshots and deltas.
+
+    Args:
+        bucket = The bucket the revisions are kept in
+        retrier = Retries reads that fail with transient errors, if given
+    '''
+
+    def __init__(self, bucket, retrier=None):
+        self.bucket = bucket
+        self.retrier = retrier
+        #page name -> (revision, text) of the last revision written or read here
+        self._latest = LRUCache(max_entries=MAX_CACHED_REVISIONS)
+
+    def record(self, name, data, author):
+        '''
+        Adds a revision to a page's history.
+
+        Args:
+            name = The page name
+            data = The page's new content, a string, bytes or a seekable file
+                object. File objects, and bytes that aren't UTF-8 text, are
+                stored as snapshots, streamed like uploads.
+            author = Who wrote the revision
+
+        Returns:
+            The number of the new revision, or None if other instances kept
+            taking its number.
+        '''
+        if isinstance(data, bytes):
+            try:
+                data = data.decode('utf-8')
+            except UnicodeDecodeError:
+                data = io.BytesIO(data)
+
+        number = self._take_number(name)
+        if number is None:
+            logger.warning('Could not number a revision of %s', name)
+            return None
+
+        blob = self.bucket.blob(_object_name(name, number))
+        kind = SNAPSHOT
+        if hasattr(data, 'read'):
+            blob.metadata = {'author': author, 'kind': kind}
+            size = data.seek(0, io.SEEK_END)
+            payload, size, blob.content_encoding = (compression.compress_file(
+                data, size))
+            blob.upload_from_file(payload,
+                                  size=size,
+                                  rewind=True,
+                                  if_generation_match=0)
+            return number
+
+        payload = data
+        #Revisions in snapshot slots are always snapshots
+        if number % SNAPSHOT_INTERVAL != 1:
+            previous = self._text(name, number - 1)
+            if previous is not None:
+                delta = json.dumps(make_delta(previous, data))
+                if len(delta) < len(data):
+                    payload, kind = delta, DELTA
+        blob.metadata = {'author': author, 'kind': kind}
+        payload, blob.content_encoding = compression.compress(payload)
+        blob.upload_from_string(payload, if_generation_match=0)
+        self._latest.put(name, (number, data))
+        return number
+
+    def list(self, name):
+        '''
+        Lists the revisions of a page, oldest first.
+
+        Returns:
+            A list of dicts with each revision's number, author, kind
+            (snapshot or delta), stored size and time it was written.
+        '''
+        return [{
+            'revision': number,
+            'author': (blob.metadata or {}).get('author'),
+            'kind': (blob.metadata or {}).get('kind'),
+            'size': blob.size,
+            'updated': blob.updated,
+        } for number, blob in self._listing(name)]
+
+    def get(self, name, revision):
+        '''
+        Returns the text of a revision of a page, or None if there is no such revision.
+        '''
+        cached = self._latest.get(name)
+        if cached is not None and cached[0] == revision:
+            return _as_text(cached[1])
+        return self._text(name, revision)
+
+    def diff(self, name, old, new):
+        '''
+        Compares two revisions of a page.
+
+        Returns:
+            The unified diff from revision old to revision new, or None if
+            either of them doesn't exist.
+        '''
+        before = self._text(name, old)
+        after = self._text(name, new)
+        if before is None or after is None:
+            return None
+        return ''.join(
+            difflib.unified_diff(before.splitlines(keepends=True),
+                                 after.splitlines(keepends=True),
+                                 fromfile=f'{name} revision {old}',
+                                 tofile=f'{name} revision {new}'))
+
+    def _take_number(self, name):
+        '''
+        Takes the next revision number of a page by moving its head on to it.
+
+        Returns:
+            The number taken, or None if other instances kept taking it first.
+        '''
+        for _ in range(RECORD_ATTEMPTS):
+            head = self._call(lambda: self.bucket.get_blob(
+                _object_name(name, HEAD), **request_options()))
+            if head is None:
+                number, generation = 1, 0
+            else:
+                number = int(head.metadata['revision']) + 1
+                generation = head.generation
+
+            head = self.bucket.blob(_object_name(name, HEAD))
+            head.metadata = {'revision': str(number)}
+            try:
+                head.upload_from_string('', if_generation_match=generation)
+            except exceptions.PreconditionFailed:
+                #Another instance took this number first
+                continue
+            return number
+        return None
+
+    def _listing(self, name):
+        '''
+        Returns the (revision number, blob) pairs of a page, oldest first.
+        '''
+        prefix = f'{name}/'
+        blobs = self._call(lambda: list(
+            self.bucket.list_blobs(prefix=prefix, **request_options())))
+        listing = []
+        for blob in blobs:
+            number = blob.name[len(prefix):]
+            #Skips the head, and the revisions of pages whose names start with this one's
+            if len(number) == REVISION_DIGITS and number.isdigit():
+                listing.append((int(number), blob))
+        listing.sort(key=lambda entry: entry[0])
+        return listing
+
+    def _text(self, name, revision):
+        '''
+        Rebuilds a revision from the last snapshot at or before it and the deltas after that.
+
+        Only the revisions back to the snapshot are read, going no further
+        than the revision's snapshot slot, which always holds a snapshot.
+        '''
+        cached = self._latest.get(name)
+        if cached is not None and cached[0] == revision:
+            return _as_text(cached[1])
+        if revision < 1:
+            return None
+        slot = (revision - 1) // SNAPSHOT_INTERVAL * SNAPSHOT_INTERVAL + 1
+        blobs = []
+        for number in range(revision, slot - 1, -1):
+            blob = self._call(lambda: self.bucket.get_blob(
+                _object_name(name, number), **request_options()))
+            #Missing if it was never written, like after a crash
+            if blob is None:
+                return None
+            blobs.append(blob)
+            if (blob.metadata or {}).get('kind') == SNAPSHOT:
+                break
+        else:
+            return None
+
+        blobs.reverse()
+        text = _as_text(self._call(compression.read_bytes, blobs[0]))
+        for blob in blobs[1:]:
+            delta = json.loads(self._call(compression.read_bytes, blob))
+            text = apply_delta(text, delta)
+        return text
+
+    def _call(self, fn, *args):
+        if self.retrier is None:
+            return fn(*args)
+        return self.retrier.call(fn, *args)
+
+
+def make_delta(old, new):
+    '''
+    Describes how to turn one text into another, line by line.
+
+    Returns:
+        A list of operations: a positive number copies that many lines of
+        old, a negative number skips that many lines of old and a list of
+        lines is added as it is.
+    '''
+    a = old.splitlines(keepends=True)
+    b = new.splitlines(keepends=True)
+    delta = []
+    matcher = difflib.SequenceMatcher(None, a, b)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            delta.append(i2 - i1)
+            continue
+        if i2 > i1:
+            delta.append(i1 - i2)
+        if j2 > j1:
+            delta.append(b[j1:j2])
+    return delta
+
+
+def apply_delta(old, delta):
+    '''
+    Returns the text a delta from make_delta turns old into.
+    '''
+    lines = old.splitlines(keepends=True)
+    new = []
+    position = 0
+    for operation in delta:
+        if isinstance(operation, list):
+            new.extend(operation)
+        elif operation > 0:
+            new.extend(lines[position:position + operation])
+            position += operation
+        else:
+            position -= operation
+    return ''.join(new)
+
+
+def _object_name(name, revision):
+    '''
+    Returns the name of a page's revision object, or of its head for HEAD.
+    '''
+    if revision == HEAD:
+        return f'{name}/{HEAD}'
+    return f'{name}/{revision:0{REVISION_DIGITS}d}'
+
+
+def _as_text(data):
+    if isinstance(data, str):
+        return data
+    return data.decode('utf-8', 'replace')
@@ -0,0 +1,210 @@
+from .history import (RevisionStore, make_delta, apply_delta, HISTORY_BUCKET,
+                      SNAPSHOT_INTERVAL)
+from .backend import Backend
+from .drivers import MemoryClient
+from google.cloud import exceptions
+from unittest.mock import MagicMock
+import io
+import random
+import pytest
+
+
+@pytest.fixture
+def backend():
+    return Backend(MemoryClient())
+
+
+def lines(n, seed):
+    rng = random.Random(seed)
+    return ''.join(f'line {rng.randrange(1000)}\n' for _ in range(n))
+
+
+def edit(text, seed):
+    '''
+    Changes, drops and adds a few lines of a text.
+    '''
+    rng = random.Random(seed)
+    page = text.splitlines(keepends=True)
+    page[rng.randrange(len(page))] = f'changed {seed}\n'
+    del page[rng.randrange(len(page))]
+    page.insert(rng.randrange(len(page)), f'added {seed}\n')
+    return ''.join(page)
+
+
+def count_reads(client):
+    reads = []
+    read = client._read
+
+    def counted(bucket, name, start=None, end=None):
+        reads.append(name)
+        return read(bucket, name, start, end)
+
+    client._read = counted
+    return reads
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_delta_round_trip(seed):
+    old = lines(50, seed)
+    new = edit(edit(old, seed), seed + 100)
+
+    assert apply_delta(old, make_delta(old, new)) == new
+
+
+def test_delta_keeps_missing_final_newline():
+    assert apply_delta('a\nb', make_delta('a\nb', 'a\nc')) == 'a\nc'
+
+
+def test_history_is_mostly_deltas(backend):
+    '''
+    Test that edits are stored as small deltas, with a snapshot every SNAPSHOT_INTERVAL revisions.
+    '''
+    text = lines(200, 0)
+    backend.upload(text, 'Engine', 'Ada')
+    for revision in range(2, SNAPSHOT_INTERVAL + 3):
+        text = edit(text, revision)
+        backend.upload(text, 'Engine', 'Ada', True)
+
+    revisions = backend.get_revisions('Engine')
+
+    assert [r['revision'] for r in revisions
+           ] == list(range(1, SNAPSHOT_INTERVAL + 3))
+    assert [r['kind'] for r in revisions
+           ] == (['snapshot'] + ['delta'] * (SNAPSHOT_INTERVAL - 1) +
+                 ['snapshot', 'delta'])
+    assert revisions[1]['size'] < revisions[0]['size'] / 5
+    assert revisions[-1]['author'] == 'Ada'
+
+
+def test_revisions_rebuilt_with_bounded_reads(backend):
+    texts = [lines(100, 0)]
+    backend.upload(texts[0], 'Engine', 'Ada')
+    for revision in range(2, 2 * SNAPSHOT_INTERVAL + 1):
+        texts.append(edit(texts[-1], revision))
+        backend.upload(texts[-1], 'Engine', 'Ada', True)
+    #A fresh instance has nothing cached
+    store = RevisionStore(backend.storage_client.bucket(HISTORY_BUCKET))
+    reads = count_reads(backend.storage_client)
+
+    for revision, text in enumerate(texts, 1):
+        reads.clear()
+        assert store.get('Engine', revision) == text
+        assert len(reads) <= SNAPSHOT_INTERVAL
+
+
+def test_missing_revision(backend):
+    backend.upload('First programmer', 'Ada Lovelace', 'Elei')
+
+    assert backend.get_revision('Ada Lovelace', 2) is None
+    assert backend.diff_revisions('Ada Lovelace', 1, 2) is None
+
+
+def test_diff(backend):
+    backend.upload('Ada\nFirst programmer\n', 'Ada Lovelace', 'Elei')
+    backend.upload('Ada\nFirst computer programmer\n', 'Ada Lovelace', 'Elei',
+                   True)
+
+    diff = backend.diff_revisions('Ada Lovelace', 1, 2)
+
+    assert diff.splitlines() == [
+        '--- Ada Lovelace revision 1',
+        '+++ Ada Lovelace revision 2',
+        '@@ -1,2 +1,2 @@',
+        ' Ada',
+        '-First programmer',
+        '+First computer programmer',
+    ]
+
+
+def test_uploaded_files_are_snapshots(backend):
+    backend.upload(io.BytesIO(b'First programmer\n'), 'Ada Lovelace', 'Elei')
+    backend.upload('First computer programmer\n', 'Ada Lovelace', 'Elei', True)
+
+    assert [r['kind'] for r in backend.get_revisions('Ada Lovelace')
+           ] == ['snapshot', 'snapshot']
+    assert backend.get_revision('Ada Lovelace', 1) == 'First programmer\n'
+
+
+def test_bytes_are_recorded_as_text(backend):
+    backend.upload(b'Ada\nFirst programmer\n', 'Ada Lovelace', 'Elei')
+    backend.upload(b'Ada\nFirst computer programmer\n', 'Ada Lovelace', 'Elei',
+                   True)
+
+    assert [r['revision'] for r in backend.get_revisions('Ada Lovelace')
+           ] == [1, 2]
+    assert backend.get_revision('Ada Lovelace',
+                                2) == 'Ada\nFirst computer programmer\n'
+
+
+def test_storage_errors_dont_fail_uploads(backend):
+    backend.history.record = MagicMock(
+        side_effect=exceptions.ServiceUnavailable('down'))
+
+    assert backend.upload('First programmer', 'Ada Lovelace',
+                          'Elei') == 'Ada Lovelace uploaded to Wiki.'
+
+
+def test_imported_pages_are_recorded(backend):
+    backend.upload('First programmer\n', 'Ada Lovelace', 'Elei')
+
+    backend.import_pages([('Ada Lovelace', 'First computer programmer\n',
+                           'Nasir'), ('Grace Hopper', 'Compilers\n', 'Nasir')])
+
+    assert [r['author'] for r in backend.get_revisions('Ada Lovelace')
+           ] == ['Elei', 'Nasir']
+    assert backend.get_revision('Ada Lovelace',
+                                2) == 'First computer programmer\n'
+    assert backend.get_revision('Grace Hopper', 1) == 'Compilers\n'
+
+
+def test_record_renumbers_after_conflict(backend):
+    '''
+    Test that a revision numbered from a stale head takes the next number.
+    '''
+    bucket = backend.storage_client.bucket(HISTORY_BUCKET)
+    store = RevisionStore(bucket)
+    get_blob = bucket.get_blob
+    calls = []
+
+    def stale_head(name, **kwargs):
+        head = get_blob(name, **kwargs)
+        if name == 'Engine/head' and not calls:
+            calls.append(name)
+            #Another instance records revision 1 after we read the head
+            RevisionStore(bucket).record('Engine', 'theirs\n', 'Nasir')
+        return head
+
+    bucket.get_blob = stale_head
+
+    assert store.record('Engine', 'ours\n', 'Ada') == 2
+    assert store.get('Engine', 1) == 'theirs\n'
+    assert store.get('Engine', 2) == 'ours\n'
+
+
+def test_record_get_and_diff_never_list(backend):
+    '''
+    Test that revisions are addressed by number, so only listing a page's revisions lists the bucket.
+    '''
+    text = lines(50, 0)
+    backend.upload(text, 'Engine', 'Ada')
+    bucket = backend.storage_client.bucket(HISTORY_BUCKET)
+    store = RevisionStore(bucket)
+    bucket.list_blobs = MagicMock(side_effect=AssertionError('listed'))
+
+    for revision in range(2, SNAPSHOT_INTERVAL + 3):
+        text = edit(text, revision)
+        assert store.record('Engine', text, 'Ada') == revision
+
+    #A fresh instance has nothing cached
+    store = RevisionStore(bucket)
+    assert store.get('Engine', SNAPSHOT_INTERVAL + 2) == text
+    assert store.diff('Engine', 1, 2).startswith('--- Engine revision 1')
+    assert store.get('Engine', SNAPSHOT_INTERVAL + 3) is None
+
+
+def test_page_names_sharing_a_prefix(backend):
+    backend.upload('Notes', 'Ada/Notes', 'Elei')
+    backend.upload('First programmer', 'Ada', 'Elei')
+
+    assert len(backend.get_revisions('Ada')) == 1
+    assert backend.get_revision('Ada', 1) == 'First programmer'
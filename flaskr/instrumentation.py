@@ -0,0 +1,280 @@
+from . import drivers, metrics
+from collections import defaultdict
+from contextvars import ContextVar
+from flask import g, request
+from urllib.parse import urlsplit, parse_qs
+import contextvars
+import functools
+import inspect
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+#Constants
+
+#Requests slower than this many milliseconds are logged with their call breakdown
+#(override with SLOW_REQUEST_MS in the app config)
+SLOW_REQUEST_MS = 500
+
+#Driver client primitives and the storage operation each one performs
+DRIVER_OPERATIONS = {
+    '_head': 'metadata',
+    '_read': 'read',
+    '_put': 'write',
+    '_remove': 'delete',
+    '_list': 'list',
+}
+
+#HTTP methods of the GCS JSON API that write objects
+HTTP_WRITE_METHODS = ('POST', 'PUT', 'PATCH')
+
+#Stats of the request being handled. Lookups that views run on other threads
+#must run in a copy of the request's context for their calls to be counted.
+current = ContextVar('request_stats', default=None)
+
+
+class RequestStats:
+    '''
+    Count, bytes and time of the backend methods and storage calls of one request.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        #(kind, name) -> [count, bytes, seconds]
+        self.calls = defaultdict(lambda: [0, 0, 0.0])
+
+    def record(self, kind, name, seconds, size=0):
+        with self._lock:
+            entry = self.calls[(kind, name)]
+            entry[0] += 1
+            entry[1] += size
+            entry[2] += seconds
+
+    def total(self, kind):
+        '''
+        Returns the number of calls, bytes and seconds of one kind of call.
+        '''
+        with self._lock:
+            entries = [v for (k, _), v in self.calls.items() if k == kind]
+        return (sum(e[0] for e in entries), sum(e[1] for e in entries),
+                sum(e[2] for e in entries))
+
+    def server_timing(self, total_seconds):
+        '''
+        Formats the stats as a Server-Timing header value.
+        '''
+        with self._lock:
+            items = sorted(self.calls.items())
+        metrics = [f'total;dur={total_seconds * 1000:.1f}']
+        for (kind, name), (count, size, seconds) in items:
+            desc = f'{count} call{"s" if count != 1 else ""}'
+            if size:
+                desc += f', {size} B'
+            metrics.append(f'{kind}-{name};dur={seconds * 1000:.1f};'
+                           f'desc="{desc}"')
+        return ', '.join(metrics)
+
+    def breakdown(self):
+        with self._lock:
+            items = sorted(self.calls.items(), key=lambda item: -item[1][2])
+        return ', '.join(
+            f'{kind}.{name} x{count} {seconds * 1000:.1f}ms {size}B'
+            for (kind, name), (count, size, seconds) in items)
+
+
+def record(kind, name, seconds, size=0):
+    '''
+    Records a call in the metrics, and against the current request if there is one.
+    '''
+    if kind == 'backend':
+        metrics.BACKEND_SECONDS.observe(seconds, method=name)
+    else:
+        metrics.STORAGE_SECONDS.observe(seconds, operation=name)
+        if size:
+            metrics.STORAGE_BYTES.inc(size, operation=name)
+    stats = current.get()
+    if stats is not None:
+        stats.record(kind, name, seconds, size)
+
+
+def instrument_backend(backend):
+    '''
+    Times every public method of a Backend for the request that calls it.
+
+    The wrappers look the method up on the class at call time, so methods
+    patched onto the class afterwards are still used.
+    '''
+    for name, _ in inspect.getmembers(type(backend), inspect.isfunction):
+        if not name.startswith('_'):
+            setattr(backend, name, _timed_method(backend, name))
+    instrument_storage(backend.storage_client)
+    return backend
+
+
+def instrument_storage(storage_client):
+    '''
+    Times every storage call a client makes for the request that makes it.
+
+    Driver clients are timed per storage primitive. The GCS client is timed
+    per HTTP request through a requests response hook on its session.
+    '''
+    if isinstance(storage_client, drivers.LazyClient):
+        #Instrumenting must not create the client ahead of its first use
+        storage_client.on_create(instrument_storage)
+    elif isinstance(storage_client, drivers.Client):
+        for method, operation in DRIVER_OPERATIONS.items():
+            setattr(
+                storage_client, method,
+                _timed_primitive(getattr(storage_client, method), operation))
+    elif hasattr(storage_client, '_http'):
+        storage_client._http.hooks['response'].append(_record_http_response)
+
+
+def init_app(app, backend):
+    '''
+    Collects RequestStats for each request, adds them to the response as a
+    Server-Timing header and logs requests slower than SLOW_REQUEST_MS.
+
+    Storage calls made while a streamed response is sent still count towards
+    its request, though they come too late for its Server-Timing header.
+    '''
+    instrument_backend(backend)
+    app.config.setdefault('SLOW_REQUEST_MS', SLOW_REQUEST_MS)
+    listeners = app.extensions.setdefault('request_stats_listeners', [])
+
+    def done(stats):
+        for listener in listeners:
+            listener(stats)
+
+    @app.before_request
+    def start_request_stats():
+        metrics.REQUESTS_IN_FLIGHT.inc()
+        g.request_started = time.perf_counter()
+        current.set(RequestStats())
+
+    @app.after_request
+    def finish_request_stats(response):
+        stats = current.get()
+        if stats is None or 'request_started' not in g:
+            return response
+        elapsed = time.perf_counter() - g.request_started
+        response.headers['Server-Timing'] = stats.server_timing(elapsed)
+        if elapsed * 1000 > app.config['SLOW_REQUEST_MS']:
+            logger.warning('Slow request %s %s took %.1fms: %s', request.method,
+                           request.path, elapsed * 1000, stats.breakdown())
+        if response.is_streamed:
+            #The body's chunks carry the stats from here on
+            response.response = _counted(response.response, stats, done)
+            g.request_stats_streamed = True
+            current.set(None)
+        return response
+
+    @app.teardown_request
+    def reset_request_stats(error=None):
+        started = g.pop('request_started', None)
+        if started is not None:
+            metrics.REQUESTS_IN_FLIGHT.dec()
+            metrics.REQUEST_SECONDS.observe(time.perf_counter() - started,
+                                            endpoint=request.endpoint or
+                                            'unknown')
+        stats = current.get()
+        if stats is None:
+            return
+        current.set(None)
+        #Streamed bodies pass their stats on once they are sent, see _counted
+        if not g.pop('request_stats_streamed', False):
+            done(stats)
+
+
+def on_request_done(app, listener):
+    '''
+    Calls listener with the RequestStats of every request once it is done, streamed bodies included.
+    '''
+    app.extensions.setdefault('request_stats_listeners', []).append(listener)
+
+
+def _timed_method(backend, name):
+    method = getattr(type(backend), name)
+
+    @functools.wraps(method)
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            attribute = getattr(type(backend), name)
+            #Bind like normal attribute access would, mocks patched on the class aren't bound
+            if hasattr(attribute, '__get__'):
+                attribute = attribute.__get__(backend, type(backend))
+            return attribute(*args, **kwargs)
+        finally:
+            record('backend', name, time.perf_counter() - start)
+
+    return timed
+
+
+def _timed_primitive(primitive, operation):
+
+    @functools.wraps(primitive)
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        size = 0
+        try:
+            result = primitive(*args, **kwargs)
+            #Reads return the bytes read, writes the properties of what was written
+            if isinstance(result, bytes):
+                size = len(result)
+            elif operation == 'write':
+                size = result.get('size') or 0
+            return result
+        finally:
+            record('storage', operation, time.perf_counter() - start, size)
+
+    return timed
+
+
+def _counted(chunks, stats, done):
+    '''
+    Yields the chunks of a streamed response with its request's stats current,
+    then passes the stats to done.
+
+    Each chunk is made in a context of its own, since the server may send
+    the body after the request's context was torn down.
+    '''
+    context = contextvars.copy_context()
+    context.run(current.set, stats)
+    iterator = iter(chunks)
+    try:
+        while True:
+            try:
+                chunk = context.run(next, iterator)
+            except StopIteration:
+                return
+            yield chunk
+    finally:
+        if hasattr(chunks, 'close'):
+            context.run(chunks.close)
+        done(stats)
+
+
+def _record_http_response(response, *args, **kwargs):
+    size = int(response.headers.get('Content-Length') or 0)
+    record('storage', _http_operation(response.request),
+           response.elapsed.total_seconds(), size)
+
+
+def _http_operation(http_request):
+    '''
+    Returns the driver operation (see DRIVER_OPERATIONS) a GCS JSON API request performs.
+    '''
+    if http_request.method == 'DELETE':
+        return 'delete'
+    #Uploads, resumable upload chunks, compose and metadata patches
+    if http_request.method in HTTP_WRITE_METHODS:
+        return 'write'
+    url = urlsplit(http_request.url)
+    if parse_qs(url.query).get('alt') == ['media']:
+        return 'read'
+    if url.path.rstrip('/').endswith('/o'):
+        return 'list'
+    return 'metadata'
@@ -0,0 +1,129 @@
+from flaskr import create_app, instrumentation
+from .instrumentation import RequestStats, instrument_backend, current
+from .backend import Backend
+from .drivers import MemoryClient
+from .pages import STREAM_PAGE_SIZE
+from unittest.mock import MagicMock
+import logging
+import os
+import pytest
+
+
+@pytest.fixture
+def app():
+    app = create_app({'TESTING': True, 'STORAGE_DRIVER': 'memory'})
+    return app
+
+
+@pytest.fixture
+def backend(app):
+    return app.extensions['backend']
+
+
+def test_request_stats_server_timing():
+    stats = RequestStats()
+    stats.record('storage', 'read', 0.002, 100)
+    stats.record('storage', 'read', 0.001, 20)
+    stats.record('backend', 'get_page_record', 0.004)
+
+    assert stats.total('storage') == (2, 120, pytest.approx(0.003))
+    assert stats.server_timing(0.01) == (
+        'total;dur=10.0, backend-get_page_record;dur=4.0;desc="1 call", '
+        'storage-read;dur=3.0;desc="2 calls, 120 B"')
+
+
+def test_instrumented_backend_records_calls():
+    '''
+    Test that backend methods and the storage calls under them are counted.
+    '''
+    backend = instrument_backend(Backend(MemoryClient()))
+    backend.upload('First programmer', 'Ada Lovelace', 'Elei')
+    stats = RequestStats()
+    token = current.set(stats)
+    try:
+        assert backend.get_wiki_page('Ada Lovelace') == 'First programmer'
+    finally:
+        current.reset(token)
+
+    assert stats.calls[('backend', 'get_wiki_page')][0] == 1
+    assert stats.calls[('backend', 'get_page_record')][0] == 1
+    #The page itself plus the change log the page cache is checked against
+    assert stats.calls[('storage', 'read')][1] >= 16
+    assert stats.calls[('storage', 'metadata')][0] >= 1
+
+
+def test_calls_outside_requests_are_not_recorded():
+    backend = instrument_backend(Backend(MemoryClient()))
+
+    assert backend.upload('x', 'page', 'Elei') == 'page uploaded to Wiki.'
+    assert current.get() is None
+
+
+def test_server_timing_header(app, backend):
+    backend.upload('First programmer', 'Ada Lovelace', 'Elei')
+    client = app.test_client()
+
+    resp = client.get('/pages/Ada Lovelace')
+
+    timing = resp.headers['Server-Timing']
+    assert timing.startswith('total;dur=')
+    assert 'backend-get_page_record;' in timing
+    assert 'storage-read;' in timing
+
+
+def test_slow_request_logged(app, backend, caplog):
+    app.config['SLOW_REQUEST_MS'] = 0
+    backend.upload('First programmer', 'Ada Lovelace', 'Elei')
+    client = app.test_client()
+
+    with caplog.at_level(logging.WARNING, logger=instrumentation.__name__):
+        client.get('/pages/Ada Lovelace')
+
+    assert 'Slow request GET /pages/Ada Lovelace' in caplog.text
+    assert 'storage.read x' in caplog.text
+
+
+def test_fast_request_not_logged(app, caplog):
+    app.config['SLOW_REQUEST_MS'] = 60 * 1000
+    client = app.test_client()
+
+    with caplog.at_level(logging.WARNING, logger=instrumentation.__name__):
+        client.get('/about')
+
+    assert 'Slow request' not in caplog.text
+
+
+def test_streamed_reads_count_towards_request(app, backend):
+    '''
+    Test that storage reads made while a big page is streamed are counted once it is sent.
+    '''
+    content = os.urandom(STREAM_PAGE_SIZE).hex()
+    backend.upload(content, 'Big page', 'Elei')
+    finished = []
+    instrumentation.on_request_done(app, finished.append)
+    client = app.test_client()
+
+    resp = client.get('/pages/Big page')
+    assert content in resp.get_data(as_text=True)
+    resp.close()
+
+    assert len(finished) == 1
+    stored = backend.pages_bucket.get_blob('Big page').size
+    assert finished[0].calls[('storage', 'read')][1] >= stored
+    assert current.get() is None
+
+
+def test_gcs_requests_labeled_like_drivers():
+    base = 'https://storage.googleapis.com'
+    requests = {
+        f'{base}/download/storage/v1/b/wiki/o/page?alt=media': 'read',
+        f'{base}/storage/v1/b/wiki/o/page?projection=noAcl': 'metadata',
+        f'{base}/storage/v1/b/wiki/o?prefix=p': 'list',
+    }
+    for url, operation in requests.items():
+        assert instrumentation._http_operation(MagicMock(method='GET',
+                                                         url=url)) == operation
+    upload = MagicMock(method='POST', url=f'{base}/upload/storage/v1/b/wiki/o')
+    assert instrumentation._http_operation(upload) == 'write'
+    delete = MagicMock(method='DELETE', url=f'{base}/storage/v1/b/wiki/o/page')
+    assert instrumentation._http_operation(delete) == 'delete'
@@ -0,0 +1,253 @@
+'''
+Load generator for the wiki.
+
+Drives create_app() in process on the storage emulator with a weighted mix of
+routes from several threads, and reports throughput, latency percentiles and
+storage calls per request for each route. Storage calls are counted for every
+request of the run by the request instrumentation (see instrumentation.py).
+
+Usage:
+    python -m flaskr.loadtest --requests 2000 --concurrency 8 \
+        --mix pages=2,page=10,search=1,login=1 --latency-ms 20 --p99-ms 200
+'''
+from flaskr import create_app
+from flaskr.emulator import OPERATIONS
+from flaskr.instrumentation import on_request_done
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import random
+import threading
+import time
+
+#Constants
+
+#Route mix used when none is given, as relative weights
+DEFAULT_MIX = {'pages': 2, 'page': 10, 'search': 1, 'login': 1}
+
+#Account the load test signs in with
+USERNAME = 'loadtest'
+PASSWORD = 'loadtest-password'
+
+#Words the generated pages are made of
+WORDS = ('algorithm compiler turing lovelace hopper network kernel database '
+         'language theory machine learning security graph proof logic '
+         'program memory processor research').split()
+
+
+def seed_wiki(backend, pages, words_per_page, rng):
+    '''
+    Fills the wiki with generated pages and the load test's account.
+
+    Returns:
+        The titles of the generated pages.
+    '''
+    titles = []
+    for i in range(pages):
+        title = f"{rng.choice(WORDS).title()} {i}"
+        content = ' '.join(rng.choice(WORDS) for _ in range(words_per_page))
+        backend.upload(content, title, USERNAME)
+        titles.append(title)
+    backend.sign_up(USERNAME, PASSWORD)
+    return titles
+
+
+def make_requests(titles, rng):
+    '''
+    Returns a function per route that sends one request of that route with a test client.
+    '''
+    return {
+        'pages':
+            lambda client: client.get('/pages'),
+        'page':
+            lambda client: client.get(f'/pages/{rng.choice(titles)}'),
+        'search':
+            lambda client: client.post('/search',
+                                       data={'name': rng.choice(WORDS)}),
+        'login':
+            lambda client: client.post('/login',
+                                       data={
+                                           'username': USERNAME,
+                                           'password': PASSWORD
+                                       }),
+    }
+
+
+def storage_calls(stats):
+    '''
+    Returns how many storage calls a request made, from its RequestStats.
+    '''
+    if stats is None:
+        return 0
+    return sum(
+        stats.calls.get(('storage', operation), (0,))[0]
+        for operation in OPERATIONS)
+
+
+def percentile(samples, fraction):
+    '''
+    Returns the nearest rank percentile of a sorted list of samples.
+    '''
+    if not samples:
+        return 0
+    rank = max(int(round(fraction * len(samples))) - 1, 0)
+    return samples[min(rank, len(samples) - 1)]
+
+
+def run(requests=1000,
+        concurrency=8,
+        mix=None,
+        pages=50,
+        words_per_page=200,
+        latency_ms=0,
+        p99_ms=None,
+        error_rate=0,
+        seed=0):
+    '''
+    Runs a load test and returns its report.
+
+    Returns:
+        A dict from route to its requests, errors, requests per second,
+        p50, p95 and p99 latency in milliseconds and storage calls per request,
+        plus a 'total' entry.
+    '''
+    mix = mix or DEFAULT_MIX
+    config = {
+        'TESTING': True,
+        'STORAGE_DRIVER': 'emulator',
+    }
+    if latency_ms:
+        config['EMULATOR_MEDIAN_LATENCY'] = latency_ms / 1000
+        config['EMULATOR_P99_LATENCY'] = (p99_ms or latency_ms * 10) / 1000
+    app = create_app(config)
+    backend = app.extensions['backend']
+    rng = random.Random(seed)
+    titles = seed_wiki(backend, pages, words_per_page, rng)
+    #Faults are only injected once the wiki is seeded
+    backend.storage_client.error_rate = dict.fromkeys(OPERATIONS, error_rate)
+    senders = make_requests(titles, rng)
+    routes = [route for route in mix if mix[route] > 0]
+
+    plan = rng.choices(routes,
+                       weights=[mix[route] for route in routes],
+                       k=requests)
+    latencies = defaultdict(list)
+    calls = defaultdict(list)
+    errors = defaultdict(int)
+    lock = threading.Lock()
+    local = threading.local()
+    #The test client runs each request, and sends its body, on the thread that sent it
+    on_request_done(app, lambda stats: setattr(local, 'stats', stats))
+
+    def send(route):
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+        local.stats = None
+        start = time.perf_counter()
+        try:
+            response = senders[route](local.client)
+            #Reads the whole body, streamed pages included
+            response.get_data()
+            response.close()
+            failed = response.status_code >= 500
+        except Exception:
+            failed = True
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies[route].append(elapsed)
+            calls[route].append(storage_calls(local.stats))
+            if failed:
+                errors[route] += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(send, plan))
+    duration = time.perf_counter() - start
+
+    report = {}
+    for route in routes + ['total']:
+        if route == 'total':
+            samples = sorted(sum(latencies.values(), []))
+            failed = sum(errors.values())
+            route_calls = sum(calls.values(), [])
+        else:
+            samples = sorted(latencies[route])
+            failed = errors[route]
+            route_calls = calls[route]
+        report[route] = {
+            'requests': len(samples),
+            'errors': failed,
+            'rps': len(samples) / duration if duration else 0,
+            'p50': percentile(samples, 0.50) * 1000,
+            'p95': percentile(samples, 0.95) * 1000,
+            'p99': percentile(samples, 0.99) * 1000,
+            'storage_calls': sum(route_calls) / max(len(route_calls), 1),
+        }
+    return report
+
+
+def format_report(report):
+    lines = [
+        f"{'route':<8} {'requests':>8} {'errors':>6} {'req/s':>8} "
+        f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'storage/req':>11}"
+    ]
+    for route, row in report.items():
+        lines.append(f"{route:<8} {row['requests']:>8} {row['errors']:>6} "
+                     f"{row['rps']:>8.1f} {row['p50']:>8.2f} "
+                     f"{row['p95']:>8.2f} {row['p99']:>8.2f} "
+                     f"{row['storage_calls']:>11.1f}")
+    return '\n'.join(lines)
+
+
+def parse_mix(text):
+    '''
+    Parses a route mix like "pages=2,page=10" into a dict of weights.
+    '''
+    mix = {}
+    for part in text.split(','):
+        route, weight = part.split('=')
+        if route not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(
+                f"unknown route {route!r}, expected one of "
+                f"{', '.join(DEFAULT_MIX)}")
+        mix[route] = float(weight)
+    return mix
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument(
+        '--mix',
+        type=parse_mix,
+        default=None,
+        help='route weights, e.g. pages=2,page=10,search=1,login=1')
+    parser.add_argument('--pages', type=int, default=50)
+    parser.add_argument('--words-per-page', type=int, default=200)
+    parser.add_argument('--latency-ms',
+                        type=float,
+                        default=0,
+                        help='median storage latency')
+    parser.add_argument('--p99-ms',
+                        type=float,
+                        default=None,
+                        help='99th percentile storage latency')
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    report = run(requests=args.requests,
+                 concurrency=args.concurrency,
+                 mix=args.mix,
+                 pages=args.pages,
+                 words_per_page=args.words_per_page,
+                 latency_ms=args.latency_ms,
+                 p99_ms=args.p99_ms,
+                 error_rate=args.error_rate,
+                 seed=args.seed)
+    print(format_report(report))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+from .loadtest import run, format_report, parse_mix, percentile, storage_calls
+from .instrumentation import RequestStats
+import argparse
+import pytest
+
+
+def test_percentile():
+    samples = list(range(1, 101))
+    assert percentile(samples, 0.50) == 50
+    assert percentile(samples, 0.99) == 99
+    assert percentile([], 0.5) == 0
+
+
+def test_storage_calls_counts_every_operation():
+    stats = RequestStats()
+    stats.record('storage', 'read', 0.001, 10)
+    stats.record('storage', 'list', 0.001)
+    stats.record('backend', 'get_wiki_page', 0.002)
+
+    assert storage_calls(stats) == 2
+    assert storage_calls(None) == 0
+
+
+def test_parse_mix():
+    assert parse_mix('pages=2,page=10') == {'pages': 2, 'page': 10}
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_mix('upload=1')
+
+
+def test_run_reports_every_route():
+    '''
+    Test that a small load test reports latency and storage calls per route.
+    '''
+    report = run(requests=40, concurrency=4, pages=5, words_per_page=20)
+
+    assert set(report) == {'pages', 'page', 'search', 'login', 'total'}
+    assert report['total']['requests'] == 40
+    assert report['total']['errors'] == 0
+    assert report['pages']['storage_calls'] >= 1
+    assert report['login']['storage_calls'] >= 1
+    assert report['page']['p50'] <= report['page']['p99']
+    assert 'storage/req' in format_report(report)
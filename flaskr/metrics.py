@@ -0,0 +1,394 @@
+from bisect import bisect_left
+import json
+import os
+import tempfile
+import threading
+import time
+import weakref
+
+#Constants
+
+#Content type of the Prometheus text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+#Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+                   2.5, 5, 10)
+
+#Upper bounds of the search candidate count histogram buckets
+COUNT_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+#Metrics rendered by /metrics, in the order they are rendered
+REGISTRY = []
+
+#How many seconds apart each worker process writes its metrics for the others
+SHARE_INTERVAL = 5
+
+
+class _Shard:
+    '''
+    One thread's values of a metric. Only its own thread writes to it.
+    '''
+
+    def __init__(self):
+        self.values = {}
+
+
+class _Metric:
+    '''
+    Base of the metric types, added to registry (REGISTRY by default) when created.
+
+    Each thread updates its own shard of the values without taking a lock,
+    so recording a value costs a dict lookup and an addition. Scrapes add
+    the shards up. When a thread ends its shard is folded into the retired
+    totals, so threads that come and go don't leave shards behind.
+    '''
+
+    type = None
+
+    def __init__(self, name, help, labelnames=(), registry=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        #id of a live shard's values -> its values
+        self._live = {}
+        self._retired = {}
+        (REGISTRY if registry is None else registry).append(self)
+
+    def _values(self):
+        '''
+        Returns the calling thread's values.
+        '''
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = _Shard()
+            with self._lock:
+                self._live[id(shard.values)] = shard.values
+            weakref.finalize(shard, self._retire, shard.values)
+        return shard.values
+
+    def _retire(self, values):
+        with self._lock:
+            self._live.pop(id(values), None)
+            for key, value in list(values.items()):
+                self._retired[key] = self._merge(self._retired.get(key), value)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def collect(self):
+        '''
+        Returns the values of every thread added up, by label values.
+        '''
+        with self._lock:
+            shards = [dict(values) for values in self._live.values()]
+            shards.append(dict(self._retired))
+        totals = {}
+        for shard in shards:
+            for key, value in shard.items():
+                totals[key] = self._merge(totals.get(key), value)
+        return totals
+
+    def _merge(self, total, value):
+        return value if total is None else total + value
+
+    def render(self, totals=None):
+        '''
+        Renders the metric, from totals by label values if given, or this process's values.
+        '''
+        if totals is None:
+            totals = self.collect()
+        lines = [
+            f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}'
+        ]
+        for key, value in sorted(totals.items()):
+            lines.extend(self._samples(dict(zip(self.labelnames, key)), value))
+        return lines
+
+    def _samples(self, labels, value):
+        return [f'{self.name}{_labels(labels)} {_number(value)}']
+
+
+class Counter(_Metric):
+    '''
+    A total that only goes up.
+    '''
+
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        values = self._values()
+        key = self._key(labels)
+        values[key] = values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    '''
+    A value that goes up and down, like the number of requests in flight.
+    '''
+
+    type = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        values = self._values()
+        key = self._key(labels)
+        values[key] = values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    '''
+    Counts of observations by bucket, with their sum and count.
+
+    Args:
+        buckets = Upper bounds of the buckets, in increasing order
+    '''
+
+    type = 'histogram'
+
+    def __init__(self,
+                 name,
+                 help,
+                 labelnames=(),
+                 buckets=LATENCY_BUCKETS,
+                 registry=None):
+        super().__init__(name, help, labelnames, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        values = self._values()
+        key = self._key(labels)
+        #One count per bucket plus +Inf, then the sum
+        counts = values.get(key)
+        if counts is None:
+            counts = values[key] = [0] * (len(self.buckets) + 2)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def _merge(self, total, value):
+        if total is None:
+            return list(value)
+        return [a + b for a, b in zip(total, value)]
+
+    def _samples(self, labels, counts):
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += count
+            bucket_labels = dict(labels, le=_number(bound))
+            samples.append(
+                f'{self.name}_bucket{_labels(bucket_labels)} {cumulative}')
+        samples.append(
+            f'{self.name}_sum{_labels(labels)} {_number(counts[-1])}')
+        samples.append(f'{self.name}_count{_labels(labels)} {cumulative}')
+        return samples
+
+
+BACKEND_SECONDS = Histogram('wiki_backend_seconds',
+                            'Time spent in Backend methods.', ['method'])
+STORAGE_SECONDS = Histogram('wiki_storage_seconds',
+                            'Time spent in storage calls.', ['operation'])
+STORAGE_BYTES = Counter('wiki_storage_bytes_total',
+                        'Bytes read and written by storage calls.',
+                        ['operation'])
+SEARCH_CANDIDATES = Histogram('wiki_search_candidates',
+                              'Pages examined by a search.',
+                              buckets=COUNT_BUCKETS)
+SEARCH_RESULTS = Histogram('wiki_search_results',
+                           'Pages matched by a search.',
+                           buckets=COUNT_BUCKETS)
+REQUESTS_IN_FLIGHT = Gauge('wiki_requests_in_flight', 'Requests being handled.')
+REQUEST_SECONDS = Histogram('wiki_request_seconds', 'Time to handle requests.',
+                            ['endpoint'])
+
+
+class SharedMetrics:
+    '''
+    Adds up the metrics of every worker process of a server, through a directory they share.
+
+    Metrics are kept per process, and a scrape is answered by whichever
+    worker the server hands it to. So each worker writes its values to
+    <pid>.json in the directory every interval seconds and when it is
+    scraped, and scrapes add up every worker's file. Counters and histograms
+    of workers that exited are kept so totals never go backwards, while
+    gauges only count workers that are still running.
+
+    Args:
+        directory = The directory, emptied by the server before it starts workers
+        registry = The metrics to share, REGISTRY by default
+    '''
+
+    def __init__(self, directory, interval=SHARE_INTERVAL, registry=None):
+        self.directory = directory
+        self.interval = interval
+        self.registry = REGISTRY if registry is None else registry
+        self._writer = None
+        os.makedirs(directory, exist_ok=True)
+
+    def clear(self):
+        '''
+        Removes the files of an earlier run of the server. Call it before workers are forked.
+        '''
+        for file_name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, file_name))
+
+    def start(self):
+        '''
+        Starts writing this process's metrics every interval seconds. Call it in each worker once it is forked.
+        '''
+        self._writer = threading.Thread(target=self._write_forever,
+                                        name='metrics-writer',
+                                        daemon=True)
+        self._writer.start()
+
+    def write(self, caches=None):
+        '''
+        Writes this process's metrics, and the hits and misses of caches, to its file.
+        '''
+        state = {
+            'metrics': {
+                metric.name:
+                [[list(key), value] for key, value in metric.collect().items()]
+                for metric in self.registry
+            },
+            'caches': {
+                name: list(cache.stats())
+                for name, cache in (caches or {}).items()
+            },
+        }
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f)
+        #Replacing the file means readers never see half of it
+        os.replace(tmp_path, os.path.join(self.directory,
+                                          f'{os.getpid()}.json'))
+
+    def collect(self):
+        '''
+        Returns the totals of every worker, as a dict from metric name to
+        totals by label values, and a dict from cache name to (hits, misses).
+        '''
+        metrics = {metric.name: metric for metric in self.registry}
+        totals = {name: {} for name in metrics}
+        caches = {}
+        for file_name in os.listdir(self.directory):
+            pid, extension = os.path.splitext(file_name)
+            if extension != '.json':
+                continue
+            try:
+                with open(os.path.join(self.directory, file_name)) as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                continue
+            alive = _alive(int(pid))
+            for name, values in state['metrics'].items():
+                metric = metrics.get(name)
+                if metric is None or (metric.type == 'gauge' and not alive):
+                    continue
+                for key, value in values:
+                    key = tuple(key)
+                    totals[name][key] = metric._merge(totals[name].get(key),
+                                                      value)
+            for name, (hits, misses) in state['caches'].items():
+                total = caches.get(name, (0, 0))
+                caches[name] = (total[0] + hits, total[1] + misses)
+        return totals, caches
+
+    def _write_forever(self):
+        while True:
+            time.sleep(self.interval)
+            self.write()
+
+
+def render(caches=None, shared=None):
+    '''
+    Renders every metric in the Prometheus text format.
+
+    Args:
+        caches = A dict from name to LRUCache, whose hits and misses are included
+        shared = A SharedMetrics, to render the totals of every worker process
+            instead of this one's
+
+    Returns:
+        The metrics, one sample per line.
+    '''
+    lines = []
+    if shared is None:
+        for metric in REGISTRY:
+            lines.extend(metric.render())
+        cache_stats = {
+            name: cache.stats() for name, cache in (caches or {}).items()
+        }
+    else:
+        shared.write(caches)
+        totals, cache_stats = shared.collect()
+        for metric in shared.registry:
+            lines.extend(metric.render(totals[metric.name]))
+    if cache_stats:
+        lines.extend(_cache_samples(cache_stats))
+    return '\n'.join(lines) + '\n'
+
+
+def _cache_samples(cache_stats):
+    stats = dict(sorted(cache_stats.items()))
+    lines = [
+        '# HELP wiki_cache_hits_total Lookups answered by a cache.',
+        '# TYPE wiki_cache_hits_total counter'
+    ]
+    lines += [
+        f'wiki_cache_hits_total{_labels({"cache": name})} {hits}'
+        for name, (hits, misses) in stats.items()
+    ]
+    lines += [
+        '# HELP wiki_cache_misses_total Lookups a cache could not answer.',
+        '# TYPE wiki_cache_misses_total counter'
+    ]
+    lines += [
+        f'wiki_cache_misses_total{_labels({"cache": name})} {misses}'
+        for name, (hits, misses) in stats.items()
+    ]
+    lines += [
+        '# HELP wiki_cache_hit_ratio Share of lookups answered by a cache.',
+        '# TYPE wiki_cache_hit_ratio gauge'
+    ]
+    lines += [
+        f'wiki_cache_hit_ratio{_labels({"cache": name})} '
+        f'{_number(hits / (hits + misses) if hits + misses else 0)}'
+        for name, (hits, misses) in stats.items()
+    ]
+    return lines
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(
+        f'{name}="{_escape(value)}"' for name, value in labels.items())
+    return '{' + pairs + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n',
+                                                    '\\n').replace('"', '\\"')
+
+
+def _number(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return repr(value)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
@@ -0,0 +1,134 @@
+from flaskr import create_app
+from .metrics import Counter, Gauge, Histogram
+from .cache import LRUCache
+from . import metrics
+from unittest.mock import MagicMock
+import os
+import threading
+
+
+def test_counter_adds_up_threads():
+    '''
+    Test that values recorded on other threads, even finished ones, are collected.
+    '''
+    counter = Counter('test_total', 'Test counter.', ['op'], registry=[])
+
+    def work():
+        for _ in range(100):
+            counter.inc(op='read')
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    counter.inc(5, op='write')
+
+    assert counter.collect() == {('read',): 400, ('write',): 5}
+    assert counter.render() == [
+        '# HELP test_total Test counter.', '# TYPE test_total counter',
+        'test_total{op="read"} 400', 'test_total{op="write"} 5'
+    ]
+
+
+def test_gauge_goes_up_and_down():
+    gauge = Gauge('test_in_flight', 'Test gauge.', registry=[])
+    gauge.inc()
+    gauge.inc()
+    gauge.dec()
+
+    assert gauge.render()[-1] == 'test_in_flight 1'
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram('test_seconds',
+                          'Test histogram.', ['method'],
+                          buckets=(0.1, 1),
+                          registry=[])
+    for value in (0.05, 0.5, 0.5, 3):
+        histogram.observe(value, method='get')
+
+    assert histogram.render()[2:] == [
+        'test_seconds_bucket{method="get",le="0.1"} 1',
+        'test_seconds_bucket{method="get",le="1"} 3',
+        'test_seconds_bucket{method="get",le="+Inf"} 4',
+        'test_seconds_sum{method="get"} 4.05',
+        'test_seconds_count{method="get"} 4',
+    ]
+
+
+def test_label_values_are_escaped():
+    counter = Counter('test_total', 'Test counter.', ['page'], registry=[])
+    counter.inc(page='say "hi"\n')
+
+    assert counter.render()[-1] == 'test_total{page="say \\"hi\\"\\n"} 1'
+
+
+def test_cache_hit_ratio():
+    cache = LRUCache()
+    cache.put('a', 1)
+    cache.get('a')
+    cache.get('a')
+    cache.get('b')
+
+    text = metrics.render(caches={'page': cache})
+
+    assert 'wiki_cache_hits_total{cache="page"} 2' in text
+    assert 'wiki_cache_misses_total{cache="page"} 1' in text
+    assert 'wiki_cache_hit_ratio{cache="page"} 0.6666666666666666' in text
+
+
+def test_metrics_endpoint():
+    app = create_app({'TESTING': True, 'STORAGE_DRIVER': 'memory'})
+    backend = app.extensions['backend']
+    backend.upload('First programmer', 'Ada Lovelace', 'Elei')
+    client = app.test_client()
+    client.get('/pages/Ada Lovelace')
+    client.post('/search', data={'name': 'programmer'})
+
+    resp = client.get('/metrics')
+
+    text = resp.get_data(as_text=True)
+    assert resp.status_code == 200
+    assert resp.content_type == metrics.CONTENT_TYPE
+    assert '# TYPE wiki_backend_seconds histogram' in text
+    assert 'wiki_backend_seconds_count{method="get_page_record"}' in text
+    assert 'wiki_backend_seconds_count{method="search_pages"}' in text
+    assert 'wiki_search_candidates_count' in text
+    assert 'wiki_storage_seconds_count{operation="read"}' in text
+    #The scrape itself is in flight
+    assert 'wiki_requests_in_flight 1' in text
+    assert 'wiki_cache_hits_total{cache="page"}' in text
+
+
+def test_shared_metrics_add_up_workers(tmp_path):
+    '''
+    Test that a scrape reports every worker's metrics, keeping exited workers' counters but not their gauges.
+    '''
+    registry = []
+    counter = Counter('test_total', 'Test counter.', ['op'], registry=registry)
+    gauge = Gauge('test_in_flight', 'Test gauge.', registry=registry)
+    shared = metrics.SharedMetrics(str(tmp_path), registry=registry)
+
+    #A worker that has exited
+    pid = os.fork()
+    if pid == 0:
+        counter.inc(3, op='read')
+        gauge.inc()
+        shared.write({'page': MagicMock(stats=lambda: (4, 1))})
+        os._exit(0)
+    os.waitpid(pid, 0)
+    counter.inc(2, op='read')
+    gauge.inc()
+
+    cache = LRUCache()
+    cache.get('a')
+    text = metrics.render({'page': cache}, shared)
+
+    assert 'test_total{op="read"} 5' in text
+    assert 'test_in_flight 1' in text
+    assert 'wiki_cache_hits_total{cache="page"} 4' in text
+    assert 'wiki_cache_misses_total{cache="page"} 2' in text
+
+    shared.clear()
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,218 @@
+'''
+Pack files of small pages, for reading the whole wiki in a few requests.
+
+Every page is its own object, so reading them all costs a request per page
+no matter how small they are. A pack is one object holding the content of
+many small pages back to back, and the pack index maps each page to its
+pack, offset, length and the generation of the page object it was copied
+from. The page objects stay the source of truth: a packed copy is only
+used while its page is still at that generation, which a listing of the
+pages bucket tells for every page at once. Packs only serve whole-wiki
+reads like search: a single page is read from its own object, since
+checking its packed copy would take as many requests.
+
+Packs are rewritten from scratch by consolidate, run periodically by App
+Engine cron (see cron.yaml). The index is replaced with a generation match,
+so two consolidations can't both win, and packs it no longer lists are
+deleted afterwards.
+'''
+from .retry import request_options
+from google.cloud import exceptions
+import json
+import logging
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+#Constants
+
+#Bucket the packs and their index are kept in
+PACKS_BUCKET = 'sdswiki_packs'
+
+#Object mapping each packed page to its pack, offset, length and generation
+PACK_INDEX = 'index.json'
+
+#Pages bigger than this many bytes are left out of packs
+MAX_PACKED_PAGE_SIZE = 64 * 1024
+
+#A new pack is started once a pack holds this many bytes
+PACK_SIZE = 32 * 1024 * 1024
+
+
+class PackStore:
+    '''
+    Packs of small pages with an index of where each page's content is.
+
+    Args:
+        bucket = The bucket the packs and their index are kept in
+        retrier = Retries reads that fail with transient errors, if given
+    '''
+
+    def __init__(self, bucket, retrier=None):
+        self.bucket = bucket
+        self.retrier = retrier
+        self._lock = threading.Lock()
+        self._index = {'packs': [], 'pages': {}}
+        self._generation = None
+
+    def index(self):
+        '''
+        Returns the pack index, downloaded again only if it changed since it was last read.
+
+        Returns:
+            A dict with the names of the packs, and a dict from page name to
+            [pack, offset, length, generation].
+        '''
+        with self._lock:
+            generation = self._generation
+        try:
+            blob = self._call(
+                lambda: self.bucket.get_blob(PACK_INDEX,
+                                             if_generation_not_match=generation,
+                                             **request_options()))
+        except exceptions.NotModified:
+            with self._lock:
+                return self._index
+        if blob is None:
+            index, generation = {'packs': [], 'pages': {}}, None
+        else:
+            index = json.loads(
+                self._call(lambda: blob.download_as_text(**request_options())))
+            generation = blob.generation
+        with self._lock:
+            self._index, self._generation = index, generation
+            return index
+
+    def scan(self, blobs):
+        '''
+        Yields the content of every listed page that has an up to date packed copy.
+
+        Each pack is read with a single ranged read covering the pages
+        wanted from it, so memory holds at most one pack at a time.
+
+        Args:
+            blobs = The blobs of the pages bucket, as listed
+
+        Returns:
+            A generator of (page name, content) tuples, with None as the
+            content of pages that must be read from their own object.
+        '''
+        pages = self.index()['pages']
+        wanted = {}
+        for blob in blobs:
+            entry = pages.get(blob.name)
+            if entry is None or entry[3] != blob.generation:
+                yield blob.name, None
+                continue
+            wanted.setdefault(entry[0], []).append((blob.name, entry))
+
+        for pack, entries in wanted.items():
+            start = min(entry[1] for _, entry in entries)
+            end = max(entry[1] + entry[2] for _, entry in entries)
+            try:
+                data = self._read_range(pack, start, end)
+            except exceptions.NotFound:
+                #A consolidation replaced the pack since the index was read
+                for name, _ in entries:
+                    yield name, None
+                continue
+            for name, (_, offset, length, _) in entries:
+                yield name, data[offset - start:offset - start + length]
+
+    def consolidate(self, blobs, read):
+        '''
+        Rewrites the packs with the current content of every small page.
+
+        Pages that are still up to date in the current packs are copied from
+        them, so only pages changed since the last consolidation are read
+        one by one.
+
+        Args:
+            blobs = The blobs of the pages bucket, as listed
+            read = Function returning a page's content in bytes, or None if
+                the page was deleted
+
+        Returns:
+            How many pages were packed, or None if another consolidation
+            replaced the index first.
+        '''
+        small = [
+            blob for blob in blobs
+            if blob.size is not None and blob.size <= MAX_PACKED_PAGE_SIZE
+        ]
+        generations = {blob.name: blob.generation for blob in small}
+        old_index = self.index()
+        old_generation = self._generation
+
+        index = {'packs': [], 'pages': {}}
+        chunks = []
+        offset = 0
+
+        def write_pack():
+            name = _pack_name()
+            self.bucket.blob(name).upload_from_string(b''.join(chunks),
+                                                      if_generation_match=0)
+            for page in pages_in_pack:
+                index['pages'][page][0] = name
+            index['packs'].append(name)
+
+        pages_in_pack = []
+        for name, content in self.scan(small):
+            if content is None:
+                content = read(name)
+                if content is None:
+                    continue
+            index['pages'][name] = [
+                None, offset, len(content), generations[name]
+            ]
+            pages_in_pack.append(name)
+            chunks.append(content)
+            offset += len(content)
+            if offset >= PACK_SIZE:
+                write_pack()
+                chunks, offset, pages_in_pack = [], 0, []
+        if pages_in_pack:
+            write_pack()
+
+        blob = self.bucket.blob(PACK_INDEX)
+        try:
+            blob.upload_from_string(json.dumps(index),
+                                    content_type='application/json',
+                                    if_generation_match=old_generation or 0)
+        except exceptions.PreconditionFailed:
+            logger.info('Another consolidation replaced the pack index')
+            self._delete(index['packs'])
+            return None
+        with self._lock:
+            self._index, self._generation = index, blob.generation
+        self._delete(set(old_index['packs']) - set(index['packs']))
+        return len(index['pages'])
+
+    def _read_range(self, pack, start, end):
+        if end <= start:
+            return b''
+        #GCS ranges include their end
+        blob = self.bucket.blob(pack)
+        return self._call(lambda: blob.download_as_bytes(
+            start=start, end=end - 1, **request_options()))
+
+    def _delete(self, packs):
+        for pack in packs:
+            try:
+                self.bucket.blob(pack).delete()
+            except exceptions.NotFound:
+                pass
+
+    def _call(self, fn, *args, **kwargs):
+        if self.retrier is None:
+            return fn(*args, **kwargs)
+        return self.retrier.call(fn, *args, **kwargs)
+
+
+def _pack_name():
+    '''
+    Returns a unique, time ordered name for a new pack.
+    '''
+    return f'pack-{time.time_ns():020d}-{uuid.uuid4().hex[:8]}'
@@ -0,0 +1,129 @@
+from .packs import PackStore, PACKS_BUCKET, PACK_INDEX
+from .backend import Backend
+from .drivers import MemoryClient
+from unittest.mock import patch
+import json
+import pytest
+
+
+@pytest.fixture
+def backend():
+    backend = Backend(MemoryClient())
+    backend.packed_pages = True
+    backend.upload('Wrote the first algorithm', 'Ada Lovelace', 'Elei')
+    backend.upload('Built the first compiler', 'Grace Hopper', 'Elei')
+    backend.upload('Broke the Enigma', 'Alan Turing', 'Elei')
+    return backend
+
+
+def count_reads(client):
+    '''
+    Counts the reads of each bucket made by a storage client.
+    '''
+    reads = {}
+    read = client._read
+
+    def counted(bucket, name, start=None, end=None):
+        reads[bucket] = reads.get(bucket, 0) + 1
+        return read(bucket, name, start, end)
+
+    client._read = counted
+    return reads
+
+
+def packed(backend):
+    '''
+    Returns the content of every page with an up to date packed copy, by page name.
+    '''
+    blobs = backend.storage_client.list_blobs('sdswiki_contents')
+    return {
+        name: content
+        for name, content in backend.packs.scan(blobs)
+        if content is not None
+    }
+
+
+def test_consolidate_packs_every_small_page(backend):
+    assert backend.pack_pages() == 3
+
+    bucket = backend.storage_client.bucket(PACKS_BUCKET)
+    index = json.loads(bucket.get_blob(PACK_INDEX).download_as_text())
+    assert len(index['packs']) == 1
+    assert sorted(
+        index['pages']) == ['Ada Lovelace', 'Alan Turing', 'Grace Hopper']
+    assert packed(backend)['Grace Hopper'] == b'Built the first compiler'
+
+
+def test_consolidate_leaves_out_big_pages(backend):
+    with patch('flaskr.packs.MAX_PACKED_PAGE_SIZE', 20):
+        assert backend.pack_pages() == 1
+
+    assert packed(backend) == {'Alan Turing': b'Broke the Enigma'}
+
+
+def test_consolidate_starts_new_packs(backend):
+    with patch('flaskr.packs.PACK_SIZE', 1):
+        assert backend.pack_pages() == 3
+
+    assert len(backend.packs.index()['packs']) == 3
+
+
+def test_consolidate_copies_from_old_packs(backend):
+    '''
+    Test that repacking reads only changed pages one by one, and deletes the old pack.
+    '''
+    backend.pack_pages()
+    old_packs = backend.packs.index()['packs']
+    backend.upload('Wrote the first program', 'Ada Lovelace', 'Elei', True)
+    reads = count_reads(backend.storage_client)
+
+    assert backend.pack_pages() == 3
+
+    assert reads == {'sdswiki_contents': 1, PACKS_BUCKET: 1}
+    assert packed(backend)['Ada Lovelace'] == b'Wrote the first program'
+    bucket = backend.storage_client.bucket(PACKS_BUCKET)
+    assert bucket.get_blob(old_packs[0]) is None
+
+
+def test_consolidate_loses_race(backend):
+    '''
+    Test that a consolidation that loses the race for the index deletes its packs.
+    '''
+    other = PackStore(backend.storage_client.bucket(PACKS_BUCKET))
+
+    def read(name):
+        #Another instance packs the pages while this one is reading them
+        if backend.packs.index()['packs'] == []:
+            backend.pack_pages()
+        return backend._read_page_bytes(name)
+
+    blobs = backend.storage_client.list_blobs('sdswiki_contents')
+    assert other.consolidate(blobs, read) is None
+    assert other.index()['packs'] == backend.packs.index()['packs']
+    assert len(backend.storage_client.list_blobs(PACKS_BUCKET)) == 2
+
+
+def test_scan_skips_stale_copies(backend):
+    backend.pack_pages()
+    backend.upload('Wrote the first program', 'Ada Lovelace', 'Elei', True)
+    blobs = backend.storage_client.list_blobs('sdswiki_contents')
+
+    pages = dict(backend.packs.scan(blobs))
+
+    assert pages == {
+        'Ada Lovelace': None,
+        'Alan Turing': b'Broke the Enigma',
+        'Grace Hopper': b'Built the first compiler',
+    }
+
+
+def test_search_reads_packs(backend):
+    '''
+    Test that a packed search reads one pack instead of every page, and ranks like an unpacked one.
+    '''
+    unpacked = backend.search_pages('first', 1)
+    backend.pack_pages()
+    reads = count_reads(backend.storage_client)
+
+    assert backend.search_pages('first', 1) == unpacked
+    assert reads == {PACKS_BUCKET: 1}
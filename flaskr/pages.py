@@ -1,20 +1,79 @@
 from flask import Flask, flash
 from flask import render_template
 from flask_login import login_user, current_user, logout_user, login_required
-from flask import request
+from flask import request, make_response, abort, current_app
+from flask import stream_with_context, session
 from .backend import Backend
 from .user import User
 from .form import LoginForm
-from base64 import b64encode
+from . import metrics, backup
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import hashlib
+import mimetypes
+import os
+import time
 
 #Constants
 
 #How many characters of difference are allowed in search
 MAX_CHAR_DIST = 1
 
+#How many requests each worker serves at the same time, see gunicorn.conf.py
+WSGI_THREADS = int(os.environ.get('WSGI_THREADS', 8))
+
+#Most lookups a view runs off its request thread, the last one runs on it
+LOOKUP_FANOUT = 2
+
+#Threads running backend lookups, enough for every request's lookups at once
+#(override with LOOKUP_WORKERS in the app config)
+LOOKUP_WORKERS = WSGI_THREADS * LOOKUP_FANOUT
+
+#How many seconds browsers and proxies may reuse a page shown to signed out users
+PAGE_MAX_AGE = 60
+
+#How many seconds browsers and proxies may reuse an image
+IMAGE_MAX_AGE = 7 * 24 * 60 * 60
+
+#Secret key the app is configured with until a deployment sets its own. Sessions
+#signed with it can be forged, so backups are never served while it is in use
+DEFAULT_SECRET_KEY = 'dev'
+
+#Session key holding the user and generation of the bookmarks they last saved,
+#so whichever worker serves them next doesn't show older bookmarks
+BOOKMARKS_SAVED = 'bookmarks_saved'
+
+#Pages bigger than this many bytes are streamed to the browser as they are read
+STREAM_PAGE_SIZE = 1024 * 1024
+
 
 def make_endpoints(app, login_manager, backend):
 
+    #Runs independent backend lookups of a view concurrently, replaced in forked workers
+    app.extensions['lookups'] = lookup_pool(app)
+
+    def lookup(fn, *args):
+        #Runs in a copy of the request's context, so its calls count towards the request
+        return app.extensions['lookups'].submit(contextvars.copy_context().run,
+                                                fn, *args)
+
+    def save_bookmarks(name):
+        #Writes the change before answering, since other workers only hear of
+        #it through the changelog when they next poll it
+        generation = backend.save_bookmarks(name)
+        if generation is not None:
+            session[BOOKMARKS_SAVED] = [name, generation]
+
+    @app.before_request
+    def require_saved_bookmarks():
+        #Only requests with a session can have saved bookmarks, and reading
+        #the session would make every other response vary by cookie
+        if app.config['SESSION_COOKIE_NAME'] not in request.cookies:
+            return
+        saved = session.get(BOOKMARKS_SAVED)
+        if saved is not None:
+            backend.require_bookmarks(*saved)
+
     @app.route("/")
     def home():
         """
@@ -68,19 +127,34 @@ def make_endpoints(app, login_manager, backend):
         """Renders the about page with headshots of the team members.
 
         Returns:
-            The rendered about page with headshot images of the team members.
+            The rendered about page, linking to the team members' headshots under /images.
         """
-        nasir_img = b64encode(
-            backend.get_image("Nasir.Barnes.Headshot.JPG")).decode("utf-8")
-        elei_img = b64encode(
-            backend.get_image("Mary.Elei.Nkata.jpeg")).decode("utf-8")
-        dimitri_img = b64encode(
-            backend.get_image("Dimitri.Pierre-Louis.JPG")).decode("utf-8")
-        return render_template("about.html",
-                               nasir_img=nasir_img,
-                               elei_img=elei_img,
-                               dimitri_img=dimitri_img,
-                               name=current_user.get_id())
+        return render_template("about.html", name=current_user.get_id())
+
+    @app.route("/images/<name>")
+    def image(name):
+        """Serves an image from the images bucket with long lived cache headers.
+
+        Args:
+            name: The name of the image.
+
+        Returns:
+            The image bytes, a 304 if the browser's copy is current, or a 404 if there is no such image.
+        """
+        record = backend.get_image_record(name)
+        if record is None:
+            abort(404)
+
+        response = make_response(record['data'])
+        response.content_type = (record['content_type'] or
+                                 mimetypes.guess_type(name)[0] or
+                                 'application/octet-stream')
+        response.set_etag(str(record['generation']))
+        if record['updated']:
+            response.last_modified = record['updated']
+        response.cache_control.public = True
+        response.cache_control.max_age = IMAGE_MAX_AGE
+        return response.make_conditional(request)
 
     @app.route("/signup")
     def signup():
@@ -136,37 +210,84 @@ def make_endpoints(app, login_manager, backend):
         '''
         displays the details of the specific wiki page selected.
         '''
-        page = backend.get_wiki_page(page_title)
-        author = backend.check_page_author(page_title)
+        #A revalidating browser only needs the page's metadata, not its body
+        conditional = bool(request.if_none_match or request.if_modified_since)
+
+        #The bookmark lookup runs while this thread reads the page record
+        name = None
+        bookmarked = False
         if current_user.is_authenticated:
             name = str(current_user.get_id())
-            existing_pages = backend.get_all_page_names()
-            all_bookmarks = backend.get_bookmarks(name, existing_pages)
-            bookmarked = page_title in all_bookmarks
-            isAuthor = name == author
+            bookmark_lookup = lookup(backend.is_bookmarked, name, page_title)
+        try:
+            if conditional:
+                record = backend.get_page_metadata(page_title)
+            else:
+                record = backend.get_page_record(page_title, STREAM_PAGE_SIZE)
+            if name is not None:
+                bookmarked = bookmark_lookup.result()
+            etag = None
+            if record is not None:
+                etag = page_etag(record, name, bookmarked)
+                #Bookmarking doesn't change when the page was updated, so
+                #signed in views are only revalidated by their ETag
+                updated = record['updated'] if name is None else None
+                if conditional and not_modified(etag, updated):
+                    return add_validators(make_response('', 304), etag, record,
+                                          name)
+            if record is not None and 'content' not in record and 'chunks' not in record:
+                record = backend.get_page_record(page_title, STREAM_PAGE_SIZE)
+        except Exception as e:
             return render_template('pageDetails.html',
-                                   isAuthor=isAuthor,
+                                   isAuthor=False,
                                    title=page_title,
-                                   page=page,
+                                   page=f"Network error: {e}",
                                    name=name,
-                                   author=author,
-                                   bookmarked=bookmarked)
-
-        return render_template('pageDetails.html',
-                               isAuthor=False,
-                               title=page_title,
-                               page=page,
-                               author=author)
+                                   author=None,
+                                   bookmarked=False)
+
+        if record is None:
+            return render_template(
+                'pageDetails.html',
+                isAuthor=False,
+                title=page_title,
+                page=f"Error: Wiki page {page_title} not found.",
+                name=name,
+                author=None,
+                bookmarked=bookmarked)
+
+        context = dict(isAuthor=name is not None and name == record['author'],
+                       title=page_title,
+                       name=name,
+                       author=record['author'],
+                       bookmarked=bookmarked)
+        if 'chunks' in record:
+            #Big pages are sent as they are read, so the first byte doesn't wait for the last
+            body = stream_with_context(
+                stream_template('pageDetails.html',
+                                page_chunks=record['chunks'],
+                                **context))
+            response = app.response_class(body, mimetype='text/html')
+        else:
+            response = make_response(
+                render_template('pageDetails.html',
+                                page=record['content'],
+                                **context))
+        return add_validators(response, etag, record, name)
 
     @app.route("/search", methods=['GET', 'POST'])
     def search():
         """Handle the search page GET and POST requests.
 
+        With ?explain=1, in debug mode or when SEARCH_EXPLAIN is set, the
+        results come with a profile of where the search spent its time.
+
         Returns:
             The rendered HTML template with search results or an error message.
         """
-
-        backend = Backend()
+        explain = bool(
+            request.args.get('explain')) and (app.debug or
+                                              app.config['SEARCH_EXPLAIN'])
 
         if request.method == 'POST':
             search_content = str(request.form['name'])
@@ -177,23 +298,32 @@ def make_endpoints(app, login_manager, backend):
                                        page_titles=[],
                                        num_results=-1,
                                        search_content=search_content,
+                                       explain=explain,
                                        err=err)
 
-            all_pages = backend.search_pages(search_content, MAX_CHAR_DIST)
+            profile = None
+            if explain:
+                all_pages, profile = backend.search_pages(search_content,
+                                                          MAX_CHAR_DIST,
+                                                          explain=True)
+            else:
+                all_pages = backend.search_pages(search_content, MAX_CHAR_DIST)
 
             num_results = len(all_pages)
 
             return render_template('search.html',
                                    page_titles=all_pages,
                                    num_results=num_results,
-                                   search_content=search_content)
+                                   search_content=search_content,
+                                   explain=explain,
+                                   profile=profile)
 
         else:
             return render_template('search.html',
                                    page_titles=[],
                                    num_results=-1,
-                                   search_content="")
-
+                                   search_content="",
+                                   explain=explain)
 
     @app.route("/upload", methods=['GET', 'POST'])
     def uploads():
@@ -210,8 +340,8 @@ def make_endpoints(app, login_manager, backend):
             destination_blob = str(request.form['destination_blob'])
             data_file = request.files['data_file']
 
-            data = data_file.read()
-            upload_status = backend.upload(data, destination_blob,
+            #Werkzeug spools big files to disk, so stream from there instead of reading it all in
+            upload_status = backend.upload(data_file.stream, destination_blob,
                                            current_user.get_id())
 
             return render_template('result.html',
@@ -221,6 +351,20 @@ def make_endpoints(app, login_manager, backend):
 
         return render_template('upload.html', name=current_user.get_id())
 
+    @app.errorhandler(413)
+    def upload_too_large(error):
+        '''
+        Renders the result page when an upload is bigger than MAX_CONTENT_LENGTH.
+        '''
+        upload_status = 'Upload failed. The file is too large.'
+        #A 413 can be raised elsewhere while no limit is configured
+        if app.config['MAX_CONTENT_LENGTH'] is not None:
+            limit = round(app.config['MAX_CONTENT_LENGTH'] / (1024 * 1024), 2)
+            upload_status = f'Upload failed. Files can be at most {limit:g} MB.'
+        return render_template('result.html',
+                               upload_status=upload_status,
+                               name=current_user.get_id()), 413
+
     @app.route("/edit/<title>", methods=['GET'])
     def make_edit(title):
         '''
@@ -247,6 +391,63 @@ def make_endpoints(app, login_manager, backend):
                                name=current_user.get_id(),
                                page_title=page_title)
 
+    @app.route("/history/<page_title>", methods=['GET'])
+    def page_history(page_title):
+        '''
+        Lists the saved revisions of a page, newest first.
+        '''
+        try:
+            revisions = backend.get_revisions(page_title)
+        except Exception as e:
+            return render_template('history.html',
+                                   title=page_title,
+                                   error=f"Network error: {e}",
+                                   name=current_user.get_id())
+        return render_template('history.html',
+                               title=page_title,
+                               revisions=revisions[::-1],
+                               name=current_user.get_id())
+
+    @app.route("/history/<page_title>/<int:revision>", methods=['GET'])
+    def page_revision(page_title, revision):
+        '''
+        Displays a page as it was in one of its revisions.
+        '''
+        status = 200
+        try:
+            page = backend.get_revision(page_title, revision)
+        except Exception as e:
+            page = f"Network error: {e}"
+        if page is None:
+            page = f"Error: Revision {revision} of {page_title} not found."
+            status = 404
+        return render_template('revision.html',
+                               title=page_title,
+                               revision=revision,
+                               page=page,
+                               name=current_user.get_id()), status
+
+    @app.route("/history/<page_title>/diff/<int:old>/<int:new>",
+               methods=['GET'])
+    def page_diff(page_title, old, new):
+        '''
+        Displays the changes made to a page between two of its revisions.
+        '''
+        status = 200
+        try:
+            diff = backend.diff_revisions(page_title, old, new)
+        except Exception as e:
+            diff = f"Network error: {e}"
+        if diff is None:
+            diff = f"Error: Revision {old} or {new} of {page_title} not found."
+            status = 404
+        return render_template('revision.html',
+                               title=page_title,
+                               old=old,
+                               new=new,
+                               diff=diff,
+                               name=current_user.get_id()), status
+
     @app.route("/delete/<page_title>", methods=['GET'])
     def delete_page(page_title):
         deleted = backend.delete_page(page_title)
@@ -270,6 +471,67 @@ def make_endpoints(app, login_manager, backend):
                                upload_status=report_result,
                                name=current_user.get_id())
 
+    @app.route("/tasks/compact_reports", methods=['GET'])
+    def compact_reports():
+        '''
+        Merges pending reports, called by App Engine cron (see cron.yaml).
+
+        App Engine strips the X-Appengine-Cron header from outside requests,
+        so its presence means the request came from cron.
+        '''
+        if request.headers.get('X-Appengine-Cron') != 'true':
+            abort(403)
+        return {'merged': backend.compact_reports()}
+
+    @app.route("/tasks/pack_pages", methods=['GET'])
+    def pack_pages():
+        '''
+        Rebuilds the packs of small pages searches read, called by App Engine cron (see cron.yaml).
+        '''
+        if request.headers.get('X-Appengine-Cron') != 'true':
+            abort(403)
+        if not backend.packed_pages:
+            return {'packed': 0}
+        return {'packed': backend.pack_pages()}
+
+    @app.route("/_ah/warmup", methods=['GET'])
+    def warmup():
+        '''
+        Creates the storage client before the instance gets traffic, called by App Engine (see app.yaml).
+        '''
+        backend.warm_up()
+        return '', 200
+
+    @app.route("/metrics", methods=['GET'])
+    def metrics_text():
+        '''
+        Exposes request, backend, storage, search and cache metrics for Prometheus to scrape.
+        '''
+        caches = {'page': backend.page_cache, 'image': backend.image_cache}
+        #With several worker processes, this one answers for all of them
+        body = metrics.render(caches, app.extensions.get('shared_metrics'))
+        return app.response_class(body, content_type=metrics.CONTENT_TYPE)
+
+    @app.route("/admin/export", methods=['GET'])
+    @login_required
+    def export_wiki():
+        '''
+        Streams a backup of every page, bookmark and report to users named in ADMIN_USERS (see backup.py),
+        unless SECRET_KEY is still the default.
+        '''
+        if current_user.get_id() not in app.config['ADMIN_USERS']:
+            abort(403)
+        if app.config['SECRET_KEY'] == DEFAULT_SECRET_KEY:
+            app.logger.warning(
+                'Refusing to export the wiki while SECRET_KEY is the default')
+            abort(403)
+        filename = time.strftime('wiki-%Y%m%d-%H%M%S.tar.gz', time.gmtime())
+        response = app.response_class(backup.iter_export(backend),
+                                      mimetype='application/gzip')
+        response.headers[
+            'Content-Disposition'] = f'attachment; filename={filename}'
+        return response
+
     @app.route("/bookmark/<page_title>/<name>", methods=['GET'])
     def bookmark(page_title, name):
         '''
@@ -285,10 +547,14 @@ def make_endpoints(app, login_manager, backend):
             Render pageDetails template with bookmark added message.
         '''
 
-        backend.bookmark(page_title, name)
-        author = backend.check_page_author(page_title)
-        isAuthor = name == author
+        #Saving the bookmark, finding the author and reading the page don't depend on each other
+        saved = lookup(backend.bookmark, page_title, name)
+        author = lookup(backend.check_page_author, page_title)
         page = backend.get_wiki_page(page_title)
+        saved.result()
+        save_bookmarks(name)
+        author = author.result()
+        isAuthor = name == author
 
         return render_template('pageDetails.html',
                                isAuthor=isAuthor,
@@ -299,6 +565,43 @@ def make_endpoints(app, login_manager, backend):
                                bookmarked=True,
                                result='Bookmark added!')
 
+    @app.route("/api/bookmark/<page_title>", methods=['POST'])
+    def bookmark_json(page_title):
+        '''
+        Bookmarks a page for the signed in user without re-rendering the page.
+
+        Returns:
+            JSON with the new bookmark state and a message to show, or a 401 if nobody is signed in.
+        '''
+        if not current_user.is_authenticated:
+            return {'error': 'Please log in to bookmark pages.'}, 401
+
+        name = str(current_user.get_id())
+        added = backend.bookmark(page_title, name)
+        save_bookmarks(name)
+        result = 'Bookmark added!' if added else 'Page is already bookmarked.'
+        return {'page_title': page_title, 'bookmarked': True, 'result': result}
+
+    @app.route("/api/remove_bookmark/<page_title>", methods=['POST'])
+    def remove_bookmark_json(page_title):
+        '''
+        Removes a bookmark of the signed in user without re-rendering the page.
+
+        Returns:
+            JSON with the new bookmark state and a message to show, or a 401 if nobody is signed in.
+        '''
+        if not current_user.is_authenticated:
+            return {'error': 'Please log in to bookmark pages.'}, 401
+
+        name = str(current_user.get_id())
+        backend.remove_bookmark(page_title, name)
+        save_bookmarks(name)
+        return {
+            'page_title': page_title,
+            'bookmarked': False,
+            'result': 'Bookmark deleted!'
+        }
+
     @app.route("/bookmarks", methods=['GET'])
     def view_bookmarks():
         '''
@@ -308,7 +611,10 @@ def make_endpoints(app, login_manager, backend):
             return bookmarks template with 'no bookmarks added' if there are no bookmarks, or displays list of bookmarks
         '''
 
+        #The user's bookmarks load while the pages are listed, then are checked against them
+        loaded = lookup(backend.load_bookmarks, current_user.get_id())
         existing_pages = backend.get_all_page_names()
+        loaded.result()
         all_bookmarks = backend.get_bookmarks(current_user.get_id(),
                                               existing_pages)
         current_user.bookmarks = all_bookmarks
@@ -333,10 +639,13 @@ def make_endpoints(app, login_manager, backend):
         Returns:
             pageDetails template with bookmark removed message
         '''
-        backend.remove_bookmark(page_title, name)
-        author = backend.check_page_author(page_title)
-        isAuthor = name == author
+        removed = lookup(backend.remove_bookmark, page_title, name)
+        author = lookup(backend.check_page_author, page_title)
         page = backend.get_wiki_page(page_title)
+        removed.result()
+        save_bookmarks(name)
+        author = author.result()
+        isAuthor = name == author
 
         return render_template('pageDetails.html',
                                isAuthor=isAuthor,
@@ -346,3 +655,74 @@ def make_endpoints(app, login_manager, backend):
                                author=author,
                                bookmarked=False,
                                result='Bookmark deleted!')
+
+
+def lookup_pool(app):
+    '''
+    Returns the thread pool that runs the backend lookups of views, sized by LOOKUP_WORKERS in the app config.
+    '''
+    return ThreadPoolExecutor(max_workers=app.config['LOOKUP_WORKERS'],
+                              thread_name_prefix='lookup')
+
+
+def stream_template(template_name, **context):
+    '''
+    Renders a template piece by piece instead of into one string.
+
+    Returns:
+        An iterator over the rendered template.
+    '''
+    current_app.update_template_context(context)
+    template = current_app.jinja_env.get_template(template_name)
+    return template.generate(**context)
+
+
+def page_etag(record, name=None, bookmarked=False):
+    '''
+    Builds the ETag of a rendered page from its blob generation.
+
+    Signed in users see their bookmark and author options on the page, so
+    their ETag also covers who they are and whether the page is bookmarked.
+    '''
+    etag = str(record['generation'])
+    if name is not None:
+        viewer = f"{name}:{bookmarked}".encode()
+        etag += '-' + hashlib.sha1(viewer).hexdigest()[:16]
+    return etag
+
+
+def not_modified(etag, updated):
+    '''
+    Checks the request's If-None-Match and If-Modified-Since headers against a page.
+
+    Returns:
+        True if the browser's copy of the page is still current.
+    '''
+    #If-None-Match wins over If-Modified-Since when both are sent
+    if request.if_none_match:
+        #Compressed responses carry the page's ETag as a weak one
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and updated:
+        return updated.replace(microsecond=0) <= request.if_modified_since
+    return False
+
+
+def add_validators(response, etag, record, name=None):
+    '''
+    Adds the ETag, Last-Modified and Cache-Control headers of a page to a response.
+
+    Signed in users get no Last-Modified, since their view also depends on
+    their bookmarks, which the page's updated time doesn't cover.
+    '''
+    response.set_etag(etag)
+    #The page differs by who is signed in, so caches must keep a copy per session cookie
+    response.vary.add('Cookie')
+    if name is None:
+        if record['updated']:
+            response.last_modified = record['updated']
+        response.cache_control.public = True
+        response.cache_control.max_age = PAGE_MAX_AGE
+    else:
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    return response
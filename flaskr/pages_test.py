@@ -1,17 +1,22 @@
 from flaskr import create_app
+from flask import abort
 from .backend import Backend
 from unittest.mock import patch
 from .user import User
 from unittest.mock import MagicMock
 from unittest import mock
+from datetime import datetime, timezone
 import pytest
 import io
+import tarfile
+import threading
 
 
 @pytest.fixture
 def app():
     app = create_app({
         'TESTING': True,
+        'STORAGE_DRIVER': 'memory',
     })
     return app
 
@@ -45,7 +50,36 @@ def test_about_page(client, monkeypatch):
     assert response.status_code == 200
     assert b"<h1>About This Wiki</h1>" in response.data
     assert b"<h3>Your Authors</h3>" in response.data
-    assert b'' in response.data
+    assert b'src="/images/Nasir.Barnes.Headshot.JPG"' in response.data
+
+
+@patch("flaskr.backend.Backend.get_image_record",
+       return_value={
+           'data': b"jpeg bytes",
+           'content_type': 'image/jpeg',
+           'generation': 7,
+           'updated': None
+       })
+def test_image(mock_get_image_record, client):
+    """
+    Test that images are served with their content type and cache headers.
+    """
+    resp = client.get('/images/Nasir.Barnes.Headshot.JPG')
+    assert resp.status_code == 200
+    assert resp.data == b"jpeg bytes"
+    assert resp.content_type == 'image/jpeg'
+    assert resp.headers['ETag'] == '"7"'
+    assert 'max-age=604800' in resp.headers['Cache-Control']
+
+    resp = client.get('/images/Nasir.Barnes.Headshot.JPG',
+                      headers={'If-None-Match': '"7"'})
+    assert resp.status_code == 304
+
+
+@patch("flaskr.backend.Backend.get_image_record", return_value=None)
+def test_image_not_found(mock_get_image_record, client):
+    resp = client.get('/images/missing.jpg')
+    assert resp.status_code == 404
 
 
 def test_signup_page(client):
@@ -146,14 +180,17 @@ def test_pages_list(mock_get_all_page_names, client):
     assert b'Pages contained in this Wiki' in resp.data
 
 
-@patch("flaskr.backend.Backend.get_wiki_page",
-       return_value=b"sample page content")
-@patch("flaskr.backend.Backend.check_page_author", return_value=b"fake author")
+@patch("flaskr.backend.Backend.get_page_record",
+       return_value={
+           'content': b"sample page content",
+           'author': b"fake author",
+           'generation': 1,
+           'updated': None
+       })
 @patch("flaskr.user.User.get_id", return_value=b'Dimitripl5')
-@patch('flaskr.backend.Backend.get_all_page_names', return_value=['page_test'])
-@patch('flaskr.backend.Backend.get_bookmarks', return_value=[])
-def test_specific_page(mock_get_wiki_page, mock_check_page_author, mock_get_id,
-                       mock_get_all_page_names, mock_get_bookmarks, client):
+@patch('flaskr.backend.Backend.is_bookmarked', return_value=False)
+def test_specific_page(mock_get_page_record, mock_get_id, mock_is_bookmarked,
+                       client):
     '''
     Test that specific page can be called to display.
     '''
@@ -175,6 +212,66 @@ def test_upload_page(mock_upload, mock_logged_in, client):
     assert b'Upload a doc to the Wiki' in resp.data
 
 
+@patch("flask_login.utils._get_user", return_value=MagicMock())
+def test_upload_file_is_streamed(mock_logged_in, client, monkeypatch):
+    '''
+    Test that the uploaded file is handed to the backend as a stream.
+    '''
+    uploaded = {}
+
+    def mock_upload(self,
+                    data,
+                    destination_blob_name,
+                    username,
+                    override=False):
+        uploaded['data'] = data.read()
+        return 'test_page uploaded to Wiki.'
+
+    monkeypatch.setattr(Backend, 'upload', mock_upload)
+    resp = client.post('/upload',
+                       data={
+                           'destination_blob': 'test_page',
+                           'data_file': (io.BytesIO(b'page text'), 'page.txt')
+                       })
+
+    assert resp.status_code == 200
+    assert uploaded['data'] == b'page text'
+    assert b'test_page uploaded to Wiki.' in resp.data
+
+
+@patch("flask_login.utils._get_user", return_value=MagicMock())
+def test_upload_too_large(mock_logged_in, app, client):
+    '''
+    Test that uploads over the configured maximum size are rejected.
+    '''
+    app.config['MAX_CONTENT_LENGTH'] = 1024
+    resp = client.post('/upload',
+                       data={
+                           'destination_blob': 'test_page',
+                           'data_file': (io.BytesIO(b'x' * 4096), 'page.txt')
+                       })
+
+    assert resp.status_code == 413
+    assert b'Upload failed. Files can be at most' in resp.data
+
+
+@patch("flask_login.utils._get_user", return_value=MagicMock())
+def test_too_large_without_limit(mock_logged_in, app, client):
+    '''
+    Test that a 413 raised while no maximum size is configured still renders.
+    '''
+    app.config['MAX_CONTENT_LENGTH'] = None
+
+    @app.route('/too_large')
+    def too_large():
+        abort(413)
+
+    resp = client.get('/too_large')
+
+    assert resp.status_code == 413
+    assert b'Upload failed. The file is too large.' in resp.data
+
+
 #Testing that users are seeing the correct login page
 def test_login_page(client):
     resp = client.get('/login')
@@ -273,6 +370,75 @@ def test_bookmark(client, monkeypatch):
     assert b'Bookmark added!' in resp.data
 
 
+def test_bookmark_json(client, monkeypatch):
+    '''
+    Test that bookmarks can be toggled through the JSON endpoints without loading the page.
+    '''
+    calls = []
+
+    def mock_bookmark(self, page_title, name):
+        calls.append(('add', page_title, name))
+        return True
+
+    def mock_remove_bookmark(self, title, name):
+        calls.append(('remove', title, name))
+        return 'Bookmark successfully deleted'
+
+    def mock_sign_in(self, username, password):
+        return True
+
+    def mock_get_wiki_page(self, name):
+        raise AssertionError('page should not be read')
+
+    monkeypatch.setattr(Backend, 'bookmark', mock_bookmark)
+    monkeypatch.setattr(Backend, 'remove_bookmark', mock_remove_bookmark)
+    monkeypatch.setattr(Backend, 'sign_in', mock_sign_in)
+    monkeypatch.setattr(Backend, 'get_wiki_page', mock_get_wiki_page)
+
+    resp = client.post('/api/bookmark/test')
+    assert resp.status_code == 401
+
+    client.post('/login',
+                data=dict(username='Dimitripl5', password='testing123'))
+    resp = client.post('/api/bookmark/test')
+    assert resp.status_code == 200
+    assert resp.get_json()['bookmarked'] == True
+    assert resp.get_json()['result'] == 'Bookmark added!'
+
+    resp = client.post('/api/remove_bookmark/test')
+    assert resp.get_json()['bookmarked'] == False
+    assert calls == [('add', 'test', 'Dimitripl5'),
+                     ('remove', 'test', 'Dimitripl5')]
+
+
+def test_bookmark_json_read_your_writes(monkeypatch):
+    '''
+    Test that a bookmark saved through one worker shows on a page served by another.
+    '''
+    workers = [
+        create_app({
+            'TESTING': True,
+            'STORAGE_DRIVER': 'memory'
+        }) for _ in range(2)
+    ]
+    #Both workers share storage, but each has its own cached bookmarks
+    storage = workers[0].extensions['backend'].storage_client
+    workers[1].extensions['backend'].storage_client = storage
+    workers[0].extensions['backend'].upload('First programmer', 'Ada', 'Elei')
+    monkeypatch.setattr(Backend, 'sign_in', lambda self, u, p: True)
+    first, second = (worker.test_client() for worker in workers)
+    for client in (first, second):
+        client.post('/login', data=dict(username='Elei', password='x'))
+    assert b'data-bookmarked="false"' in second.get('/pages/Ada').data
+
+    first.post('/api/bookmark/Ada')
+    #The browser sends the session the first worker answered with to the second
+    cookie = next(c for c in first.cookie_jar if c.name == 'session')
+    second.set_cookie('localhost', 'session', cookie.value)
+
+    assert b'data-bookmarked="true"' in second.get('/pages/Ada').data
+
+
 def test_view_bookmarks(client, monkeypatch):
     '''
     Test that bookmarks are able to properly be viewed.
@@ -312,6 +478,35 @@ def test_view_bookmarks(client, monkeypatch):
     assert b'Hello World' in resp.data
 
 
+def test_view_bookmarks_lookups_run_concurrently(client, monkeypatch):
+    '''
+    Test that the page listing and the bookmark load wait on storage at the same time.
+    '''
+    #Each call waits until the other has started, so running them one after the other times out
+    barrier = threading.Barrier(2, timeout=5)
+
+    def mock_get_all_page_names(self):
+        barrier.wait()
+        return ['Test Page']
+
+    def mock_load_bookmarks(self, name):
+        barrier.wait()
+        return 1
+
+    monkeypatch.setattr(User, 'get_id', lambda self: 'Dimitripl5')
+    monkeypatch.setattr(Backend, 'sign_in', lambda self, u, p: True)
+    monkeypatch.setattr(Backend, 'get_all_page_names', mock_get_all_page_names)
+    monkeypatch.setattr(Backend, 'load_bookmarks', mock_load_bookmarks)
+    monkeypatch.setattr(Backend, 'get_bookmarks',
+                        lambda self, name, existing_pages: existing_pages)
+
+    client.post('/login', data=dict(username='Dimitripl5', password='x'))
+    resp = client.get('/bookmarks')
+
+    assert resp.status_code == 200
+    assert b'Test Page' in resp.data
+
+
 def test_remove_bookmark(client, monkeypatch):
     '''
     Test that remove bookmark button redirects back to bookmark page.
@@ -374,15 +569,17 @@ user = MagicMock()
 user.get_id.return_value = 'Elei'
 
 
-@patch("flaskr.backend.Backend.check_page_author", return_value='Elei')
-@patch("flaskr.backend.Backend.get_wiki_page",
-       return_value=b"sample page content")
-@patch("flaskr.backend.Backend.get_all_page_names", return_value=['test_page'])
-@patch('flaskr.backend.Backend.get_bookmarks', return_value=[])
+@patch("flaskr.backend.Backend.get_page_record",
+       return_value={
+           'content': b"sample page content",
+           'author': 'Elei',
+           'generation': 1,
+           'updated': None
+       })
+@patch('flaskr.backend.Backend.is_bookmarked', return_value=False)
 @patch("flask_login.utils._get_user", return_value=user)
-def test_page_is_viewed_by_author(mock_check_page_author, mock_wiki_page,
-                                  mock_logged_in, mock_get_all_page_names,
-                                  mock_get_bookmarks, client):
+def test_page_is_viewed_by_author(mock_get_page_record, mock_is_bookmarked,
+                                  mock_logged_in, client):
     resp = client.get('pages/test_page')
     assert resp.status_code == 200
     #assert b'Delete' in resp.data
@@ -392,15 +589,17 @@ def test_page_is_viewed_by_author(mock_check_page_author, mock_wiki_page,
 
 
 # Test correct options are displayed when user is not author
-@patch("flaskr.backend.Backend.check_page_author", return_value='Elei')
-@patch("flaskr.backend.Backend.get_wiki_page",
-       return_value=b"sample page content")
-@patch("flaskr.backend.Backend.get_all_page_names", return_value=['test_page'])
-@patch('flaskr.backend.Backend.get_bookmarks', return_value=[])
+@patch("flaskr.backend.Backend.get_page_record",
+       return_value={
+           'content': b"sample page content",
+           'author': 'Elei',
+           'generation': 1,
+           'updated': None
+       })
+@patch('flaskr.backend.Backend.is_bookmarked', return_value=False)
 @patch("flask_login.utils._get_user", return_value=MagicMock())
-def test_page_is_not_viewed_by_author(mock_check_page_author, mock_wiki_page,
-                                      mock_logged_in, mock_get_all_page_names,
-                                      mock_get_bookmarks, client):
+def test_page_is_not_viewed_by_author(mock_get_page_record, mock_is_bookmarked,
+                                      mock_logged_in, client):
     resp = client.get('pages/test_page')
     assert resp.status_code == 200
     assert b'Report' in resp.data
@@ -410,11 +609,14 @@ def test_page_is_not_viewed_by_author(mock_check_page_author, mock_wiki_page,
 
 
 # Test correct options are displayed when user is not signed in
-@patch("flaskr.backend.Backend.check_page_author", return_value='Elei')
-@patch("flaskr.backend.Backend.get_wiki_page",
-       return_value=b"sample page content")
-def test_page_is_viewed_by_not_signed_in_user(mock_check_page_author,
-                                              mock_wiki_page, client):
+@patch("flaskr.backend.Backend.get_page_record",
+       return_value={
+           'content': b"sample page content",
+           'author': 'Elei',
+           'generation': 1,
+           'updated': None
+       })
+def test_page_is_viewed_by_not_signed_in_user(mock_get_page_record, client):
     resp = client.get('pages/test_page')
     assert resp.status_code == 200
     assert b'Report' in resp.data
@@ -423,6 +625,94 @@ def test_page_is_viewed_by_not_signed_in_user(mock_check_page_author,
     assert b'sample page content' in resp.data
 
 
+# Test a missing page shows an error instead of failing
+@patch("flaskr.backend.Backend.get_page_record", return_value=None)
+def test_page_not_found(mock_get_page_record, client):
+    resp = client.get('pages/missing_page')
+    assert resp.status_code == 200
+    assert b'Error: Wiki page missing_page not found.' in resp.data
+
+
+# Test page views carry validators and answer revalidation with 304
+@patch("flaskr.backend.Backend.get_page_record",
+       return_value={
+           'content': b"sample page content",
+           'author': 'Elei',
+           'generation': 42,
+           'updated': datetime(2023, 4, 1, 12, 0, 0, tzinfo=timezone.utc)
+       })
+@patch("flaskr.backend.Backend.get_page_metadata",
+       return_value={
+           'author': 'Elei',
+           'generation': 42,
+           'updated': datetime(2023, 4, 1, 12, 0, 0, tzinfo=timezone.utc)
+       })
+def test_page_conditional_get(mock_get_page_metadata, mock_get_page_record,
+                              client):
+    resp = client.get('pages/test_page')
+    assert resp.status_code == 200
+    assert resp.headers['ETag'] == '"42"'
+    assert resp.headers['Last-Modified'] == 'Sat, 01 Apr 2023 12:00:00 GMT'
+    assert 'public' in resp.headers['Cache-Control']
+    assert resp.headers['Vary'] == 'Cookie'
+
+    resp = client.get('pages/test_page', headers={'If-None-Match': '"42"'})
+    assert resp.status_code == 304
+    assert resp.data == b''
+    mock_get_page_record.assert_called_once()
+
+    resp = client.get(
+        'pages/test_page',
+        headers={'If-Modified-Since': 'Sat, 01 Apr 2023 12:00:00 GMT'})
+    assert resp.status_code == 304
+
+    resp = client.get('pages/test_page', headers={'If-None-Match': '"41"'})
+    assert resp.status_code == 200
+    assert b'sample page content' in resp.data
+
+
+# Test signed in views vary by cookie and are only revalidated by their ETag
+@patch("flaskr.backend.Backend.get_page_record",
+       return_value={
+           'content': b"sample page content",
+           'author': 'Elei',
+           'generation': 42,
+           'updated': datetime(2023, 4, 1, 12, 0, 0, tzinfo=timezone.utc)
+       })
+@patch('flaskr.backend.Backend.is_bookmarked', return_value=False)
+@patch("flask_login.utils._get_user", return_value=MagicMock())
+def test_signed_in_page_not_revalidated_by_date(mock_logged_in,
+                                                mock_is_bookmarked,
+                                                mock_get_page_record, client):
+    resp = client.get('pages/test_page')
+    assert resp.status_code == 200
+    assert 'Last-Modified' not in resp.headers
+    assert 'Cookie' in resp.headers['Vary']
+    assert 'private' in resp.headers['Cache-Control']
+
+    resp = client.get(
+        'pages/test_page',
+        headers={'If-Modified-Since': 'Sat, 01 Apr 2023 12:00:00 GMT'})
+    assert resp.status_code == 200
+
+
+# Test big pages are streamed to the browser
+@patch("flaskr.backend.Backend.get_page_record",
+       return_value={
+           'chunks': iter(["first chunk ", "second chunk"]),
+           'author': 'Elei',
+           'generation': 5,
+           'updated': None
+       })
+def test_page_streamed(mock_get_page_record, client):
+    resp = client.get('pages/big_page')
+    assert resp.status_code == 200
+    assert resp.is_streamed
+    assert resp.headers['ETag'] == '"5"'
+    assert b'first chunk second chunk' in resp.data
+    assert b'Page author: Elei' in resp.data
+
+
 # Test report brings up the right page
 @patch("flask_login.utils._get_user", return_value=MagicMock())
 def test_user_can_make_report(mock_logged_in, client):
@@ -455,6 +745,34 @@ def test_no_report_made(mock_report_page, mock_logged_in, client):
     assert b'You need to enter a message' in resp.data
 
 
+# Test reports are only compacted when App Engine cron asks for it
+@patch("flaskr.backend.Backend.compact_reports", return_value=3)
+def test_compact_reports_task(mock_compact_reports, client):
+    resp = client.get('/tasks/compact_reports')
+    assert resp.status_code == 403
+    mock_compact_reports.assert_not_called()
+
+    resp = client.get('/tasks/compact_reports',
+                      headers={'X-Appengine-Cron': 'true'})
+    assert resp.status_code == 200
+    assert resp.get_json() == {'merged': 3}
+
+
+# Test pages are only packed when App Engine cron asks for it and packs are on
+def test_pack_pages_task(app, client):
+    backend = app.extensions['backend']
+    backend.upload('First programmer', 'Ada Lovelace', 'Elei')
+    resp = client.get('/tasks/pack_pages')
+    assert resp.status_code == 403
+
+    resp = client.get('/tasks/pack_pages', headers={'X-Appengine-Cron': 'true'})
+    assert resp.get_json() == {'packed': 0}
+
+    backend.packed_pages = True
+    resp = client.get('/tasks/pack_pages', headers={'X-Appengine-Cron': 'true'})
+    assert resp.get_json() == {'packed': 1}
+
+
 # Test page is successfully deleted
 @patch("flaskr.backend.Backend.delete_page", return_value=True)
 @patch("flask_login.utils._get_user", return_value=MagicMock())
@@ -497,3 +815,112 @@ def test_save_edit(mock_upload, mock_logged_in, client):
     assert b'Result for editing' in resp.data
     assert b'sample page' in resp.data
     assert b"upload sucessful" in resp.data
+
+
+def test_search_explain(app, client):
+    app.config['SEARCH_EXPLAIN'] = True
+    profile = {
+        'stages': {
+            'list': 0.001,
+            'fetch': 0.002
+        },
+        'total': 0.003,
+        'max_distance': 1,
+        'pages_examined': 2,
+        'words_compared': 7,
+        'distance_computations': 5,
+        'cache_hits': 1,
+    }
+    with patch("flaskr.backend.Backend.search_pages",
+               return_value=(['Cats'], profile)) as mock_search:
+        resp = client.post('/search?explain=1', data={'name': 'cats'})
+
+    assert mock_search.call_args.kwargs == {'explain': True}
+    assert resp.status_code == 200
+    assert b'Search profile' in resp.data
+    assert b'<td>distance computations</td><td>5</td>' in resp.data
+    assert b'action="/search?explain=1"' in resp.data
+
+
+def test_search_explain_disabled(client):
+    with patch("flaskr.backend.Backend.search_pages",
+               return_value=['Cats']) as mock_search:
+        resp = client.post('/search?explain=1', data={'name': 'cats'})
+
+    assert mock_search.call_args.kwargs == {}
+    assert b'Search profile' not in resp.data
+
+
+def test_warmup(client):
+    with patch("flaskr.backend.Backend.warm_up",
+               return_value=True) as mock_warm_up:
+        resp = client.get('/_ah/warmup')
+
+    assert resp.status_code == 200
+    mock_warm_up.assert_called_once()
+
+
+def test_export_needs_admin(app, client):
+    user = MagicMock()
+    user.get_id.return_value = 'Elei'
+    with patch("flask_login.utils._get_user", return_value=user):
+        resp = client.get('/admin/export')
+
+    assert resp.status_code == 403
+
+
+def test_export_refused_with_default_secret_key(app, client):
+    app.config['ADMIN_USERS'] = ('Elei',)
+    user = MagicMock()
+    user.get_id.return_value = 'Elei'
+    with patch("flask_login.utils._get_user", return_value=user):
+        resp = client.get('/admin/export')
+
+    assert resp.status_code == 403
+
+
+def test_export_streams_backup(app, client):
+    app.config['ADMIN_USERS'] = ('Elei',)
+    app.config['SECRET_KEY'] = 'not the default'
+    app.extensions['backend'].upload('First programmer', 'Ada Lovelace', 'Elei')
+    user = MagicMock()
+    user.get_id.return_value = 'Elei'
+    with patch("flask_login.utils._get_user", return_value=user):
+        resp = client.get('/admin/export')
+
+    assert resp.status_code == 200
+    assert resp.is_streamed
+    assert resp.headers['Content-Disposition'].startswith(
+        'attachment; filename=wiki-')
+    with tarfile.open(fileobj=io.BytesIO(resp.data), mode='r:gz') as tar:
+        assert tar.getnames() == ['pages/Ada Lovelace']
+
+
+def test_page_history(app, client):
+    '''
+    Test that edits show up in the page's history, with their changes.
+    '''
+    user = MagicMock()
+    user.get_id.return_value = 'Elei'
+    with patch("flask_login.utils._get_user", return_value=user):
+        client.post(
+            '/upload',
+            data={
+                'destination_blob': 'Ada Lovelace',
+                'data_file': (io.BytesIO(b'First programmer\n'), 'ada.txt')
+            })
+        client.post('/save_edit/Ada Lovelace',
+                    data={'content': 'First computer programmer\n'})
+
+        resp = client.get('/history/Ada Lovelace')
+        assert resp.status_code == 200
+        assert b'href="/history/Ada Lovelace/diff/1/2"' in resp.data
+
+        resp = client.get('/history/Ada Lovelace/1')
+        assert b'First programmer' in resp.data
+
+        resp = client.get('/history/Ada Lovelace/diff/1/2')
+        assert b'+First computer programmer' in resp.data
+
+        resp = client.get('/history/Ada Lovelace/3')
+        assert resp.status_code == 404
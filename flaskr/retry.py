@@ -0,0 +1,221 @@
+from . import metrics
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from google.cloud import exceptions
+import contextvars
+import logging
+import random
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+#Constants
+
+#Errors worth trying again: throttling, server errors and dropped connections
+TRANSIENT_ERRORS = (exceptions.TooManyRequests, exceptions.InternalServerError,
+                    exceptions.BadGateway, exceptions.ServiceUnavailable,
+                    exceptions.GatewayTimeout, ConnectionError, TimeoutError)
+
+#Seconds before the first retry, doubled for every retry after it up to MAX_BACKOFF
+INITIAL_BACKOFF = 0.1
+MAX_BACKOFF = 2
+
+#Seconds a call may take, retries included, before its last error is raised
+DEADLINE = 10
+
+#Shortest timeout given to a storage request, however little of the deadline is left
+MIN_REQUEST_TIMEOUT = 0.1
+
+#Reads slower than this percentile of recent reads get a duplicate read
+HEDGE_PERCENTILE = 0.95
+
+#How many recent read times the hedge delay is worked out from, and how many
+#are needed before reads are hedged at all
+HEDGE_WINDOW = 200
+HEDGE_MIN_SAMPLES = 20
+
+#How many reads and duplicate reads can be waited on at the same time
+HEDGE_WORKERS = 16
+
+RETRIES = metrics.Counter('wiki_storage_retries_total',
+                          'Storage calls retried after a transient error.',
+                          ['error'])
+HEDGES = metrics.Counter('wiki_hedged_reads_total',
+                         'Duplicate reads started for slow reads.', ['winner'])
+
+#Returns how many seconds are left of the deadline of the Retrier.call being run
+_remaining = contextvars.ContextVar('storage_deadline', default=None)
+
+
+def request_options():
+    '''
+    Returns the keyword arguments bounding a GCS request made under Retrier.call.
+
+    Turns off the GCS library's own retries, which would retry for up to two
+    minutes under ours, and times the request out once the deadline of the
+    Retrier.call it runs under has passed. Outside Retrier.call the library's
+    defaults are kept.
+
+    Returns:
+        A dict of retry and timeout, or an empty dict.
+    '''
+    remaining = _remaining.get()
+    if remaining is None:
+        return {}
+    return {'retry': None, 'timeout': max(remaining(), MIN_REQUEST_TIMEOUT)}
+
+
+class Retrier:
+    '''
+    Calls storage, retrying transient errors with jittered exponential backoff.
+
+    Each retry waits a random time between zero and a backoff that doubles
+    from initial_backoff up to max_backoff ("full jitter"), so instances that
+    failed together don't retry together. Once the next wait would end past
+    the call's deadline the last error is raised instead.
+
+    Args:
+        deadline = Seconds a call may take, retries included
+        initial_backoff = Longest wait before the first retry, in seconds
+        max_backoff = Longest wait before any retry, in seconds
+    '''
+
+    def __init__(self,
+                 deadline=DEADLINE,
+                 initial_backoff=INITIAL_BACKOFF,
+                 max_backoff=MAX_BACKOFF,
+                 sleep=time.sleep,
+                 clock=time.monotonic,
+                 rng=None):
+        self.deadline = deadline
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.sleep = sleep
+        self.clock = clock
+        self.rng = rng or random.Random()
+
+    def call(self, fn, *args, **kwargs):
+        '''
+        Returns fn(*args, **kwargs), retrying it while it fails with a transient error.
+        '''
+        give_up_at = self.clock() + self.deadline
+        backoff = self.initial_backoff
+        #GCS requests fn makes are bounded by the deadline, see request_options
+        token = _remaining.set(lambda: give_up_at - self.clock())
+        try:
+            while True:
+                try:
+                    return fn(*args, **kwargs)
+                except Exception as e:
+                    if not _is_transient(e):
+                        raise
+                    wait_for = self.rng.uniform(0, backoff)
+                    if self.clock() + wait_for >= give_up_at:
+                        raise
+                    RETRIES.inc(error=type(e).__name__)
+                    logger.info('Retrying %s in %.3fs after %r',
+                                getattr(fn, '__name__', fn), wait_for, e)
+                    self.sleep(wait_for)
+                    backoff = min(backoff * 2, self.max_backoff)
+        finally:
+            _remaining.reset(token)
+
+
+class Hedger:
+    '''
+    Sends a duplicate of reads that take longer than most, and keeps whichever answers first.
+
+    A few reads from cloud storage take many times longer than the rest.
+    Once a read has been waited on for longer than the percentile of recent
+    read times, a second identical read is started and the first of the two
+    to succeed is returned. The slower one finishes in the background and is
+    ignored. Reads are only hedged once enough read times were seen.
+
+    Args:
+        percentile = Fraction of reads that should finish without a duplicate
+        window = How many recent read times are kept
+        min_samples = How many read times are needed before hedging
+    '''
+
+    def __init__(self,
+                 percentile=HEDGE_PERCENTILE,
+                 window=HEDGE_WINDOW,
+                 min_samples=HEDGE_MIN_SAMPLES,
+                 workers=HEDGE_WORKERS,
+                 clock=time.perf_counter):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.workers = workers
+        self.clock = clock
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='hedge')
+
+    def delay(self):
+        '''
+        Returns how many seconds a read runs before it is duplicated, or None while too few reads were seen.
+        '''
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            samples = sorted(self._samples)
+        return samples[min(int(len(samples) * self.percentile),
+                           len(samples) - 1)]
+
+    def call(self, fn, *args):
+        '''
+        Returns fn(*args), asking twice if the first call is slow.
+        '''
+        delay = self.delay()
+        first = self._submit(fn, *args)
+        done, _ = wait([first], timeout=delay)
+        if done:
+            return first.result()
+
+        second = self._submit(fn, *args)
+        done, _ = wait([first, second], return_when=FIRST_COMPLETED)
+        winner = first if first in done else second
+        if winner.exception() is not None:
+            #The other read may still succeed
+            other = second if winner is first else first
+            if other.exception() is None:
+                winner = other
+        HEDGES.inc(winner='first' if winner is first else 'second')
+        return winner.result()
+
+    def after_fork(self):
+        '''
+        Replaces the lock and thread pool, which a forked worker can't use.
+        '''
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                            thread_name_prefix='hedge')
+
+    def _submit(self, fn, *args):
+        #Runs in a copy of the caller's context, so storage calls count towards its request
+        return self._executor.submit(contextvars.copy_context().run,
+                                     self._timed, fn, *args)
+
+    def _timed(self, fn, *args):
+        start = self.clock()
+        result = fn(*args)
+        with self._lock:
+            self._samples.append(self.clock() - start)
+        return result
+
+
+def _is_transient(error):
+    '''
+    Returns whether an error is worth trying again, including the timeouts
+    and dropped connections the GCS library raises once its own retries are off.
+    '''
+    if isinstance(error, TRANSIENT_ERRORS):
+        return True
+    #Only the GCS client imports requests, which is slow to import otherwise
+    requests = sys.modules.get('requests')
+    return requests is not None and isinstance(
+        error,
+        (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
@@ -0,0 +1,168 @@
+from .retry import Retrier, Hedger, request_options
+from .backend import Backend
+from .drivers import MemoryClient
+from .emulator import EmulatedClient
+from google.cloud import exceptions
+from unittest.mock import MagicMock
+import threading
+import pytest
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def retrier(clock):
+    return Retrier(deadline=10,
+                   initial_backoff=0.1,
+                   max_backoff=1,
+                   sleep=clock.sleep,
+                   clock=clock)
+
+
+def test_retries_transient_errors(retrier, clock):
+    fn = MagicMock(side_effect=[
+        exceptions.ServiceUnavailable('busy'),
+        exceptions.TooManyRequests('slow down'), 'page'
+    ])
+
+    assert retrier.call(fn, 'Ada Lovelace') == 'page'
+    assert fn.call_count == 3
+    fn.assert_called_with('Ada Lovelace')
+    #Full jitter waits at most 0.1s and then 0.2s
+    assert 0 <= clock.now <= 0.3
+
+
+def test_does_not_retry_other_errors(retrier):
+    fn = MagicMock(side_effect=exceptions.NotFound('missing'))
+
+    with pytest.raises(exceptions.NotFound):
+        retrier.call(fn)
+    assert fn.call_count == 1
+
+
+def test_gives_up_at_deadline(retrier, clock):
+    fn = MagicMock(side_effect=exceptions.InternalServerError('down'))
+
+    with pytest.raises(exceptions.InternalServerError):
+        retrier.call(fn)
+    assert fn.call_count > 3
+    assert clock.now < 10
+
+
+def test_requests_bounded_by_remaining_deadline(retrier, clock):
+    '''
+    Test that storage requests under a call get no retries of their own and time out at its deadline.
+    '''
+    options = []
+
+    def read():
+        clock.now += 4
+        options.append(request_options())
+        if len(options) == 1:
+            raise exceptions.ServiceUnavailable('busy')
+        return 'page'
+
+    assert retrier.call(read) == 'page'
+    assert options[0] == {'retry': None, 'timeout': 6}
+    assert options[1]['retry'] is None
+    assert options[1]['timeout'] <= 2
+    assert request_options() == {}
+
+
+def test_retries_dropped_connections(retrier):
+    requests = pytest.importorskip('requests')
+    fn = MagicMock(
+        side_effect=[requests.exceptions.ReadTimeout('slow'), 'page'])
+
+    assert retrier.call(fn) == 'page'
+
+
+def test_hedger_waits_for_enough_samples():
+    hedger = Hedger(min_samples=3)
+    assert hedger.delay() is None
+
+    for _ in range(3):
+        assert hedger.call(lambda: 'page') == 'page'
+
+    assert hedger.delay() is not None
+
+
+def test_hedger_duplicates_slow_read():
+    '''
+    Test that a read slower than the hedge delay is sent again, and the faster answer wins.
+    '''
+    hedger = Hedger(min_samples=1)
+    hedger.call(lambda: 'warm up')
+    release = threading.Event()
+    calls = []
+
+    def read():
+        calls.append(1)
+        if len(calls) == 1:
+            #The first read hangs until the test is over
+            release.wait(5)
+            return 'slow'
+        return 'fast'
+
+    assert hedger.call(read) == 'fast'
+    assert len(calls) == 2
+    release.set()
+
+
+def test_hedger_falls_back_when_the_first_answer_failed():
+    hedger = Hedger(min_samples=1)
+    hedger.call(lambda: 'warm up')
+    second_started = threading.Event()
+    calls = []
+
+    def read():
+        calls.append(1)
+        if len(calls) == 1:
+            second_started.wait(5)
+            raise exceptions.ServiceUnavailable('busy')
+        second_started.set()
+        return 'page'
+
+    assert hedger.call(read) == 'page'
+
+
+def test_backend_reads_through_transient_errors():
+    '''
+    Test that page reads survive storage that often fails.
+    '''
+    storage_client = EmulatedClient(MemoryClient(), seed=1)
+    backend = Backend(storage_client)
+    backend.retrier.sleep = lambda seconds: None
+    backend.upload('First programmer', 'Ada Lovelace', 'Elei')
+    backend.sign_up('Elei', 'password')
+    storage_client.error_rate = dict.fromkeys(['metadata', 'read', 'list'], 0.5)
+
+    assert backend.get_wiki_page('Ada Lovelace') == 'First programmer'
+    assert backend.get_all_page_names() == ['Ada Lovelace']
+    assert backend.check_page_author('Ada Lovelace') == 'Elei'
+    assert backend.sign_in('Elei', 'password') == True
+    assert storage_client.stats['errors'] > 0
+
+
+def test_backend_hedged_page_read():
+    backend = Backend(MemoryClient())
+    backend.hedger = Hedger(min_samples=1)
+    backend.upload('First programmer', 'Ada Lovelace', 'Elei')
+
+    assert backend.get_wiki_page('Ada Lovelace') == 'First programmer'
+    assert backend.hedger.delay() is not None
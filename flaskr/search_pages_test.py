@@ -228,3 +228,43 @@ def test_search_pages_relevance_score(backend):
     match_score = title_match_counter * 0.8 + content_match_counter * 0.1 + close_title_match_counter * 0.08 + close_content_match_counter * 0.02
 
     assert match_score == expected_match_score
+
+
+def test_search_pages_explain(wiki_searcher, backend):
+    '''
+    Test that explain returns the results with a profile of the search.
+    '''
+    wiki_searcher.get_all_page_names.return_value = ['Cats', 'Dogs']
+    wiki_searcher.get_wiki_page.side_effect = lambda x: {
+        'Cats': 'cats purr',
+        'Dogs': 'dogs bark loudly',
+    }[x]
+
+    page_titles, profile = backend.search_pages('cats', MAX_CHAR_DIST,
+                                                wiki_searcher, True)
+
+    assert page_titles == ['Cats']
+    assert set(
+        profile['stages']) == {'list', 'fetch', 'tokenize', 'compare', 'rank'}
+    assert profile['total'] == pytest.approx(sum(profile['stages'].values()))
+    assert profile['pages_examined'] == 2
+    assert profile['words_compared'] == 7
+    #Every comparison but the two exact matches of "cats" computes a distance
+    assert profile['distance_computations'] == 5
+    assert profile['results'] == 1
+    assert profile['max_distance'] == MAX_CHAR_DIST
+
+
+def test_search_pages_explain_counts_cache_hits(storage_client, blob):
+    backend = Backend(storage_client)
+    blob.name = 'Cats'
+    storage_client.list_blobs.return_value = [blob]
+    backend.page_cache.put('Cats', {'content': 'cats purr', 'author': 'Elei'})
+    backend.changelog.sync = MagicMock()
+
+    page_titles, profile = backend.search_pages('cats',
+                                                MAX_CHAR_DIST,
+                                                explain=True)
+
+    assert page_titles == ['Cats']
+    assert profile['cache_hits'] == 1
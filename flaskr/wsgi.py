@@ -0,0 +1,51 @@
+'''
+Hooks that let a preforking server share one loaded app between worker processes.
+
+The app is loaded once in the server's master process and its workers are
+forked from it, so modules, compiled templates and other read-only state
+sit in memory pages the workers share. What can't be shared, like the
+storage client's connections and anything holding locks or threads, is
+replaced in each worker after the fork. gunicorn.conf.py wires these into
+gunicorn.
+'''
+from .pages import lookup_pool
+import gc
+
+
+def preload(app):
+    '''
+    Loads read-only state in the master process, before workers are forked.
+
+    Imports the GCS client library and compiles every template, so workers
+    share them instead of each loading its own copy. Does not create the
+    storage client, each worker needs its own.
+    '''
+    if app.config['STORAGE_DRIVER'] == 'gcs':
+        #Imported for its side effect of loading the modules
+        from google.cloud import storage
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    if 'shared_metrics' in app.extensions:
+        app.extensions['shared_metrics'].clear()
+
+
+def before_fork():
+    '''
+    Moves every object loaded so far out of the garbage collector's view.
+
+    Collections in a worker would otherwise write to the headers of the
+    parent's objects and copy the pages they sit on.
+    '''
+    gc.freeze()
+
+
+def after_fork(app):
+    '''
+    Gives a freshly forked worker its own storage client, caches and thread
+    pools, and starts sharing its metrics with the other workers.
+    '''
+    app.extensions['backend'].after_fork()
+    app.extensions['lookups'] = lookup_pool(app)
+    if 'shared_metrics' in app.extensions:
+        app.extensions['shared_metrics'].start()
+    gc.enable()
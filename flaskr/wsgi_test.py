@@ -0,0 +1,95 @@
+from flaskr import create_app
+from .drivers import LazyClient, MemoryClient
+from . import wsgi
+from unittest.mock import MagicMock
+import gc
+import os
+import pytest
+import runpy
+
+
+@pytest.fixture
+def app():
+    return create_app({'TESTING': True, 'STORAGE_DRIVER': 'memory'})
+
+
+def test_preload_compiles_templates(app):
+    wsgi.preload(app)
+
+    assert len(app.jinja_env.cache) == len(app.jinja_env.list_templates())
+
+
+def test_after_fork_replaces_process_state(app):
+    backend = app.extensions['backend']
+    lookups = app.extensions['lookups']
+    page_cache = backend.page_cache
+    deferred = backend.deferred
+    backend.upload('First programmer', 'Ada Lovelace', 'Elei')
+    bookmarks = backend.bookmarks
+
+    wsgi.before_fork()
+    gc.disable()
+    wsgi.after_fork(app)
+
+    assert gc.isenabled()
+    assert app.extensions['lookups'] is not lookups
+    assert backend.page_cache is not page_cache
+    assert backend.deferred is not deferred
+    assert backend.bookmarks is not bookmarks
+    assert backend.get_wiki_page('Ada Lovelace') == 'First programmer'
+    gc.unfreeze()
+
+
+def test_server_config_collects_garbage_once_ready(app, monkeypatch):
+    '''
+    Test that the server config keeps the collector off only while preloading, and starts few workers.
+    '''
+    monkeypatch.delenv('WEB_CONCURRENCY', raising=False)
+    monkeypatch.setenv('WIKI_METRICS_DIR', '')
+    path = os.path.join(os.path.dirname(__file__), '..', 'gunicorn.conf.py')
+    try:
+        config = runpy.run_path(path)
+        assert not gc.isenabled()
+        server = MagicMock()
+        server.app.wsgi.return_value = app
+
+        config['when_ready'](server)
+
+        assert gc.isenabled()
+        assert config['workers'] == 2
+    finally:
+        gc.enable()
+        gc.unfreeze()
+
+
+def test_after_fork_recreates_lazy_client():
+    clients = []
+
+    def factory():
+        clients.append(MemoryClient())
+        return clients[-1]
+
+    app = create_app({'TESTING': True})
+    backend = app.extensions['backend']
+    backend.storage_client = LazyClient(factory)
+    backend.warm_up()
+
+    backend.after_fork()
+
+    assert backend.storage_client.created == False
+    backend.warm_up()
+    assert len(clients) == 2
+    assert backend.pages_bucket.client is clients[1]
+
+
+def test_lookup_pool_sized_from_config():
+    app = create_app({
+        'TESTING': True,
+        'STORAGE_DRIVER': 'memory',
+        'LOOKUP_WORKERS': 3
+    })
+    assert app.extensions['lookups']._max_workers == 3
+
+    wsgi.after_fork(app)
+
+    assert app.extensions['lookups']._max_workers == 3
@@ -0,0 +1,52 @@
+# Production server settings, used by app.yaml and `run-flask.sh --prod`.
+# Run with: gunicorn -c gunicorn.conf.py main:app
+import gc
+import os
+import tempfile
+
+bind = ':' + os.environ.get('PORT', '8080')
+
+# A few worker processes, each serving requests on several threads, since
+# most of a request is spent waiting on Cloud Storage. The host's core count
+# says nothing of what a small App Engine instance class gets, and every
+# worker holds its own caches, so more are only started with WEB_CONCURRENCY
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('WSGI_THREADS', 8))
+worker_class = 'gthread'
+timeout = 60
+
+# Each worker keeps its own metrics, so they are added up through files in
+# this directory for /metrics to report the whole server whichever worker
+# answers the scrape. Bookmarks are written with generation checks, so
+# workers don't lose each other's changes either, and the session tells
+# every worker which bookmarks a user last saved (see flaskr/bookmarks.py).
+os.environ.setdefault(
+    'WIKI_METRICS_DIR',
+    os.path.join(tempfile.gettempdir(), f'wiki-metrics-{os.getpid()}'))
+
+# Load the app once in the master process and fork the workers from it, so
+# they share its memory until they write to it
+preload_app = True
+
+# Objects freed while loading would leave holes in pages the workers would
+# then copy, so the collector stays off until preloading is done
+gc.disable()
+
+
+def when_ready(server):
+    from flaskr import wsgi
+    wsgi.preload(server.app.wsgi())
+    # What was loaded is kept out of the master's collections from now on,
+    # so they don't touch the pages the workers share
+    gc.freeze()
+    gc.enable()
+
+
+def pre_fork(server, worker):
+    from flaskr import wsgi
+    wsgi.before_fork()
+
+
+def post_fork(server, worker):
+    from flaskr import wsgi
+    wsgi.after_fork(worker.app.wsgi())
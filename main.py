@@ -1,3 +1,7 @@
 from flaskr import create_app
+import logging
 
-app = create_app()
\ No newline at end of file
+# Logging is set up by the entry point, not when flaskr is imported
+logging.basicConfig(level=logging.INFO)
+
+app = create_app()
@@ -1,5 +1,10 @@
 #!/usr/bin/env bash
 
+# Serve with the production settings in gunicorn.conf.py
+if [ "$1" == "--prod" ]; then
+    exec gunicorn -c gunicorn.conf.py main:app
+fi
+
 export FLASK_APP=flaskr
 export FLASK_ENV=development
-flask run -p 8080
\ No newline at end of file
+flask run -p 8080